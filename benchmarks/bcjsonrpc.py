@@ -0,0 +1,185 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+
+#####################
+# BCJSONRPC clients #
+#####################
+
+
+
+import json
+import time
+from binascii import hexlify
+from threading import Thread, RLock, Condition
+from core.util import Bunch, monotonic
+from modules.theseven.bcjsonrpc.bcjsonrpcworksource import BCJSONRPCWorkSource
+from .benchmark import BenchmarkCore
+from .hashing import data, target
+try: from socketserver import ThreadingMixIn
+except ImportError: from SocketServer import ThreadingMixIn
+try: from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError: from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+
+# Work sources that point at the same stand-in server
+sourcecount = 2
+getworkconnections = 4
+uploadconnections = 1
+# Seconds that the stand-in server needs to answer a getwork request
+getworkdelay = 0.02
+shares = 50
+
+
+
+class StandInGetworkHandler(BaseHTTPRequestHandler):
+
+  protocol_version = "HTTP/1.1"
+  disable_nagle_algorithm = True
+
+
+  def setup(self):
+    BaseHTTPRequestHandler.setup(self)
+    with self.server.lock: self.server.connections += 1
+
+
+  def log_message(self, format, *args):
+    pass
+
+
+  def do_POST(self):
+    req = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode("utf_8"))
+    if req["params"]:
+      result = True
+    else:
+      time.sleep(getworkdelay)
+      result = {"data": hexlify(data).decode("ascii"), "target": hexlify(target).decode("ascii")}
+    body = json.dumps({"result": result, "error": None, "id": req["id"]}).encode("utf_8")
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+
+
+# A getwork pool on localhost that needs getworkdelay seconds per job and accepts every share immediately.
+# Counts the connections that were opened to it.
+class StandInGetworkServer(ThreadingMixIn, HTTPServer):
+
+  daemon_threads = True
+
+
+  def __init__(self):
+    HTTPServer.__init__(self, ("127.0.0.1", 0), StandInGetworkHandler)
+    self.lock = RLock()
+    self.connections = 0
+    self.port = self.server_address[1]
+    self.thread = Thread(None, self.serve_forever, "getwork_server", (0.1,))
+    self.thread.daemon = True
+    self.thread.start()
+
+
+  def close(self):
+    self.shutdown()
+    self.server_close()
+
+
+
+# Just what the work source needs to upload a share
+class UploadJob(object):
+
+  def __init__(self, condition, latencies):
+    self.condition = condition
+    self.latencies = latencies
+    self.starttime = monotonic()
+
+
+  def nonce_handled_callback(self, nonce, noncediff, result):
+    with self.condition:
+      self.latencies.append((monotonic() - self.starttime, result))
+      self.condition.notify()
+
+
+# Starts the work sources and keeps all of their fetchers busy, like the core does while refilling the work buffer
+def _run(measure):
+  server = StandInGetworkServer()
+  sources = []
+  state = Bunch(refilling = True)
+  def refill():
+    while state.refilling:
+      for source in sources: source._start_fetcher()
+      time.sleep(0.001)
+  try:
+    for i in range(sourcecount):
+      source = BCJSONRPCWorkSource(BenchmarkCore())
+      source.settings.host = "127.0.0.1"
+      source.settings.port = server.port
+      source.settings.getworkconnections = getworkconnections
+      source.settings.uploadconnections = uploadconnections
+      source.settings.longpollconnections = 0
+      source._push_jobs = lambda jobs, name: None
+      sources.append(source)
+    for source in sources: source.start()
+    refiller = Thread(None, refill, "refiller")
+    refiller.start()
+    try: return measure(server, sources)
+    finally:
+      state.refilling = False
+      refiller.join()
+      for source in sources: source.stop()
+  finally: server.close()
+
+
+# Connections that the work sources opened to the server while refilling the work buffer
+def connection_count():
+  def measure(server, sources):
+    time.sleep(1)
+    return server.connections
+  return _run(measure)
+
+
+# Time from finding a share until it was accepted while all job fetching connections are busy (median)
+def upload_latency():
+  def measure(server, sources):
+    condition = Condition()
+    latencies = []
+    with condition:
+      for i in range(shares):
+        sources[i % len(sources)].nonce_found(UploadJob(condition, latencies), data, data[76:80], 1)
+        condition.wait(0.05)
+      endtime = monotonic() + 10
+      while len(latencies) < shares and monotonic() < endtime: condition.wait(endtime - monotonic())
+    accepted = sorted(latency for latency, result in latencies if result is True)
+    if len(accepted) != shares: raise Exception("Only %d of %d shares were accepted" % (len(accepted), shares))
+    return accepted[len(accepted) // 2] * 1000
+  return _run(measure)
+
+
+
+# Benchmarks of this suite, as (name, setup function) tuples for timing benchmarks
+# or (name, setup function, unit) tuples for benchmarks that return a measured value.
+benchmarks = [
+  ("%d sources: connections while refilling" % sourcecount, connection_count, "connections"),
+  ("%d sources: share upload while refilling" % sourcecount, upload_latency, "ms"),
+]
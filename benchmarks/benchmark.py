@@ -0,0 +1,187 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+
+####################
+# Benchmark runner #
+####################
+
+
+
+import os
+import sys
+import json
+import time
+import importlib
+from threading import RLock
+from timeit import default_timer
+from core.core import Core
+from core.util import Bunch
+from core.objectregistry import ObjectRegistry
+from core.workqueue import WorkQueue
+from core.blockchain import DummyBlockchain
+from core.midstate import get_backend_name
+from . import suites
+
+
+
+# Stands in for the core, just enough to create jobs and work sources without starting anything
+class BenchmarkCore(object):
+
+  version = Core.version
+
+  
+  def __init__(self):
+    self.registry = ObjectRegistry(self)
+    self.stats = Bunch(lock = RLock(), ghashes = 0)
+    self.workqueue = WorkQueue(self)
+    self.fetcher = Bunch(lock = RLock(), wakeup = lambda: None)
+    
+    
+  def get_blockchain_by_name(self, name):
+    return None
+    
+    
+  def log(self, source, message, loglevel, format = ""):
+    pass
+    
+    
+  def event(self, level, source, event, arg = None, message = None, worker = None, worksource = None, blockchain = None, job = None):
+    pass
+    
+    
+    
+class BenchmarkWorkSource(object):
+
+  
+  def __init__(self, core):
+    self.core = core
+    self.settings = Bunch(name = "Benchmark work source")
+    self.stats = Bunch(lock = RLock(), difficulty = 1, ghashes = 0, jobsaccepted = 0, jobscanceled = 0)
+    self.blockchain = DummyBlockchain(core)
+    self.shares = 0
+    
+    
+  def nonce_found(self, job, data, nonce, noncediff):
+    self.shares += 1
+    
+    
+  def add_job(self, job):
+    pass
+    
+    
+  def remove_job(self, job):
+    pass
+    
+    
+  def add_pending_mhashes(self, mhashes):
+    pass
+    
+    
+  def add_wasted_jobs(self, count, stale = False):
+    pass
+    
+    
+    
+class BenchmarkWorker(object):
+
+  
+  def __init__(self, core):
+    self.core = core
+    self.settings = Bunch(name = "Benchmark worker")
+    self.stats = Bunch(lock = RLock(), ghashes = 0, jobsaccepted = 0, jobscanceled = 0, sharesinvalid = 0)
+
+
+
+def _time(function, loops):
+  starttime = default_timer()
+  for i in range(loops): function()
+  return default_timer() - starttime
+
+
+# Returns the time that function needs per operation, where a call of function performs the given number of operations.
+# The number of calls per measurement is calibrated to take about mintime, and the best of repeat measurements is used.
+def measure(function, operations = 1, mintime = 0.2, repeat = 3):
+  loops = 1
+  while True:
+    elapsed = _time(function, loops)
+    if elapsed >= mintime / 10: break
+    loops *= 10
+  loops = max(loops, int(loops * mintime / elapsed))
+  return min(_time(function, loops) for i in range(repeat)) / loops / operations
+
+
+def get_baseline_path(suite):
+  return "config/benchmark_%s.json" % suite
+
+
+# Runs all benchmarks of a suite and compares the results against the saved baseline, which they replace if save is true.
+# Returns the number of benchmarks that got slower by more than threshold percent.
+def run_suite(suite, threshold = 10, save = False, output = sys.stdout):
+  if not suite in suites: raise Exception("Unknown benchmark suite: %s" % suite)
+  module = importlib.import_module("benchmarks." + suite)
+  path = get_baseline_path(suite)
+  baseline = None
+  try:
+    with open(path, "r") as f: baseline = json.load(f)
+  except: pass
+  environment = {"python": sys.version.split()[0], "midstate_backend": get_backend_name()}
+  output.write("Running %s benchmark suite (Python %s, %s midstate backend)\n" % (suite, environment["python"], environment["midstate_backend"]))
+  if baseline:
+    output.write("Comparing against baseline from %s\n" % time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(baseline["timestamp"])))
+    if baseline["environment"] != environment:
+      output.write("Warning: Baseline was recorded in a different environment: %s\n" % baseline["environment"])
+  results = {}
+  regressions = 0
+  for benchmark in module.benchmarks:
+    # Timing benchmarks are (name, setup) tuples, setup returns the function to be measured and its number of operations.
+    # Others are (name, setup, unit) tuples, setup does the measurement itself and returns the result (lower is better).
+    if len(benchmark) == 2:
+      name, setup = benchmark
+      function, operations = setup()
+      result = measure(function, operations)
+      line = "%-40s %12.3f us/op %14.1f op/s" % (name, result * 1000000, 1 / result)
+    else:
+      name, setup, unit = benchmark
+      result = setup()
+      if result is None:
+        output.write("%-40s %12s\n" % (name, "skipped"))
+        continue
+      line = "%-40s %12.1f %-21s" % (name, result, unit)
+    results[name] = result
+    if baseline and name in baseline["results"]:
+      change = 100. * (result / baseline["results"][name] - 1)
+      line += " %+8.1f%%" % change
+      if change > threshold:
+        line += " REGRESSION"
+        regressions += 1
+    output.write(line + "\n")
+    output.flush()
+  if regressions: output.write("%d benchmark%s got slower by more than %.1f%%\n" % (regressions, "s" if regressions != 1 else "", threshold))
+  if not save:
+    output.write("Results were not saved, use --benchmark-save to make them the new baseline\n")
+    return regressions
+  if not os.path.exists("config"): os.mkdir("config")
+  with open(path, "w") as f:
+    json.dump({"timestamp": time.time(), "environment": environment, "results": results}, f, indent = 2, sort_keys = True)
+  output.write("Results saved to %s\n" % path)
+  return regressions
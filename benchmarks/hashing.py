@@ -0,0 +1,156 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+
+####################################
+# Hashing and job pipeline benches #
+####################################
+
+
+
+import time
+import json
+import struct
+from binascii import hexlify, unhexlify
+from core import merkle
+from core.job import Job
+from core.sha256 import SHA256
+from core.util import monotonic
+from modules.theseven.bcjsonrpc.bcjsonrpcworksource import BCJSONRPCWorkSource
+from modules.theseven.stratum.stratumworksource import StratumWorkSource
+from .benchmark import BenchmarkCore, BenchmarkWorkSource, BenchmarkWorker
+
+
+
+# Block header of the validation job, with a valid nonce
+data = unhexlify(b"00000001c3bf95208a646ee98a58cf97c3a0c4b7bf5de4c89ca04495000005200000000024d1fff8d5d73ae11140e4e48032cd"
+                 b"88ee01d48c67147f9a09cd41fdec2e25824f5c038d1a0b350c5eb01f04000000800000000000000000000000000000000000"
+                 b"00000000000000000000000000000000000000000000000000000080020000")
+target = b"\xff" * 28 + b"\0" * 4
+
+
+
+def _make_job():
+  core = BenchmarkCore()
+  job = Job(core, BenchmarkWorkSource(core), monotonic() + 60, data, target)
+  job.worker = BenchmarkWorker(core)
+  return job
+
+
+def sha256_hash():
+  return lambda: SHA256.hash(data), 1
+
+
+def calculate_midstate():
+  return lambda: Job.calculate_midstate(data), 1
+
+
+def calculate_hash():
+  return lambda: Job.calculate_hash(data), 1
+
+
+def nonce_found():
+  job = _make_job()
+  nonce = data[76:80]
+  return lambda: job.nonce_found(nonce), 1
+
+
+def nonce_found_invalid():
+  job = _make_job()
+  nonce = b"\0\0\0\0"
+  return lambda: job.nonce_found(nonce), 1
+
+
+class _Response(object):
+
+  
+  def __init__(self, headers):
+    self.headers = headers
+    
+    
+  def getheaders(self):
+    return self.headers
+
+
+def build_jobs_rollntime():
+  core = BenchmarkCore()
+  worksource = BCJSONRPCWorkSource(core)
+  response = _Response([("X-Roll-NTime", "expire=60")])
+  body = json.dumps({"result": {"data": hexlify(data).decode("ascii"), "target": hexlify(target).decode("ascii")}}).encode("utf_8")
+  jobcount = sum(job.jobcount for job in worksource._build_jobs(response, body, worksource.jobepoch, monotonic(), "benchmark"))
+  if jobcount != 60: raise Exception("Expected 60 jobs, got %d" % jobcount)
+  return lambda: worksource._build_jobs(response, body, worksource.jobepoch, monotonic(), "benchmark"), jobcount
+
+
+def stratum_generator():
+  core = BenchmarkCore()
+  worksource = StratumWorkSource(core)
+  core.workqueue.target = worksource.settings.jobbatchsize
+  # Build every batch on the spot instead of taking it from the background generator's ring
+  worksource.settings.jobringsize = 0
+  worksource._push_jobs = lambda jobs, source = None: len(jobs)
+  worksource.shutdown = False
+  coinb1 = unhexlify(b"01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff20020862062f503253482f04b8864e5008")
+  extranonce1 = unhexlify(b"08000002")
+  worksource.data = {
+    "job_id": "1",
+    "prevhash": data[4:36],
+    "coinbaseprefix": coinb1 + extranonce1,
+    "coinb2": unhexlify(b"072f736c7573682f000000000100f2052a010000001976a914d23fcdf86f7e756a64a7a9688ef9903327048ed988ac00000000"),
+    "merkle_branch": [data[36:68]] * 8,
+    "versions": [(data[:4], None)],
+    "nbits": data[72:76],
+    "ntime": struct.unpack(">I", data[68:72])[0] - int(time.time()),
+    "extranonce2len": 4,
+    "extranonce2": 0,
+    "difficulty": 1,
+    "target": target,
+    "session": 0,
+  }
+  result, count = worksource._start_fetcher()
+  return worksource._start_fetcher, count
+
+
+
+# Same setup as the merkle builder selection, batches of 1024 jobs with 12 merkle branch levels
+def _merkle_roots(builderclass):
+  def setup():
+    builder = builderclass()
+    prefix, suffix, branches, extranonce2s = merkle._test_data(merkle.benchmark_batch_size)
+    return lambda: builder.merkle_roots(prefix, suffix, branches, extranonce2s), len(extranonce2s)
+  return setup
+
+
+
+# Benchmarks of this suite, as (name, setup function) tuples.
+# The setup function returns a function to be timed and the number of operations that it performs.
+benchmarks = [
+  ("SHA256.hash", sha256_hash),
+  ("Job.calculate_midstate", calculate_midstate),
+  ("Job.calculate_hash", calculate_hash),
+  ("Job.nonce_found", nonce_found),
+  ("Job.nonce_found (H != 0)", nonce_found_invalid),
+  ("BCJSONRPC._build_jobs (roll-ntime 60)", build_jobs_rollntime),
+  ("Stratum job generator", stratum_generator),
+  ("merkle roots, hashlib", _merkle_roots(merkle.HashlibMerkleBuilder)),
+]
+if merkle.numpy: benchmarks.append(("merkle roots, numpy", _merkle_roots(merkle.NumPyMerkleBuilder)))
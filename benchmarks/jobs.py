@@ -0,0 +1,191 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+
+
+##################
+# Job allocation #
+##################
+
+
+
+import gc
+import struct
+import time
+from threading import Condition
+from core.job import Job, ValidationJob
+from core.util import Bunch, monotonic
+from .benchmark import BenchmarkCore, BenchmarkWorkSource, BenchmarkWorker
+from .hashing import data, target
+try: import tracemalloc
+except ImportError: tracemalloc = None
+
+
+
+# Number of jobs that are queued when measuring memory usage
+queuesize = 10000
+batchsize = 100
+
+
+
+def _make_worksource():
+  core = BenchmarkCore()
+  worksource = BenchmarkWorkSource(core)
+  worksource.blockchain.check_job = lambda job: True
+  return core, worksource
+
+
+# Memory held by the queued jobs, excluding their data (which is allocated before measuring, like the work source would)
+def queued_job_memory():
+  if not tracemalloc: return None
+  core, worksource = _make_worksource()
+  midstate = Job.calculate_midstate(data)
+  datas = [data[:68] + struct.pack("<I", i) + data[72:] for i in range(queuesize)]
+  expiry = monotonic() + 60
+  gc.collect()
+  tracemalloc.start()
+  try:
+    before = tracemalloc.get_traced_memory()[0]
+    core.workqueue.add_jobs([Job(core, worksource, expiry, d, target, midstate) for d in datas])
+    after = tracemalloc.get_traced_memory()[0]
+  finally: tracemalloc.stop()
+  return (after - before) / float(queuesize)
+
+
+# Full life cycle of a job that is handed to a worker and finished
+def job_lifecycle():
+  core, worksource = _make_worksource()
+  midstate = Job.calculate_midstate(data)
+  def run():
+    expiry = monotonic() + 60
+    for i in range(batchsize):
+      job = Job(core, worksource, expiry, data, target, midstate)
+      job.register()
+      job.destroy()
+  return run, batchsize
+
+
+# Just what the block chain needs to track and drop a job
+class TrackedJob(object):
+
+  jobcount = 1
+
+  
+  def __init__(self, blockchain, worksource):
+    self.blockchain = blockchain
+    self.worksource = worksource
+    self.worker = None
+    self.ranges = ()
+    
+    
+  def destroy(self):
+    self.blockchain.remove_job(self)
+    
+    
+
+# Registering and destroying jobs while many others are tracked by the block chain
+def job_tracking():
+  core, worksource = _make_worksource()
+  blockchain = worksource.blockchain
+  for i in range(queuesize): blockchain.add_job(TrackedJob(blockchain, worksource))
+  jobs = [TrackedJob(blockchain, worksource) for i in range(batchsize)]
+  def run():
+    for job in jobs: blockchain.add_job(job)
+    for job in jobs: job.destroy()
+  return run, batchsize
+
+
+# Dropping all tracked jobs when a new block is detected, per job
+def block_change():
+  worksource = BenchmarkWorkSource(BenchmarkCore())
+  blockchain = worksource.blockchain
+  jobs = [TrackedJob(blockchain, worksource) for i in range(queuesize)]
+  counter = [0]
+  def run():
+    for job in jobs: blockchain.add_job(job)
+    counter[0] += 1
+    blockchain.check_job(Bunch(prevhash = struct.pack("<I", counter[0])))
+  return run, queuesize
+
+
+# A worker that records the jobs it was told to stop working on
+class LeaseWorker(BenchmarkWorker):
+
+  def __init__(self, core, condition, delay = 0):
+    super(LeaseWorker, self).__init__(core)
+    self.condition = condition
+    self.delay = delay
+    self.canceled = []
+    
+    
+  def notify_canceled(self, job, graceful):
+    # Stands for a device that needs a while to acknowledge the cancellation
+    if self.delay: time.sleep(self.delay)
+    with self.condition:
+      self.canceled.append(job)
+      self.condition.notify()
+
+
+# Leases all nonces of a job in ranges to several workers, one of which is slow to cancel, and announces
+# a new block. Checks that the worker of every range was told to stop and returns the time until the
+# last one of the others was notified, which must not have to wait for the slow one.
+def block_change_leased():
+  core = BenchmarkCore()
+  queue = core.workqueue
+  queue.start()
+  try:
+    worksource = BenchmarkWorkSource(core)
+    queue.add_job(Job(core, worksource, monotonic() + 60, data, target))
+    condition = Condition()
+    workers = [LeaseWorker(core, condition, 1 if i == 0 else 0) for i in range(16)]
+    ranges = [queue.get_job(worker, 0, True, 2**28) for worker in workers]
+    if None in ranges: raise Exception("Could not lease 16 nonce ranges of one job")
+    with condition:
+      starttime = monotonic()
+      worksource.blockchain.check_job(Bunch(prevhash = b"\1" * 32))
+      endtime = starttime + 10
+      while any(not worker.canceled for worker in workers[1:]) and monotonic() < endtime: condition.wait(endtime - monotonic())
+      elapsed = monotonic() - starttime
+      while not workers[0].canceled and monotonic() < endtime: condition.wait(endtime - monotonic())
+    for worker, lease in zip(workers, ranges):
+      if worker.canceled != [lease]: raise Exception("Worker of nonces %08x-%08x was not notified of the new block" % (lease.start, lease.end - 1))
+    return elapsed * 1000
+  finally: queue.stop()
+
+
+def validation_job():
+  core = BenchmarkCore()
+  midstate = Job.calculate_midstate(data)
+  return lambda: ValidationJob(core, data, midstate), 1
+
+
+
+# Benchmarks of this suite, as (name, setup function) tuples for timing benchmarks
+# or (name, setup function, unit) tuples for benchmarks that return a measured value.
+benchmarks = [
+  ("memory per queued job", queued_job_memory, "bytes"),
+  ("Job create + register + destroy", job_lifecycle),
+  ("ValidationJob create", validation_job),
+  ("add_job + destroy (10k tracked)", job_tracking),
+  ("new block (10k tracked jobs)", block_change),
+  ("new block, 16 leased nonce ranges, 1 slow", block_change_leased, "ms"),
+]
@@ -0,0 +1,480 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+
+###################
+# Stratum clients #
+###################
+
+
+
+import json
+import time
+import struct
+import select
+import socket
+import threading
+from binascii import unhexlify
+from hashlib import sha256
+from threading import Thread, RLock, Condition
+from timeit import default_timer
+try: from time import process_time
+except ImportError: from time import clock as process_time
+from core.util import Bunch
+from modules.theseven.stratum.stratumengine import engine
+from modules.theseven.stratum.stratumworksource import StratumWorkSource
+from .benchmark import BenchmarkCore
+
+
+
+# Number of Stratum work sources that are connected to the stand-in server at once
+sourcecount = 50
+notifies = 20
+submits = 1000
+# Notifications that are sent at once by flood tests
+floodsize = 1000
+# Jobs per _start_fetcher call
+batchsize = 32
+
+
+
+def make_notify(jobid, clean = True):
+  return {"id": None, "method": "mining.notify", "params": [
+    "%x" % jobid,
+    "%064x" % jobid,
+    "01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff20020862062f503253482f04b8864e5008",
+    "072f736c7573682f000000000100f2052a010000001976a914d23fcdf86f7e756a64a7a9688ef9903327048ed988ac00000000",
+    ["%064x" % i for i in range(12)],
+    "00000002",
+    "1c2ac4af",
+    "%08x" % int(time.time()),
+    clean,
+  ]}
+
+
+
+def _double_sha256(data):
+  return sha256(sha256(data).digest()).digest()
+
+
+
+# A minimal Stratum pool on localhost that accepts every worker and share, running in its own thread.
+# Sends job generation data to every client right after it subscribed and whenever notify is called.
+# Supports version rolling. The block headers of submitted shares are rebuilt like a real pool would
+# do it (but not checked against the target) and collected in headers.
+class StandInStratumServer(object):
+
+  # Version bits that clients may roll
+  versionmask = 0x1fffe000
+
+  def __init__(self, port = 0):
+    self.lock = RLock()
+    self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.listener.bind(("127.0.0.1", port))
+    self.listener.listen(128)
+    self.port = self.listener.getsockname()[1]
+    self.clients = {}
+    self.subscribed = set()
+    self.extranonce1s = {}
+    self.versionmasks = {}
+    self.jobs = {}
+    self.headers = []
+    self.shutdown = False
+    self.jobid = 0
+    self.shares = 0
+    self.floodpayload = None
+    self.thread = Thread(None, self._loop, "stratum_server")
+    self.thread.daemon = True
+    self.thread.start()
+
+
+  def close(self):
+    self.shutdown = True
+    self.thread.join(1)
+    for sock in list(self.clients) + [self.listener]: sock.close()
+
+
+  def _send(self, sock, msg):
+    try: sock.sendall((json.dumps(msg) + "\n").encode("utf_8"))
+    except socket.error: self._drop(sock)
+
+
+  def _drop(self, sock):
+    with self.lock:
+      self.clients.pop(sock, None)
+      self.subscribed.discard(sock)
+    sock.close()
+
+
+  def _make_notify(self, clean):
+    msg = make_notify(self.jobid, clean)
+    self.jobs[msg["params"][0]] = msg["params"]
+    return msg
+
+
+  # Sends new job generation data to all subscribed clients
+  def notify(self, clean = True):
+    with self.lock:
+      self.jobid += 1
+      msg = self._make_notify(clean)
+      for sock in list(self.subscribed): self._send(sock, msg)
+    return "%x" % self.jobid
+
+
+  # Sends floodsize mining.notify messages (that don't flush old jobs) to all subscribed clients in one go.
+  # The messages are only encoded once, so that the clients' processing dominates the time needed.
+  def flood(self):
+    with self.lock:
+      if not self.floodpayload:
+        msgs = []
+        for i in range(floodsize):
+          self.jobid += 1
+          msgs.append(json.dumps(self._make_notify(False)) + "\n")
+        self.floodpayload = "".join(msgs).encode("utf_8")
+      for sock in list(self.subscribed): sock.sendall(self.floodpayload)
+
+
+  # Returns the block header of a share in getwork byte order, or raises an exception if it is invalid
+  def _build_header(self, sock, params):
+    job = self.jobs[params[1]]
+    merkle = _double_sha256(unhexlify((job[2] + self.extranonce1s[sock] + params[2] + job[3]).encode("ascii")))
+    for branch in job[4]: merkle = _double_sha256(merkle + unhexlify(branch.encode("ascii")))
+    version = int(job[5], 16)
+    if len(params) > 5:
+      mask = self.versionmasks.get(sock, 0)
+      versionbits = int(params[5], 16)
+      if versionbits & ~mask: raise Exception("Version bits outside of the mask")
+      version = (version & ~mask) | versionbits
+    return struct.pack(">I", version) + unhexlify(job[1].encode("ascii")) + struct.pack("<8I", *struct.unpack(">8I", merkle)) \
+         + unhexlify((params[3] + job[6] + params[4]).encode("ascii"))
+
+
+  def _handle(self, sock, msg):
+    method = msg.get("method")
+    if method == "mining.configure":
+      mask = int(msg["params"][1]["version-rolling.mask"], 16) & self.versionmask
+      self.versionmasks[sock] = mask
+      self._send(sock, {"id": msg["id"], "result": {"version-rolling": True, "version-rolling.mask": "%08x" % mask}, "error": None})
+    elif method == "mining.subscribe":
+      extranonce1 = "%08x" % sock.fileno()
+      self.extranonce1s[sock] = extranonce1
+      self._send(sock, {"id": msg["id"], "result": [[["mining.notify", extranonce1]], extranonce1, 4], "error": None})
+      with self.lock:
+        self.subscribed.add(sock)
+        self._send(sock, self._make_notify(True))
+    elif method == "mining.submit":
+      try: header = self._build_header(sock, msg["params"])
+      except Exception as e:
+        self._send(sock, {"id": msg["id"], "result": None, "error": [20, str(e), None]})
+        return
+      with self.lock:
+        self.shares += 1
+        self.headers.append(header)
+      self._send(sock, {"id": msg["id"], "result": True, "error": None})
+    else: self._send(sock, {"id": msg["id"], "result": True, "error": None})
+
+
+  def _loop(self):
+    while not self.shutdown:
+      with self.lock: readers = [self.listener] + list(self.clients)
+      readable, writable, failed = select.select(readers, [], [], 0.1)
+      for sock in readable:
+        if sock is self.listener:
+          client, address = self.listener.accept()
+          with self.lock: self.clients[client] = b""
+          continue
+        try: data = sock.recv(65536)
+        except socket.error: data = b""
+        if not data:
+          self._drop(sock)
+          continue
+        lines = (self.clients[sock] + data).split(b"\n")
+        self.clients[sock] = lines.pop()
+        for line in lines: self._handle(sock, json.loads(line.decode("utf_8")))
+
+
+
+# Starts count Stratum work sources connected to server, which call jobreceived(source, job_id) for every mining.notify
+def _start_sources(server, count, jobreceived):
+  core = BenchmarkCore()
+  sources = []
+  for i in range(count):
+    source = StratumWorkSource(core)
+    source.settings.host = "127.0.0.1"
+    source.settings.port = server.port
+    source.blockchain.check_job = lambda job, source = source: jobreceived(source, source.data["job_id"])
+    sources.append(source)
+  for source in sources: source.start()
+  return sources
+
+
+def _stop_sources(sources):
+  for source in sources: source.stop()
+
+
+def _run(measure):
+  server = StandInStratumServer()
+  condition = Condition()
+  # Every client that subscribes gets the current job id, which is 0 until the first notify
+  state = Bunch(jobid = "0", received = set())
+  def jobreceived(source, jobid):
+    with condition:
+      if jobid != state.jobid: return
+      state.received.add(source)
+      if len(state.received) == sourcecount: condition.notify()
+  try:
+    with condition:
+      starttime = default_timer()
+      sources = _start_sources(server, sourcecount, jobreceived)
+      endtime = starttime + 10
+      while len(state.received) < sourcecount and default_timer() < endtime: condition.wait(endtime - default_timer())
+      if len(state.received) < sourcecount: raise Exception("Only %d of %d sources connected" % (len(state.received), sourcecount))
+      connecttime = default_timer() - starttime
+    # All threads except this one and the server's
+    try: return measure(server, condition, state, connecttime, threading.active_count() - 2)
+    finally: _stop_sources(sources)
+  finally: server.close()
+
+
+# Time from starting all sources until every one of them got its first job
+def connect_time():
+  return _run(lambda server, condition, state, connecttime, threads: connecttime * 1000)
+
+
+# Threads that the running sources need in addition to the server
+def thread_count():
+  return _run(lambda server, condition, state, connecttime, threads: threads)
+
+
+# Time from the server sending a mining.notify to all sources until all of them processed it (median)
+def notify_fanout():
+  def measure(server, condition, state, connecttime, threads):
+    results = []
+    for i in range(notifies):
+      with condition:
+        state.received = set()
+        starttime = default_timer()
+        with server.lock:
+          state.jobid = "%x" % (server.jobid + 1)
+          server.notify()
+        endtime = starttime + 10
+        while len(state.received) < sourcecount and default_timer() < endtime: condition.wait(endtime - default_timer())
+        results.append(default_timer() - starttime)
+    return sorted(results)[len(results) // 2] * 1000
+  return _run(measure)
+
+
+
+# Just what the Stratum work source needs to submit a share
+class SubmitJob(object):
+
+  def __init__(self, source, condition, results, job = None):
+    self.source = source
+    self.condition = condition
+    self.results = results
+    self.job = job
+    self.prevhash = source.data["prevhash"]
+    
+    
+  def get_ext(self, name):
+    if self.job: return self.job.get_ext(name)
+    return (self.source.data["job_id"], "00000000", "00000000", self.source.session, self.source.data["extranonce1"], None)
+    
+    
+  def nonce_handled_callback(self, nonce, noncediff, result):
+    with self.condition:
+      self.results.append(result)
+      self.condition.notify()
+
+
+# Time per share when a burst of shares is submitted, with up to submitwindow shares in flight
+def submit_burst():
+  def measure(server, condition, state, connecttime, threads):
+    source = state.received.pop()
+    results = []
+    job = SubmitJob(source, condition, results)
+    nonce = b"\0\0\0\0"
+    with condition:
+      starttime = default_timer()
+      for i in range(submits): source.nonce_found(job, None, nonce, 1)
+      endtime = starttime + 10
+      while len(results) < submits and default_timer() < endtime: condition.wait(endtime - default_timer())
+      elapsed = default_timer() - starttime
+    if results.count(True) != submits: raise Exception("Only %d of %d shares were accepted" % (results.count(True), submits))
+    return elapsed * 1000000 / submits
+  return _run(measure)
+
+
+# Connects a work source with version rolling to the stand-in server and checks that all of its jobs
+# are accepted and have the block headers that the server rebuilds. Then times the job generation.
+def build_jobs_version_rolling():
+  server = StandInStratumServer()
+  condition = Condition()
+  try:
+    core = BenchmarkCore()
+    core.workqueue.target = batchsize
+    source = StratumWorkSource(core)
+    source.settings.host = "127.0.0.1"
+    source.settings.port = server.port
+    source.settings.jobringsize = 0
+    source.settings.versionrolling = 16
+    source.blockchain.check_job = lambda job: None
+    jobs = []
+    source._push_jobs = lambda newjobs, name: jobs.extend(newjobs)
+    source.start()
+    endtime = default_timer() + 10
+    while not (source.data and source.versionmask) and default_timer() < endtime: time.sleep(0.01)
+    source._start_fetcher()
+    results = []
+    with condition:
+      for job in jobs: source.nonce_found(SubmitJob(source, condition, results, job), None, job.data[76:80], 1)
+      while len(results) < len(jobs) and default_timer() < endtime: condition.wait(endtime - default_timer())
+    data = source.data
+    source.stop()
+    if len(set(job.data[:4] for job in jobs)) != 16: raise Exception("Expected 16 block versions, got %d" % len(set(job.data[:4] for job in jobs)))
+    if results.count(True) != len(jobs): raise Exception("Only %d of %d shares were accepted: %s" % (results.count(True), len(jobs), results))
+    if sorted(server.headers) != sorted(job.data[:80] for job in jobs): raise Exception("The pool rebuilt different block headers")
+  finally: server.close()
+  roots = source._get_merkle_root_count(data, batchsize)
+  return lambda: source._build_jobs(data, 0, roots), roots * len(data["versions"])
+
+
+# Connects a client to the stand-in server and returns a function that floods it with notifications and
+# waits until received(client) was called for all of them, where client is what connect(server, received) returned
+def _flood(connect):
+  server = StandInStratumServer()
+  condition = Condition()
+  state = Bunch(received = 0)
+  def received(*args):
+    with condition:
+      state.received += 1
+      condition.notify()
+  # Wait for the response to mining.subscribe and the first mining.notify
+  with condition:
+    client = connect(server, received)
+    endtime = default_timer() + 10
+    while state.received < 1 and default_timer() < endtime: condition.wait(endtime - default_timer())
+  def run():
+    with condition:
+      target = state.received + floodsize
+      server.flood()
+      endtime = default_timer() + 10
+      while state.received < target and default_timer() < endtime: condition.wait(endtime - default_timer())
+      if state.received < target: raise Exception("Only %d of %d notifications were received" % (floodsize - target + state.received, floodsize))
+  return run, client, server
+
+
+# Just the line framing of the engine's connections
+def _connect_raw(server, received):
+  def connected(): conn.send(json.dumps({"id": 1, "method": "mining.subscribe", "params": []}))
+  def line_received(line):
+    if '"mining.notify"' in line: received()
+  conn = engine.connect("127.0.0.1", server.port, 10, connected, line_received, lambda reason: None)
+  return conn
+
+
+# A work source that does not prebuild jobs, so that all of its time is spent in receiving notifications
+def _connect_source(server, received):
+  source = StratumWorkSource(BenchmarkCore())
+  source.settings.host = "127.0.0.1"
+  source.settings.port = server.port
+  source.settings.jobringsize = 0
+  source.blockchain.check_job = received
+  source.start()
+  return source
+
+
+def flood_raw():
+  run, conn, server = _flood(_connect_raw)
+  return run, floodsize
+
+
+def flood_source():
+  run, source, server = _flood(_connect_source)
+  return run, floodsize
+
+
+# CPU time of the whole process (the server just sends a prebuilt buffer) per notification received by a work source
+def flood_source_cpu():
+  run, source, server = _flood(_connect_source)
+  try:
+    starttime = process_time()
+    for i in range(10): run()
+    return (process_time() - starttime) * 1000000 / (10 * floodsize)
+  finally:
+    source.stop()
+    server.close()
+
+
+# A work source that got job generation data, but is not connected to anything
+def _make_source(ringsize):
+  core = BenchmarkCore()
+  core.workqueue.target = batchsize
+  source = StratumWorkSource(core)
+  source.settings.jobringsize = ringsize
+  source.shutdown = False
+  source.extranonce1 = b"\0\0\0\1"
+  source.extranonce2len = 4
+  source._push_jobs = lambda jobs, name: len(jobs)
+  source._handle_line(json.dumps(make_notify(1)))
+  return source
+
+
+# Fetching jobs when the generator could not keep up, so that they are built on the spot
+def fetch_jobs_unbuffered():
+  source = _make_source(0)
+  return source._start_fetcher, batchsize
+
+
+# Fetching jobs that the generator already built
+def fetch_jobs_from_ring():
+  source = _make_source(0)
+  prebuilt = source._build_jobs(source.data, 0, batchsize)
+  def run():
+    source.ring.extend(prebuilt)
+    source._start_fetcher()
+  return run, batchsize
+
+
+# Building jobs in the generator (12 merkle branch levels)
+def build_jobs():
+  source = _make_source(0)
+  return lambda: source._build_jobs(source.data, 0, batchsize), batchsize
+
+
+
+# Benchmarks of this suite, as (name, setup function) tuples for timing benchmarks
+# or (name, setup function, unit) tuples for benchmarks that return a measured value.
+benchmarks = [
+  ("%d sources: connect until first job" % sourcecount, connect_time, "ms"),
+  ("%d sources: threads" % sourcecount, thread_count, "threads"),
+  ("%d sources: mining.notify fan-out" % sourcecount, notify_fanout, "ms"),
+  ("mining.submit burst, per share", submit_burst, "us"),
+  ("mining.notify flood, line framing", flood_raw),
+  ("mining.notify flood, work source", flood_source),
+  ("mining.notify flood, CPU per message", flood_source_cpu, "us"),
+  ("job generation", build_jobs),
+  ("job generation, 16 versions per root", build_jobs_version_rolling),
+  ("_start_fetcher, jobs built on the spot", fetch_jobs_unbuffered),
+  ("_start_fetcher, jobs from the ring", fetch_jobs_from_ring),
+]
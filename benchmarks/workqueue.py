@@ -0,0 +1,130 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+
+####################
+# Work queue bench #
+####################
+
+
+
+import random
+from core.job import Job, JobTemplate
+from core.util import monotonic
+from .benchmark import BenchmarkCore, BenchmarkWorkSource, BenchmarkWorker
+from .hashing import data, target
+
+
+
+# Number of jobs that are kept in the queue while measuring
+queuesize = 10000
+batchsize = 100
+
+
+
+# Just what the work queue needs, so that only the queue itself is measured
+class QueueJob(object):
+
+  jobcount = 1
+
+  
+  def __init__(self, blockchain, expiry):
+    self.blockchain = blockchain
+    self.expiry = expiry
+    self.canceled = False
+    
+    
+  def register(self):
+    pass
+    
+    
+  def set_worker(self, worker):
+    pass
+
+
+    
+class _AnyBlockchain(object):
+
+  
+  def check_job(self, job):
+    return True
+    
+
+
+# Jobs expire within spread seconds, a small spread means few large expiry buckets (like a burst of Stratum jobs)
+def _make_queue(spread):
+  core = BenchmarkCore()
+  queue = core.workqueue
+  blockchain = _AnyBlockchain()
+  now = monotonic()
+  rng = random.Random(0)
+  make = lambda: QueueJob(blockchain, now + 20 + rng.uniform(0, spread))
+  queue.add_jobs([make() for i in range(queuesize)])
+  return queue, make
+
+
+def add_jobs(spread):
+  def setup():
+    queue, make = _make_queue(spread)
+    jobs = [make() for i in range(batchsize)]
+    def run():
+      queue.add_jobs(jobs)
+      for job in jobs: queue.remove_job(job)
+    return run, batchsize
+  return setup
+
+
+def get_job(spread):
+  def setup():
+    queue, make = _make_queue(spread)
+    def run():
+      jobs = [queue.get_job(None, 10 + spread / 2.) for i in range(batchsize)]
+      for job in jobs: queue.remove_job(job)
+      queue.add_jobs(jobs)
+    return run, batchsize
+  return setup
+
+
+
+# Hands out all jobs of a roll-ntime template, which creates them on the fly
+def get_job_template():
+  core = BenchmarkCore()
+  queue = core.workqueue
+  worksource = BenchmarkWorkSource(core)
+  worker = BenchmarkWorker(core)
+  midstate = Job.calculate_midstate(data)
+  def run():
+    queue.add_jobs([JobTemplate(core, worksource, monotonic() + 60, data, target, midstate, None, batchsize)])
+    for i in range(batchsize): queue.get_job(worker, 30).destroy()
+  return run, batchsize
+
+
+
+# Benchmarks of this suite, as (name, setup function) tuples.
+# The setup function returns a function to be timed and the number of operations that it performs.
+benchmarks = [
+  ("add_jobs + remove_job (10k queued, 100s)", add_jobs(100)),
+  ("get_job + requeue (10k queued, 100s)", get_job(100)),
+  ("add_jobs + remove_job (10k queued, 2s)", add_jobs(2)),
+  ("get_job + requeue (10k queued, 2s)", get_job(2)),
+  ("get_job from roll-ntime template", get_job_template),
+]
@@ -32,6 +32,7 @@ from binascii import hexlify
 from threading import RLock, Thread
 from .baseworksource import BaseWorkSource
 from .blockchain import DummyBlockchain
+from .util import monotonic
 
 
 
@@ -61,6 +62,7 @@ class ActualWorkSource(BaseWorkSource):
     self.lockoutend = 0
     self.estimated_jobs = 1
     self.estimated_expiry = 60
+    self.fetch_latency = None
     
       
   def _stop(self):
@@ -76,6 +78,7 @@ class ActualWorkSource(BaseWorkSource):
     stats.consecutive_errors = self.errors
     stats.jobs_per_request = self.estimated_jobs
     stats.job_expiry = self.estimated_expiry
+    stats.fetch_latency = self.fetch_latency
     stats.blockchain = self.blockchain
     stats.blockchain_id = self.blockchain.id
     stats.blockchain_name = "None" if isinstance(self.blockchain, DummyBlockchain) else self.blockchain.settings.name
@@ -126,9 +129,9 @@ class ActualWorkSource(BaseWorkSource):
     with self.statelock:
       self.errors = 0
       if jobs:
-        jobcount = len(jobs)
+        jobcount = sum(job.jobcount for job in jobs)
         self.estimated_jobs = jobcount
-        self.estimated_expiry = int(jobs[0].expiry - time.time())
+        self.estimated_expiry = int(jobs[0].expiry - monotonic())
         with self.stats.lock: self.stats.jobsreceived += jobcount
 
     
@@ -141,6 +144,25 @@ class ActualWorkSource(BaseWorkSource):
     with self.stats.lock:
       if upload: self.stats.uploadretries += 1
       else: self.stats.failedjobreqs += 1
+    # The fetcher might be waiting for the jobs that this request was supposed to deliver
+    if not upload: self.core.fetcher.wakeup()
+    
+    
+  # Records how long it took to fetch a batch of jobs (moving average)
+  def _handle_fetch_latency(self, latency):
+    with self.statelock:
+      if self.fetch_latency is None: self.fetch_latency = latency
+      else: self.fetch_latency += (latency - self.fetch_latency) * 0.25
+      
+      
+  def get_fetch_latency(self):
+    if not self.started or self.fetch_latency is None: return None
+    return self.fetch_latency
+    
+    
+  def get_job_expiry(self):
+    if not self.started: return None
+    return self.estimated_expiry
 
     
   def _handle_stale(self):
@@ -153,6 +175,7 @@ class ActualWorkSource(BaseWorkSource):
     if jobs:
       accepted = self.core.workqueue.add_jobs(jobs, self, source)
       if accepted != len(jobs): self._handle_stale()
+      self.core.fetcher.wakeup()
       return accepted
     else: return 0
       
@@ -28,7 +28,7 @@
 
 import time
 from threading import RLock
-from .util import Bunch
+from .util import Bunch, OrderedSet
 from .statistics import StatisticsProvider
 from .startable import Startable
 from .inflatable import Inflatable
@@ -82,10 +82,13 @@ class BaseWorkSource(StatisticsProvider, Startable, Inflatable):
     self.stats.jobsreceived = 0
     self.stats.jobsaccepted = 0
     self.stats.jobscanceled = 0
+    # Jobs that were destroyed without ever being handed to a worker
+    self.stats.jobsexpired = 0
+    self.stats.jobsstale = 0
     self.stats.sharesaccepted = 0
     self.stats.sharesrejected = 0
     self.stats.difficulty = 0
-    self.jobs = []
+    self.jobs = OrderedSet()
     
     
   def _get_statistics(self, stats, childstats):
@@ -99,6 +102,8 @@ class BaseWorkSource(StatisticsProvider, Startable, Inflatable):
     stats.jobsreceived = self.stats.jobsreceived + childstats.calculatefieldsum("jobsreceived")
     stats.jobsaccepted = self.stats.jobsaccepted + childstats.calculatefieldsum("jobsaccepted")
     stats.jobscanceled = self.stats.jobscanceled + childstats.calculatefieldsum("jobscanceled")
+    stats.jobsexpired = self.stats.jobsexpired + childstats.calculatefieldsum("jobsexpired")
+    stats.jobsstale = self.stats.jobsstale + childstats.calculatefieldsum("jobsstale")
     stats.sharesaccepted = self.stats.sharesaccepted + childstats.calculatefieldsum("sharesaccepted")
     stats.sharesrejected = self.stats.sharesrejected + childstats.calculatefieldsum("sharesrejected")
     stats.difficulty = self.stats.difficulty
@@ -113,21 +118,38 @@ class BaseWorkSource(StatisticsProvider, Startable, Inflatable):
 
     
   def add_job(self, job):
-    if not job in self.jobs: self.jobs.append(job)
+    self.jobs.add(job)
   
 
   def remove_job(self, job):
-    while job in self.jobs: self.jobs.remove(job)
+    self.jobs.discard(job)
+    
+    
+  # Accounts for jobs that were thrown away unused, either because they expired or because they became stale
+  def add_wasted_jobs(self, count, stale = False):
+    with self.stats.lock:
+      if stale: self.stats.jobsstale += count
+      else: self.stats.jobsexpired += count
+      
+      
+  # Returns the average time that it takes to get new jobs from this work source (None if unknown)
+  def get_fetch_latency(self):
+    return None
+    
+    
+  # Returns the number of seconds for which jobs from this work source are valid (None if unknown)
+  def get_job_expiry(self):
+    return None
 
 
   def _cancel_jobs(self, graceful = False):
     cancel = []
     with self.core.workqueue.lock:
-      while self.jobs:
-        job = self.jobs.pop(0)
-        if job.worker: cancel.append(job)
-        else: job.destroy()
-    if not graceful: self.jobs = []
+      for job in self.jobs.drain():
+        if job.worker or job.ranges: cancel.append(job)
+        else:
+          self.add_wasted_jobs(job.jobcount, True)
+          job.destroy()
     self.core.workqueue.cancel_jobs(cancel, graceful)
   
 
@@ -28,7 +28,7 @@
 
 import time
 from threading import RLock
-from .util import Bunch
+from .util import Bunch, OrderedSet
 from .statistics import StatisticsProvider, StatisticsList
 from .startable import Startable
 from .inflatable import Inflatable
@@ -82,10 +82,16 @@ class Blockchain(StatisticsProvider, Startable, Inflatable):
     self.currentprevhash = None
     self.knownprevhashes = []
     self.timeoutend = 0
-    self.jobs = []
+    self.jobs = OrderedSet()
+    # Bumped on every new block, jobs that were registered with an older generation are stale
+    self.generation = 0
     self.stats.starttime = time.time()
     self.stats.blocks = 0
     self.stats.lastblock = None
+    # Time from detecting a new block until all affected workers were notified
+    self.stats.switchtime = None
+    self.stats.maxswitchtime = 0
+    self.stats.totalswitchtime = 0
 
     
   def _get_statistics(self, stats, childstats):
@@ -93,6 +99,9 @@ class Blockchain(StatisticsProvider, Startable, Inflatable):
     stats.starttime = self.stats.starttime
     stats.blocks = self.stats.blocks
     stats.lastblock = self.stats.lastblock
+    stats.switchtime = self.stats.switchtime
+    stats.maxswitchtime = self.stats.maxswitchtime
+    stats.avgswitchtime = self.stats.totalswitchtime / self.stats.blocks if self.stats.blocks else None
     stats.ghashes = childstats.calculatefieldsum("ghashes")
     stats.avgmhps = childstats.calculatefieldsum("avgmhps")
     stats.jobsreceived = childstats.calculatefieldsum("jobsreceived")
@@ -104,11 +113,11 @@ class Blockchain(StatisticsProvider, Startable, Inflatable):
     
     
   def add_job(self, job):
-    if not job in self.jobs: self.jobs.append(job)
+    self.jobs.add(job)
   
 
   def remove_job(self, job):
-    while job in self.jobs: self.jobs.remove(job)
+    self.jobs.discard(job)
 
 
   def add_work_source(self, worksource):
@@ -121,6 +130,14 @@ class Blockchain(StatisticsProvider, Startable, Inflatable):
       while worksource in self.children: self.children.remove(worksource)
 
 
+  def _switched(self, latency):
+    with self.stats.lock:
+      self.stats.switchtime = latency
+      self.stats.maxswitchtime = max(self.stats.maxswitchtime, latency)
+      self.stats.totalswitchtime += latency
+    self.core.log(self, "All workers were switched to the new block after %.1fms\n" % (latency * 1000), 500)
+
+
   def check_job(self, job):
     if self.currentprevhash == job.prevhash: return True
     cancel = []
@@ -134,16 +151,18 @@ class Blockchain(StatisticsProvider, Startable, Inflatable):
         if timeout_expired: self.knownprevhashes = [self.currentprevhash]
         else: self.knownprevhashes.append(self.currentprevhash)
         self.currentprevhash = job.prevhash
-        while self.jobs:
-          job = self.jobs.pop(0)
-          if job.worker: cancel.append(job)
-          else: job.destroy()
-        self.jobs = []
+        self.generation += 1
+        for job in self.jobs.drain():
+          # Jobs with leased nonce ranges have no worker of their own, but the workers of their ranges need to be notified
+          if job.worker or job.ranges: cancel.append(job)
+          else:
+            job.worksource.add_wasted_jobs(job.jobcount, True)
+            job.destroy()
         with self.stats.lock:
           self.stats.blocks += 1
           self.stats.lastblock = now
     self.core.log(self, "New block detected\n", 300, "B")
-    self.core.workqueue.cancel_jobs(cancel)
+    self.core.workqueue.cancel_jobs(cancel, callback = self._switched)
     return True
  
 
@@ -157,19 +176,20 @@ class DummyBlockchain(object):
     self.settings = Bunch(name = "Dummy blockchain")
     
     # Initialize job list (protected by global job queue lock)
-    self.jobs = []
+    self.jobs = OrderedSet()
     self.currentprevhash = None
     self.knownprevhashes = []
     self.timeoutend = 0
+    self.generation = 0
     self.blocklock = RLock()
     
     
   def add_job(self, job):
-    if not job in self.jobs: self.jobs.append(job)
+    self.jobs.add(job)
   
 
   def remove_job(self, job):
-    while job in self.jobs: self.jobs.remove(job)
+    self.jobs.discard(job)
     
     
   def add_work_source(self, worksource):
@@ -193,11 +213,13 @@ class DummyBlockchain(object):
         if timeout_expired: self.knownprevhashes = [self.currentprevhash]
         else: self.knownprevhashes.append(self.currentprevhash)
         self.currentprevhash = job.prevhash
-        while self.jobs:
-          job = self.jobs.pop(0)
-          if job.worker: cancel.append(job)
-          else: job.destroy()
-      self.jobs = []
+        self.generation += 1
+        for job in self.jobs.drain():
+          # Jobs with leased nonce ranges have no worker of their own, but the workers of their ranges need to be notified
+          if job.worker or job.ranges: cancel.append(job)
+          else:
+            job.worksource.add_wasted_jobs(job.jobcount, True)
+            job.destroy()
     self.core.log(self, "New block detected\n", 300, "B")
     self.core.workqueue.cancel_jobs(cancel)
     return True
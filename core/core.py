@@ -112,6 +112,18 @@ class Core(Startable):
             except Exception as e:
               self.log(self, "Could not load module %s.%s: %s\n" % (maintainer, module, traceback.format_exc()), 300, "yB")
               
+    # Pick the fastest working SHA256 midstate implementation
+    from . import midstate
+    midstate.select_backends()
+    for message, loglevel, format in midstate.messages: self.log(self, message, loglevel, format)
+    self.log(self, "Using %s midstate backend\n" % midstate.get_backend_name(), 400)
+
+    # Same for the merkle root calculation of Stratum jobs
+    from . import merkle
+    merkle.select_builder()
+    for message, loglevel, format in merkle.messages: self.log(self, message, loglevel, format)
+    self.log(self, "Using %s merkle builder (%d jobs/s)\n" % (merkle.get_builder_name(), merkle.jobs_per_second), 400)
+
     # Register the detected classes in the global object registry
     for frontendclass in self.frontendclasses: frontendclass.id = self.registry.register(frontendclass)
     for workerclass in self.workerclasses: workerclass.id = self.registry.register(workerclass)
@@ -206,6 +218,8 @@ class Core(Startable):
     self.stats = Bunch()
     self.stats.starttime = time.time()
     self.stats.ghashes = 0
+    from .midstate import get_backend_name
+    self.stats.midstate_backend = get_backend_name()
 
 
   def _start(self):
@@ -464,8 +478,8 @@ class Core(Startable):
           self.log(self, "Could not start root work source %s: %s\n" % (worksource.settings.name, traceback.format_exc()), 100, "yB")
           
           
-  def get_job(self, worker, expiry_min_ahead, async = False):
-    return self.workqueue.get_job(worker, expiry_min_ahead, async)
+  def get_job(self, worker, expiry_min_ahead, nonblocking = False, nonces = None):
+    return self.workqueue.get_job(worker, expiry_min_ahead, nonblocking, nonces)
     
     
   def get_blockchain_statistics(self):
@@ -27,20 +27,30 @@
 
 
 import time
+import math
 import traceback
 from threading import RLock, Condition, Thread, current_thread
 from .startable import Startable
-from .util import Bunch
+from .util import Bunch, monotonic
 
 
 
 class Fetcher(Startable):
 
+  # Minimum number of seconds between two work buffer size adjustments
+  updateinterval = 1
+  # Time constant (in seconds) of the job consumption average
+  averagingtime = 30
+  # Range of the safety margin that the work buffer size is multiplied with
+  minmargin = 0.5
+  maxmargin = 4
+
   
   def __init__(self, core):
     self.core = core
     self.id = -2
-    self.settings = Bunch(name = "Fetcher controller")
+    # starvation_probability: Acceptable probability of the work queue running dry while waiting for new jobs
+    self.settings = Bunch(name = "Fetcher controller", starvation_probability = 0.001)
     super(Fetcher, self).__init__()
     # Initialize global fetcher lock and wakeup condition
     self.lock = Condition()
@@ -53,6 +63,13 @@ class Fetcher(Startable):
     super(Fetcher, self)._reset()
     self.speedchanged = True
     self.queuetarget = 5
+    # Work buffer controller state, see _update_queue_target
+    self.jobspersecond = 0
+    self.paralleljobs = 0
+    self.consumption = None
+    self.latency = None
+    self.margin = 1.
+    self.lastupdate = None
     
 
   def _start(self):
@@ -80,6 +97,61 @@ class Fetcher(Startable):
       self.lock.notify()
 
     
+  def get_statistics(self):
+    with self.lock:
+      return Bunch(queuetarget = self.queuetarget, consumption = self.consumption, latency = self.latency, margin = self.margin,
+                   starvation_probability = self.settings.starvation_probability)
+
+
+  # Returns the number of standard deviations above the mean that are exceeded with the given probability (normal distribution).
+  # Uses the rational approximation from Abramowitz and Stegun 26.2.23 (error below 0.00045), limited to 0...10.
+  @staticmethod
+  def _get_quantile(probability):
+    if probability >= 0.5: return 0.
+    if probability <= 0: return 10.
+    t = math.sqrt(-2 * math.log(probability))
+    z = t - (2.515517 + 0.802853 * t + 0.010328 * t * t) / (1 + 1.432788 * t + 0.189269 * t * t + 0.001308 * t * t * t)
+    return min(10., max(0., z))
+
+
+  # Adjusts the work buffer size so that the work queue runs dry while waiting for new jobs with at most
+  # the configured probability. Job requests are treated as a Poisson process whose rate is the higher one of
+  # the measured job consumption and what the workers estimate, and the queue needs to last for the
+  # fetch latency of the slowest work source. Starvation in spite of that raises a safety margin,
+  # jobs that expire unused lower it. The buffer is limited to what can be used up before the jobs expire.
+  def _update_queue_target(self, force = False):
+    now = monotonic()
+    queue = self.core.workqueue
+    if self.lastupdate is None:
+      self.lastupdate = now
+      self.lasttaken = queue.jobstaken
+      self.laststarved = queue.starved
+      self.lastexpired = queue.jobsexpired
+    elapsed = now - self.lastupdate
+    if not force and elapsed < self.updateinterval: return
+    if elapsed > 0:
+      rate = (queue.jobstaken - self.lasttaken) / elapsed
+      if self.consumption is None: self.consumption = rate
+      else: self.consumption += (rate - self.consumption) * min(1, elapsed / self.averagingtime)
+    if queue.starved > self.laststarved: self.margin = min(self.maxmargin, self.margin * 1.25)
+    elif queue.jobsexpired > self.lastexpired: self.margin = max(self.minmargin, self.margin * 0.9)
+    self.lastupdate = now
+    self.lasttaken = queue.jobstaken
+    self.laststarved = queue.starved
+    self.lastexpired = queue.jobsexpired
+    
+    worksource = self.core.get_root_work_source()
+    demand = max(self.consumption or 0, self.jobspersecond)
+    self.latency = worksource.get_fetch_latency()
+    # Assume one second until the first jobs arrived
+    mean = demand * (1 if self.latency is None else self.latency)
+    target = (mean + self._get_quantile(self.settings.starvation_probability) * math.sqrt(mean)) * self.margin
+    expiry = worksource.get_job_expiry()
+    if expiry is not None: target = min(target, demand * max(0, expiry - queue.cutoffahead))
+    self.queuetarget = max(2, self.paralleljobs * 2, int(math.ceil(target)))
+    queue.target = self.queuetarget
+
+    
   def controllerloop(self):
     with self.lock:
       while not self.shutdown:
@@ -91,8 +163,10 @@ class Fetcher(Startable):
             for worker in self.core.workers:
               jobspersecond += worker.get_jobs_per_second()
               paralleljobs += worker.get_parallel_jobs()
-          self.queuetarget = max(5, paralleljobs * 2, jobspersecond * 30)
-          self.core.workqueue.target = self.queuetarget
+          self.jobspersecond = jobspersecond
+          self.paralleljobs = paralleljobs
+          self._update_queue_target(True)
+        else: self._update_queue_target()
         
         worksource = self.core.get_root_work_source()
         queuecount = self.core.workqueue.count
@@ -100,9 +174,10 @@ class Fetcher(Startable):
         needjobs = self.queuetarget - queuecount - jobcount
         startfetchers = max(0, min(5, (self.queuetarget - queuecount - jobcount // 2) // 2))
         if not startfetchers and queuecount == 0 and fetchercount < 3: startfetchers = 1
+        # Work sources wake us up once running requests finished, and the work queue once jobs were used up.
+        # Not every finished request does so, and the demand averages need to be updated anyway, so wait for a while at most.
         if not startfetchers:
-          if self.core.workqueue.count * 2 > self.queuetarget: self.lock.wait()
-          else: self.lock.wait(0.1)
+          self.lock.wait(self.updateinterval)
           continue
         try:
           if startfetchers:
@@ -30,12 +30,56 @@ import struct
 import traceback
 from binascii import hexlify
 from threading import Thread
-from .sha256 import SHA256
+from .midstate import calculate_midstate, calculate_midstates
 from hashlib import sha256
 
 
 
-class Job(object):
+class HashContext(object):
+
+  __slots__ = ("prefix", "tail")
+
+  
+  # Byte swaps the header once and keeps a hash object that has already consumed
+  # the first 64 bytes of it, so that checking a nonce only needs to hash the tail.
+  def __init__(self, data):
+    header = struct.pack("<20I", *struct.unpack(">20I", data[:80]))
+    self.prefix = sha256(header[:64])
+    self.tail = header[64:76]
+    
+    
+  def calculate_hash(self, nonce):
+    hash = self.prefix.copy()
+    hash.update(self.tail + nonce[::-1])
+    return sha256(hash.digest()).digest()
+
+
+
+class JobExtension(object):
+
+  # Modules can't add attributes of their own to jobs, which have a fixed layout.
+  # They can store data in the job's extension dict instead, which is only allocated when it is used.
+  # Keys should be prefixed with the module's maintainer and name, e.g. "theseven_sqlite_jobid".
+  __slots__ = ("ext",)
+
+  
+  def get_ext(self, key, default = None):
+    if self.ext is None: return default
+    return self.ext.get(key, default)
+    
+    
+  def set_ext(self, key, value):
+    if self.ext is None: self.ext = {}
+    self.ext[key] = value
+
+
+
+class Job(JobExtension):
+
+  __slots__ = ("core", "worksource", "blockchain", "expiry", "data", "target", "identifier", "difficulty", "midstate", "canceled",
+               "destroyed", "worker", "starttime", "hashes_remaining", "hashcontext", "generation", "ranges", "nextnonce")
+  # Number of jobs that this work queue entry stands for
+  jobcount = 1
 
   
   def __init__(self, core, worksource, expiry, data, target, midstate = None, identifier = None):
@@ -46,7 +90,7 @@ class Job(object):
     self.data = data
     self.target = target
     self.identifier = identifier
-    self.prevhash = data[4:36]
+    self.ext = None
     difficulty_inverse = struct.unpack("<Q", self.target[-12:-4])[0]
     if difficulty_inverse: self.difficulty = 65535. * 2**48 / difficulty_inverse
     else: self.difficulty = 65535. / 65536
@@ -58,9 +102,22 @@ class Job(object):
     self.worker = None
     self.starttime = None
     self.hashes_remaining = 2**32
+    self.hashcontext = None
+    self.generation = None
+    # Nonce range leases that are currently active (a list once the first one was handed out),
+    # and the first nonce that wasn't leased yet
+    self.ranges = ()
+    self.nextnonce = 0
+    
+    
+  # Derived from the data instead of being stored, it is only needed once per job
+  @property
+  def prevhash(self):
+    return self.data[4:36]
     
     
   def register(self):
+    self.generation = self.blockchain.generation
     self.worksource.add_job(self)
     self.blockchain.add_job(self)
     self.worksource.add_pending_mhashes(-self.hashes_remaining / 1000000.)
@@ -70,6 +127,10 @@ class Job(object):
   def destroy(self):
     if self.destroyed: return
     self.destroyed = True
+    # Workers must not keep hashing the ranges of a job that is gone
+    for range in list(self.ranges):
+      range.cancel()
+      range.destroy()
     self.worksource.remove_job(self)
     self.blockchain.remove_job(self)
     self.core.workqueue.remove_job(self)
@@ -90,6 +151,31 @@ class Job(object):
     self.hashes_remaining -= hashes
     
     
+  # Leases the next (up to) count nonces of this job to a worker.
+  # Must be called with the work queue lock held, returns None if all nonces have been leased.
+  def lease_range(self, worker, count):
+    if self.nextnonce >= 2**32: return None
+    if not self.nextnonce:
+      with self.worksource.stats.lock: self.worksource.stats.jobsaccepted += 1
+    range = JobRange(self, self.nextnonce, min(2**32, self.nextnonce + count))
+    self.nextnonce = range.end
+    if not self.ranges: self.ranges = []
+    self.ranges.append(range)
+    range.set_worker(worker)
+    return range
+    
+    
+  def _range_destroyed(self, range):
+    with self.core.workqueue.lock:
+      try: self.ranges.remove(range)
+      except: pass
+      self.hashes_remaining -= range.end - range.start - range.hashes_remaining
+      # The job is done once all of its nonces were hashed or it was canceled and nobody works on it any more
+      if self.ranges or self.destroyed: return
+      if not self.canceled and self.nextnonce < 2**32: return
+    self.destroy()
+    
+    
   def set_worker(self, worker):
     self.worker = worker
     self.core.log(worker, "Mining %s:%s\n" % (self.worksource.settings.name, hexlify(self.data[:76]).decode("ascii")), 400)
@@ -101,8 +187,8 @@ class Job(object):
   def nonce_found(self, nonce, ignore_invalid = False):
     nonceval = struct.unpack("<I", nonce)[0]
     self.core.event(400, self.worker, "noncefound", nonceval, None, self.worker, self.worksource, self.blockchain, self)
-    data = self.data[:76] + nonce + self.data[80:]
-    hash = Job.calculate_hash(data)
+    if not self.hashcontext: self.hashcontext = HashContext(self.data)
+    hash = self.hashcontext.calculate_hash(nonce)
     if hash[-4:] != b"\0\0\0\0":
       if ignore_invalid: return False
       self.core.log(self.worker, "Got H-not-zero share %s\n" % (hexlify(nonce).decode("ascii")), 200, "yB")
@@ -116,10 +202,49 @@ class Job(object):
       self.core.event(350, self.worksource, "noncefaileddiff", nonceval, str(self.difficulty), self.worker, self.worksource, self.blockchain, self)
       self.core.log(self.worker, "Share %s (difficulty %.5f) didn't meet difficulty %.5f\n" % (hexlify(nonce).decode("ascii"), noncediff, self.difficulty), 300, "g")
       return True
+    data = self.data[:76] + nonce + self.data[80:]
     self.worksource.nonce_found(self, data, nonce, noncediff)
     return True
     
     
+  def nonces_found(self, nonces, ignore_invalid = False):
+    if not nonces: return []
+    if not self.hashcontext: self.hashcontext = HashContext(self.data)
+    results = []
+    invalid = []
+    valid = []
+    failed = []
+    # The same per nonce events as nonce_found, only logging is done once per batch
+    for nonce in nonces:
+      nonceval = struct.unpack("<I", nonce)[0]
+      self.core.event(400, self.worker, "noncefound", nonceval, None, self.worker, self.worksource, self.blockchain, self)
+      hash = self.hashcontext.calculate_hash(nonce)
+      if hash[-4:] != b"\0\0\0\0":
+        results.append(False)
+        if ignore_invalid: continue
+        invalid.append(nonce)
+        self.core.event(300, self.worker, "nonceinvalid", nonceval, None, self.worker, self.worksource, self.blockchain, self)
+        continue
+      results.append(True)
+      noncediff = 65535. * 2**48 / struct.unpack("<Q", hash[-12:-4])[0]
+      self.core.event(450, self.worker, "noncevalid", nonceval, str(noncediff), self.worker, self.worksource, self.blockchain, self)
+      if hash[::-1] > self.target[::-1]:
+        failed.append((nonce, noncediff))
+        self.core.event(350, self.worksource, "noncefaileddiff", nonceval, str(self.difficulty), self.worker, self.worksource, self.blockchain, self)
+      else: valid.append((nonce, noncediff))
+    if invalid:
+      self.core.log(self.worker, "Got %d H-not-zero shares: %s\n" % (len(invalid), " ".join(hexlify(nonce).decode("ascii") for nonce in invalid)), 200, "yB")
+      with self.worker.stats.lock: self.worker.stats.sharesinvalid += len(invalid)
+    if failed:
+      self.core.log(self.worker, "%d shares didn't meet difficulty %.5f: %s\n" % (len(failed), self.difficulty, " ".join("%s (%.5f)" % (hexlify(nonce).decode("ascii"), noncediff) for nonce, noncediff in failed)), 300, "g")
+    if valid:
+      self.core.log(self.worker, "Found %d shares: %s:%s:%s\n" % (len(valid), self.worksource.settings.name, hexlify(self.data[:76]).decode("ascii"), ",".join(hexlify(nonce).decode("ascii") for nonce, noncediff in valid)), 350, "g")
+      prefix = self.data[:76]
+      suffix = self.data[80:]
+      for nonce, noncediff in valid: self.worksource.nonce_found(self, prefix + nonce + suffix, nonce, noncediff)
+    return results
+    
+    
   def nonce_handled_callback(self, nonce, noncediff, result):
     nonceval = struct.unpack("<I", nonce)[0]
     if result == True:
@@ -135,7 +260,8 @@ class Job(object):
       self.core.event(300, self.worksource, "noncerejected", nonceval, result, self.worker, self.worksource, self.blockchain, self)
 
 
-  def cancel(self, graceful = False):
+  # Leased nonce ranges are canceled as well, except for those in skipranges, which the caller cancels itself
+  def cancel(self, graceful = False, skipranges = ()):
     self.canceled = True
     if not graceful:
       self.worksource.remove_job(self)
@@ -147,11 +273,20 @@ class Job(object):
       except: self.core.log(self.worker, "Exception while canceling job: %s" % (traceback.format_exc()), 100, "r")
       with self.worker.stats.lock: self.worker.stats.jobscanceled += 1
       with self.worksource.stats.lock: self.worksource.stats.jobscanceled += 1
+    for range in list(self.ranges):
+      if not range in skipranges: range.cancel(graceful)
+    # Nobody else will destroy a partially leased job any more once it was removed from the work queue
+    if not self.ranges and self.nextnonce: self.destroy()
       
       
   @staticmethod
   def calculate_midstate(data):
-    return struct.pack("<8I", *struct.unpack(">8I", SHA256.hash(struct.pack("<16I", *struct.unpack(">16I", data[:64])), False)))
+    return calculate_midstate(data)
+      
+      
+  @staticmethod
+  def calculate_midstates(datas):
+    return calculate_midstates(datas)
       
       
   @staticmethod
@@ -160,15 +295,177 @@ class Job(object):
 
     
     
-class ValidationJob(object):
+class JobTemplate(JobExtension):
+
+  __slots__ = ("core", "worksource", "blockchain", "expiry", "data", "target", "midstate", "identifier", "prefix", "timebase",
+               "suffix", "jobcount", "minted", "hashes_remaining", "canceled", "destroyed", "worker", "generation")
+
+  
+  # Stands for count jobs that only differ in their ntime value (consecutive values starting at the one in data).
+  # It is stored as a single entry in the work queue, Jobs are only created once they are handed out to a worker.
+  def __init__(self, core, worksource, expiry, data, target, midstate, identifier, count):
+    self.core = core
+    self.worksource = worksource
+    self.blockchain = worksource.blockchain
+    self.expiry = expiry
+    self.data = data
+    self.target = target
+    self.midstate = midstate
+    self.identifier = identifier
+    self.ext = None
+    self.prefix = data[:68]
+    self.timebase = struct.unpack(">I", data[68:72])[0]
+    self.suffix = data[72:]
+    self.jobcount = count
+    self.minted = 0
+    self.hashes_remaining = count * 2**32
+    self.canceled = False
+    self.destroyed = False
+    self.worker = None
+    self.generation = None
+    
+    
+  @property
+  def prevhash(self):
+    return self.data[4:36]
+    
+    
+  # Templates are never leased in nonce ranges
+  @property
+  def ranges(self):
+    return ()
+    
+    
+  def register(self):
+    self.generation = self.blockchain.generation
+    self.worksource.add_job(self)
+    self.blockchain.add_job(self)
+    self.worksource.add_pending_mhashes(-self.hashes_remaining / 1000000.)
+    self.core.event(500, self.worksource, "registerjob", self.jobcount, None, None, self.worksource, self.blockchain, self)
+    
+    
+  # Creates and registers the next job. Must be called with the work queue lock held.
+  def mint(self):
+    job = Job(self.core, self.worksource, self.expiry, self.prefix + struct.pack(">I", self.timebase + self.minted) + self.suffix, self.target, self.midstate, self.identifier)
+    self.minted += 1
+    self.jobcount -= 1
+    # Move the pending hashes of this job over to it, register() will take them again
+    self.hashes_remaining -= 2**32
+    self.worksource.add_pending_mhashes(2**32 / 1000000.)
+    job.register()
+    if not self.jobcount: self.destroy()
+    return job
+    
+    
+  def destroy(self):
+    if self.destroyed: return
+    self.destroyed = True
+    self.worksource.remove_job(self)
+    self.blockchain.remove_job(self)
+    self.core.workqueue.remove_job(self)
+    self.worksource.add_pending_mhashes(self.hashes_remaining / 1000000.)
+    self.core.event(700, self.worksource, "destroyjob", self.jobcount, None, None, self.worksource, self.blockchain, self)
+    
+    
+  # Templates never have a worker, so there is nobody to notify
+  def cancel(self, graceful = False):
+    self.canceled = True
+    self.destroy()
+
+    
+    
+class JobRange(Job):
+
+  __slots__ = ("job", "start", "end")
+
+  
+  # A lease of the nonces start ... end - 1 of a job, which can be processed like a job of its own.
+  # Hashes are accounted per range, and canceling or destroying the job affects all of its ranges.
+  def __init__(self, job, start, end):
+    self.job = job
+    self.core = job.core
+    self.worksource = job.worksource
+    self.blockchain = job.blockchain
+    self.expiry = job.expiry
+    self.data = job.data
+    self.target = job.target
+    self.identifier = job.identifier
+    self.ext = None
+    self.difficulty = job.difficulty
+    self.midstate = job.midstate
+    self.canceled = job.canceled
+    self.destroyed = False
+    self.worker = None
+    self.starttime = None
+    self.start = start
+    self.end = end
+    self.hashes_remaining = end - start
+    self.hashcontext = job.hashcontext
+    self.generation = job.generation
+    self.ranges = ()
+    self.nextnonce = 2**32
+    
+    
+  # Work source modules store their data in the job they created
+  def get_ext(self, key, default = None):
+    if self.ext is None or not key in self.ext: return self.job.get_ext(key, default)
+    return self.ext[key]
+    
+    
+  def register(self):
+    pass
+    
+    
+  def set_worker(self, worker):
+    self.worker = worker
+    self.core.log(worker, "Mining %s:%s (nonces %08x-%08x)\n" % (self.worksource.settings.name, hexlify(self.data[:76]).decode("ascii"), self.start, self.end - 1), 400)
+    self.core.event(450, self.worker, "acquirejob", None, None, self.worker, self.worksource, self.blockchain, self)
+    with self.worker.stats.lock: self.worker.stats.jobsaccepted += 1
+    
+    
+  def destroy(self):
+    if self.destroyed: return
+    self.destroyed = True
+    if self.worker:
+      hashes = self.end - self.start - self.hashes_remaining
+      self.core.event(400, self.worker, "hashes_calculated", hashes, None, self.worker, self.worksource, self.blockchain, self)
+      ghashes = hashes / 1000000000.
+      self.core.stats.ghashes += ghashes
+      with self.worksource.stats.lock:
+        self.worksource.stats.ghashes += ghashes
+      with self.worker.stats.lock:
+        self.worker.stats.ghashes += ghashes
+    self.job._range_destroyed(self)
+    
+    
+  def cancel(self, graceful = False):
+    if self.canceled: return
+    self.canceled = True
+    if self.worker:
+      self.core.event(450, self.worksource, "canceljob", None, None, self.worker, self.worksource, self.blockchain, self)
+      try: self.worker.notify_canceled(self, graceful)
+      except: self.core.log(self.worker, "Exception while canceling job: %s" % (traceback.format_exc()), 100, "r")
+      with self.worker.stats.lock: self.worker.stats.jobscanceled += 1
+    
+    
+  def lease_range(self, worker, count):
+    return None
+
+    
+    
+class ValidationJob(JobExtension):
+
+  __slots__ = ("core", "data", "midstate", "nonce", "hashcontext", "worker", "starttime")
 
   
   def __init__(self, core, data, midstate = None):
     self.core = core
     self.data = data
+    self.ext = None
     if midstate: self.midstate = midstate
     else: self.midstate = Job.calculate_midstate(data)
     self.nonce = self.data[76:80]
+    self.hashcontext = None
     self.worker = None
     self.starttime = None
     
@@ -178,7 +475,12 @@ class ValidationJob(object):
     
     
   def nonce_found(self, nonce, ignore_invalid = False):
-    return Job.calculate_hash(self.data[:76] + nonce)[-4:] == b"\0\0\0\0"
+    if not self.hashcontext: self.hashcontext = HashContext(self.data)
+    return self.hashcontext.calculate_hash(nonce)[-4:] == b"\0\0\0\0"
+    
+    
+  def nonces_found(self, nonces, ignore_invalid = False):
+    return [self.nonce_found(nonce) for nonce in nonces]
    
    
   def destroy(self):
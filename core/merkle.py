@@ -0,0 +1,188 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+###########################
+# Merkle root calculation #
+###########################
+
+
+
+import time
+import struct
+from hashlib import sha256
+from threading import RLock
+from .sha256 import SHA256
+from .midstate import NumPyMidstateBackend
+try: import numpy
+except ImportError: numpy = None
+
+
+
+class MerkleBuilder(object):
+
+  name = "unknown"
+
+
+  # Calculates the merkle roots of the coinbase transactions prefix + extranonce2 + suffix for all
+  # extranonce2 values (byte strings of equal length), given the merkle branch of the coinbase.
+  # Returns the roots in hash byte order (as the double SHA256 digests), in the order of extranonce2s.
+  def merkle_roots(self, prefix, suffix, branches, extranonce2s):
+    raise NotImplementedError()
+
+
+
+class HashlibMerkleBuilder(MerkleBuilder):
+
+  name = "hashlib"
+
+
+  def merkle_roots(self, prefix, suffix, branches, extranonce2s):
+    # The prefix is the same for all coinbases, so hashing continues from a copy of its hash state
+    prefixhash = sha256(prefix)
+    roots = []
+    for extranonce2 in extranonce2s:
+      coinbase = prefixhash.copy()
+      coinbase.update(extranonce2 + suffix)
+      merkle = sha256(coinbase.digest()).digest()
+      for branch in branches: merkle = sha256(sha256(merkle + branch).digest()).digest()
+      roots.append(merkle)
+    return roots
+
+
+
+# Calculates the merkle roots of all extranonce2 values at once, as uint32 vectors
+class NumPyMerkleBuilder(MerkleBuilder):
+
+  name = "numpy"
+
+
+  def __init__(self):
+    if not numpy: raise Exception("NumPy is not available")
+    self.backend = NumPyMidstateBackend()
+    # Padding of a 32 byte message (the second hash) and the second block of a 64 byte message
+    self.padding32 = numpy.array([0x80000000, 0, 0, 0, 0, 0, 0, 256], dtype = numpy.uint32)
+    self.padding64 = numpy.array([0x80000000] + [0] * 14 + [512], dtype = numpy.uint32)
+
+
+  def _hash(self, state, blocks):
+    for block in blocks: state = self.backend.compress(state, block)
+    return state
+
+
+  def _double_hash_64(self, blocks):
+    count = len(blocks)
+    state = self._hash(numpy.tile(self.backend.iv, (count, 1)), [blocks, numpy.tile(self.padding64, (count, 1))])
+    block = numpy.concatenate((state, numpy.tile(self.padding32, (count, 1))), axis = 1)
+    return self.backend.compress(numpy.tile(self.backend.iv, (count, 1)), block)
+
+
+  def merkle_roots(self, prefix, suffix, branches, extranonce2s):
+    if not extranonce2s: return []
+    count = len(extranonce2s)
+    # Hash all complete blocks of the prefix just once
+    split = len(prefix) - len(prefix) % 64
+    prefixhash = SHA256()
+    prefixhash.update(prefix[:split])
+    length = len(prefix) + len(extranonce2s[0]) + len(suffix)
+    padding = b"\x80" + b"\0" * ((55 - length) % 64) + struct.pack(">Q", length * 8)
+    head = prefix[split:]
+    tail = suffix + padding
+    message = b"".join(head + extranonce2 + tail for extranonce2 in extranonce2s)
+    words = numpy.frombuffer(message, dtype = ">u4").astype(numpy.uint32).reshape(count, -1)
+    with numpy.errstate(over = "ignore"):
+      state = numpy.tile(numpy.array(prefixhash.state, dtype = numpy.uint32), (count, 1))
+      state = self._hash(state, [words[:, i : i + 16] for i in range(0, words.shape[1], 16)])
+      block = numpy.concatenate((state, numpy.tile(self.padding32, (count, 1))), axis = 1)
+      merkle = self.backend.compress(numpy.tile(self.backend.iv, (count, 1)), block)
+      for branch in branches:
+        branch = numpy.frombuffer(branch, dtype = ">u4").astype(numpy.uint32)
+        merkle = self._double_hash_64(numpy.concatenate((merkle, numpy.tile(branch, (count, 1))), axis = 1))
+    result = merkle.astype(">u4").tobytes()
+    return [result[i : i + 32] for i in range(0, len(result), 32)]
+
+
+
+# Builders in order of preference, the fastest verified one will be picked
+builderclasses = [HashlibMerkleBuilder, NumPyMerkleBuilder]
+# Batch size that the builders are compared with, and the merkle branch depth of the test data
+benchmark_batch_size = 1024
+benchmark_branch_depth = 12
+# Smaller batches are always processed by the hashlib builder, vector lanes only pay off for large ones
+min_batch_size = 256
+lock = RLock()
+builder = None
+hashlib_builder = HashlibMerkleBuilder()
+jobs_per_second = None
+messages = []
+
+
+def _test_data(count):
+  prefix = b"".join(struct.pack(">I", i * 0x01010101) for i in range(27))
+  suffix = b"".join(struct.pack(">I", i * 0x02020202) for i in range(19))
+  branches = [sha256(struct.pack(">I", i)).digest() for i in range(benchmark_branch_depth)]
+  extranonce2s = [struct.pack(">I", i) for i in range(count)]
+  return prefix, suffix, branches, extranonce2s
+
+
+# Returns jobs per second, or None if the builder produced wrong results
+def _benchmark(instance, reference):
+  prefix, suffix, branches, extranonce2s = _test_data(benchmark_batch_size)
+  starttime = time.time()
+  roots = instance.merkle_roots(prefix, suffix, branches, extranonce2s)
+  elapsed = time.time() - starttime
+  if roots != reference: return None
+  return benchmark_batch_size / max(elapsed, 0.000001)
+
+
+def select_builder():
+  global builder, jobs_per_second, messages
+  with lock:
+    if builder: return builder
+    reference = hashlib_builder.merkle_roots(*_test_data(benchmark_batch_size))
+    report = []
+    results = []
+    for index, builderclass in enumerate(builderclasses):
+      try:
+        instance = builderclass()
+        rate = _benchmark(instance, reference)
+        if rate is None:
+          report.append(("%s merkle builder produced wrong results, not using it\n" % builderclass.name, 200, "yB"))
+          continue
+        report.append(("%s merkle builder: %d jobs/s\n" % (builderclass.name, rate), 500, ""))
+        results.append((-rate, index, instance))
+      except Exception as e:
+        report.append(("%s merkle builder is not available: %s\n" % (builderclass.name, e), 500, ""))
+    if results: rate, index, builder = min(results)
+    else: rate, builder = 0, hashlib_builder
+    jobs_per_second = -rate
+    messages = report
+    return builder
+
+
+def get_builder_name():
+  return select_builder().name
+
+
+def calculate_merkle_roots(prefix, suffix, branches, extranonce2s):
+  if not builder: select_builder()
+  if len(extranonce2s) < min_batch_size: return hashlib_builder.merkle_roots(prefix, suffix, branches, extranonce2s)
+  return builder.merkle_roots(prefix, suffix, branches, extranonce2s)
@@ -0,0 +1,226 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+############################
+# SHA256 midstate backends #
+############################
+
+
+
+import time
+import struct
+from binascii import unhexlify
+from threading import RLock
+from .sha256 import SHA256
+try: import numpy
+except ImportError: numpy = None
+
+
+
+# Known answers for the first 64 bytes of getwork data (as returned by Job.calculate_midstate of
+# MPBM v0.1.0). Every backend has to reproduce all of these before it will be used.
+test_vectors = [(unhexlify(data), unhexlify(midstate)) for data, midstate in (
+  (b"00000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000",
+   b"be9856da69b4b91799573362cabe9f7791d4e58c4362d2c0eaf9febad8a93718"),
+  (b"ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff",
+   b"8d740cefa850daf4013cc4d6e73cdc3ea99f9d6cde8a45a1c086eb56d29244a6"),
+  (b"000102030405060708090a0b0c0d0e0f101112131415161718191a1b1c1d1e1f202122232425262728292a2b2c2d2e2f303132333435363738393a3b3c3d3e3f",
+   b"eb9adee680e26bb67096801ee2c1e9d548f259c85748cd32bbf41edb5fc526c3"),
+  (b"00000001c3bf95208a646ee98a58cf97c3a0c4b7bf5de4c89ca04495000005200000000024d1fff8d5d73ae11140e4e48032cd88ee01d48c67147f9a09cd41fd",
+   b"011732df67dd16de9a6f59cdd355dd6e44325e232aa70e7af23924db41aa505f"),
+)]
+
+
+
+class MidstateBackend(object):
+
+  name = "unknown"
+  batch_only = False
+
+
+  # Calculates the midstate of the first 64 bytes of getwork (word-swapped) data
+  def midstate(self, data):
+    raise NotImplementedError()
+
+
+  def midstates(self, datas):
+    return [self.midstate(data) for data in datas]
+
+
+  def verify(self):
+    datas = [data for data, midstate in test_vectors]
+    expected = [midstate for data, midstate in test_vectors]
+    if not self.batch_only:
+      for data, midstate in test_vectors:
+        if self.midstate(data) != midstate: return False
+    return self.midstates(datas) == expected
+
+
+
+class PythonMidstateBackend(MidstateBackend):
+
+  name = "python"
+
+
+  def midstate(self, data):
+    hash = SHA256()
+    hash.update(struct.pack("<16I", *struct.unpack(">16I", data[:64])))
+    return struct.pack("<8I", *hash.state)
+
+
+
+class OpenSSLMidstateBackend(MidstateBackend):
+
+  name = "openssl"
+  # sizeof(SHA256_CTX): 8 state words, 2 length words, 16 data words, num, md_len
+  ctxsize = 4 * (8 + 2 + 16 + 2)
+
+
+  def __init__(self):
+    import ctypes
+    import ctypes.util
+    self.ctypes = ctypes
+    path = None
+    for name in ("crypto", "libeay32", "libcrypto-1_1", "libcrypto-3"):
+      path = ctypes.util.find_library(name)
+      if path: break
+    if not path: raise Exception("Could not find the OpenSSL crypto library")
+    library = ctypes.CDLL(path)
+    self.init = library.SHA256_Init
+    self.transform = library.SHA256_Transform
+
+
+  def midstate(self, data):
+    ctx = self.ctypes.create_string_buffer(self.ctxsize)
+    self.init(ctx)
+    self.transform(ctx, struct.pack("<16I", *struct.unpack(">16I", data[:64])))
+    return struct.pack("<8I", *struct.unpack("=8I", ctx.raw[:32]))
+
+
+
+class NumPyMidstateBackend(MidstateBackend):
+
+  name = "numpy"
+  batch_only = True
+
+
+  def __init__(self):
+    if not numpy: raise Exception("NumPy is not available")
+    self.k = numpy.array(SHA256._k, dtype = numpy.uint32)
+    self.iv = numpy.array(SHA256().state, dtype = numpy.uint32)
+
+
+  @staticmethod
+  def _rotr(x, y):
+    return (x >> numpy.uint32(y)) | (x << numpy.uint32(32 - y))
+
+
+  # Runs the SHA256 compression function on N blocks at once.
+  # state: (N, 8) uint32 array, block: (N, 16) uint32 array (message words as integers)
+  def compress(self, state, block):
+    rotr = self._rotr
+    w = list(block.T)
+    for i in range(16, 64):
+      s0 = rotr(w[i - 15], 7) ^ rotr(w[i - 15], 18) ^ (w[i - 15] >> numpy.uint32(3))
+      s1 = rotr(w[i - 2], 17) ^ rotr(w[i - 2], 19) ^ (w[i - 2] >> numpy.uint32(10))
+      w.append(w[i - 16] + s0 + w[i - 7] + s1)
+    a, b, c, d, e, f, g, h = state.T
+    for i in range(64):
+      t1 = h + (rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)) + ((e & f) ^ (~e & g)) + self.k[i] + w[i]
+      t2 = (rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)) + ((a & b) ^ (a & c) ^ (b & c))
+      h, g, f, e, d, c, b, a = g, f, e, d + t1, c, b, a, t1 + t2
+    return state + numpy.array([a, b, c, d, e, f, g, h], dtype = numpy.uint32).T
+
+
+  def midstate(self, data):
+    return self.midstates([data])[0]
+
+
+  def midstates(self, datas):
+    if not datas: return []
+    # Getwork data is word-swapped, so reading it as little endian yields the message words
+    block = numpy.frombuffer(b"".join(bytes(data[:64]) for data in datas), dtype = "<u4").reshape(-1, 16).astype(numpy.uint32)
+    state = numpy.tile(self.iv, (len(datas), 1))
+    with numpy.errstate(over = "ignore"):
+      result = self.compress(state, block).astype("<u4").tobytes()
+    return [result[i : i + 32] for i in range(0, len(result), 32)]
+
+
+
+# Backends in order of preference, the fastest verified one will be picked
+backendclasses = [OpenSSLMidstateBackend, NumPyMidstateBackend, PythonMidstateBackend]
+# Smaller batches are processed block by block using the single block backend
+min_batch_size = 16
+lock = RLock()
+backend = None
+batch_backend = None
+messages = []
+
+
+def _benchmark(instance, batch):
+  datas = [data for data, midstate in test_vectors] * 16
+  starttime = time.time()
+  if batch: instance.midstates(datas)
+  else:
+    for data in datas: instance.midstate(data)
+  return time.time() - starttime
+
+
+def select_backends():
+  global backend, batch_backend, messages
+  with lock:
+    if backend: return backend, batch_backend
+    instances = []
+    report = []
+    for backendclass in backendclasses:
+      try:
+        instance = backendclass()
+        if not instance.verify():
+          report.append(("%s midstate backend produced wrong results, not using it\n" % backendclass.name, 200, "yB"))
+          continue
+        instances.append(instance)
+      except Exception as e:
+        report.append(("%s midstate backend is not available: %s\n" % (backendclass.name, e), 500, ""))
+    single = [(_benchmark(instance, False), index, instance) for index, instance in enumerate(instances) if not instance.batch_only]
+    batch = [(_benchmark(instance, True), index, instance) for index, instance in enumerate(instances)]
+    backend = min(single)[2] if single else PythonMidstateBackend()
+    batch_backend = min(batch)[2] if batch else backend
+    messages = report
+    return backend, batch_backend
+
+
+def get_backend_name():
+  single, batch = select_backends()
+  if single is batch: return single.name
+  return "%s (batch: %s)" % (single.name, batch.name)
+
+
+def calculate_midstate(data):
+  if not backend: select_backends()
+  return backend.midstate(data)
+
+
+
+def calculate_midstates(datas):
+  if not backend: select_backends()
+  if len(datas) < min_batch_size: return [backend.midstate(data) for data in datas]
+  return batch_backend.midstates(datas)
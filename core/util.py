@@ -26,6 +26,18 @@
 
 
 
+import time
+import math
+from threading import RLock
+
+
+
+# Clock for job expiry, which doesn't jump if the system time is changed (where the Python version provides one)
+try: monotonic = time.monotonic
+except AttributeError: monotonic = time.time
+
+
+
 class OutputRedirector(object):
 
 
@@ -59,3 +71,177 @@ class Bunch(dict):
   def __setstate__(self, state):
     self.update(state)
     self.__dict__ = self
+
+
+
+# Set that remembers insertion order, with O(1) add, discard and pop at both ends.
+# Items are kept in a circular doubly linked list of [item, prev, next] nodes.
+class OrderedSet(object):
+
+
+  def __init__(self, iterable = ()):
+    self.end = end = []
+    end += [None, end, end]
+    self.map = {}
+    for item in iterable: self.add(item)
+
+    
+  def __len__(self):
+    return len(self.map)
+
+    
+  def __contains__(self, item):
+    return item in self.map
+
+    
+  def __iter__(self):
+    end = self.end
+    node = end[2]
+    while node is not end:
+      yield node[0]
+      node = node[2]
+
+      
+  def add(self, item):
+    if item in self.map: return
+    end = self.end
+    last = end[1]
+    last[2] = end[1] = self.map[item] = [item, last, end]
+
+    
+  def discard(self, item):
+    if not item in self.map: return False
+    item, prev, next = self.map.pop(item)
+    prev[2] = next
+    next[1] = prev
+    return True
+
+    
+  def remove(self, item):
+    if not self.discard(item): raise KeyError(item)
+
+    
+  def pop(self, last = True):
+    if not self.map: raise KeyError("pop from an empty set")
+    item = self.end[1][0] if last else self.end[2][0]
+    self.discard(item)
+    return item
+
+    
+  def clear(self):
+    self.end[1:] = [self.end, self.end]
+    self.map.clear()
+
+    
+  # Removes all items at once, returning them in insertion order
+  def drain(self):
+    items = list(self)
+    self.clear()
+    return items
+
+
+
+# Reentrant lock that keeps track of how often and how long threads had to wait for it.
+# The counters are only modified while holding the lock. Can be used with threading.Condition.
+class MeasuredRLock(object):
+
+
+  def __init__(self):
+    self.lock = RLock()
+    self.acquisitions = 0
+    self.contentions = 0
+    self.waittime = 0.
+
+    
+  def acquire(self, blocking = True):
+    if self.lock.acquire(False):
+      self.acquisitions += 1
+      return True
+    if not blocking: return False
+    starttime = time.time()
+    self.lock.acquire()
+    self.waittime += time.time() - starttime
+    self.acquisitions += 1
+    self.contentions += 1
+    return True
+
+    
+  def release(self):
+    self.lock.release()
+
+    
+  def __enter__(self):
+    # Inlined uncontended case of acquire(), this is called a lot
+    if self.lock.acquire(False):
+      self.acquisitions += 1
+      return True
+    return self.acquire()
+
+    
+  def __exit__(self, type, value, traceback):
+    self.lock.release()
+
+    
+  # Used by threading.Condition to release a recursively held lock while waiting
+  def _release_save(self):
+    return self.lock._release_save()
+
+    
+  def _acquire_restore(self, state):
+    self.lock._acquire_restore(state)
+
+    
+  def _is_owned(self):
+    return self.lock._is_owned()
+
+
+
+# Latency histogram with logarithmically spaced buckets (resolution buckets per doubling, starting at 1ms),
+# which provides percentiles without keeping every sample around. Also counts failed operations.
+class LatencyHistogram(object):
+
+  resolution = 4
+  buckets = 80
+
+
+  def __init__(self):
+    self.lock = RLock()
+    self.counts = [0] * self.buckets
+    self.count = 0
+    self.errors = 0
+    self.total = 0.
+    self.max = 0.
+
+    
+  def add(self, latency):
+    if latency <= 0.001: index = 0
+    else: index = min(self.buckets - 1, int(math.ceil(math.log(latency / 0.001, 2) * self.resolution)))
+    with self.lock:
+      self.counts[index] += 1
+      self.count += 1
+      self.total += latency
+      self.max = max(self.max, latency)
+
+    
+  def add_error(self):
+    with self.lock: self.errors += 1
+
+    
+  # Returns the upper bound of the bucket that contains the given percentile (None if there were no samples)
+  def get_percentile(self, percentile):
+    with self.lock:
+      if not self.count: return None
+      threshold = self.count * percentile / 100.
+      seen = 0
+      for index, count in enumerate(self.counts):
+        seen += count
+        if seen >= threshold: break
+      return min(self.max, 0.001 * 2 ** (float(index) / self.resolution))
+
+    
+  def get_statistics(self):
+    with self.lock:
+      attempts = self.count + self.errors
+      return Bunch(count = self.count, errors = self.errors, errorrate = float(self.errors) / attempts if attempts else 0,
+                   avg = self.total / self.count if self.count else None, max = self.max,
+                   p50 = self.get_percentile(50), p90 = self.get_percentile(90), p99 = self.get_percentile(99))
@@ -27,37 +27,120 @@
 
 
 import time
+import traceback
+from bisect import bisect_left, bisect_right, insort
 from threading import Condition, RLock, Thread
 from .startable import Startable
-from .util import Bunch
+from .util import Bunch, OrderedSet, MeasuredRLock, monotonic
+from .job import JobTemplate
 try: from queue import Queue
 except: from Queue import Queue
 
 
 
+class JobCache(object):
+
+  
+  # Jobs reserved for the workers of a worker group. These are handed out under the cache's own lock,
+  # only refilling the cache (in batches) needs the global work queue lock.
+  def __init__(self, size):
+    self.size = size
+    self.lock = RLock()
+    self.jobs = OrderedSet()
+    self.taken = OrderedSet()
+    self.hits = 0
+    self.misses = 0
+    
+    
+  # Returns the first reserved job that is still usable and expires after min_expiry.
+  # Jobs that were invalidated in the meantime (by a new block or otherwise) are dropped and returned as well.
+  def get_job(self, min_expiry):
+    stale = []
+    with self.lock:
+      for job in list(self.jobs):
+        if job.destroyed or job.canceled or job.generation != job.blockchain.generation:
+          self.jobs.discard(job)
+          stale.append(job)
+        elif job.expiry > min_expiry:
+          self.jobs.discard(job)
+          self.taken.add(job)
+          self.hits += 1
+          return job, stale
+      self.misses += 1
+    return None, stale
+    
+    
+  # Removes jobs that have expired or were destroyed. Returns the expired jobs, which have to be destroyed or canceled.
+  def cleanup(self, now):
+    with self.lock:
+      expired = [job for job in self.jobs if job.destroyed or job.expiry <= now]
+      for job in expired: self.jobs.discard(job)
+      taken = [job for job in self.taken if job.destroyed or job.expiry <= now]
+      for job in taken: self.taken.discard(job)
+    return expired, taken
+    
+    
+  # Returns the expiry time of the job that will expire next, or None if the cache is empty
+  def get_next_expiry(self):
+    with self.lock:
+      expiries = [job.expiry for job in self.jobs] + [job.expiry for job in self.taken]
+    return min(expiries) if expiries else None
+    
+
+
 class WorkQueue(Startable):
 
+  # Maximum number of jobs reserved per worker group
+  cachesize = 4
+  # Jobs that will expire within this many seconds don't count towards the queue level any more
+  cutoffahead = 10
+
   
   def __init__(self, core):
     self.core = core
     self.id = -3
     self.settings = Bunch(name = "Work queue")
-    super(WorkQueue, self).__init__()
     # Initialize global work queue lock and wakeup condition
-    self.lock = Condition()
+    self.rawlock = MeasuredRLock()
+    self.lock = Condition(self.rawlock)
+    # Wakes up the cleanup thread if a job needs to be expired earlier than it was scheduled for
+    self.cleanupwakeup = Condition(self.rawlock)
+    super(WorkQueue, self).__init__()
     self.cancelqueue = Queue()
+    # Jobs waiting to be canceled by worker, and the workers that currently have a cancellation thread running
+    self.cancellock = RLock()
+    self.cancelpending = {}
+    self.cancelthreads = set()
+    # Running totals for the fetcher: jobs handed out, get_job calls that had to wait for jobs, and jobs that expired unused
+    self.jobstaken = 0
+    self.starved = 0
+    self.jobsexpired = 0
     
     
   def _reset(self):
     self.core.event(300, self, "reset", None, "Resetting work queue state")
     super(WorkQueue, self)._reset()
     # Initialize job list container and count
+    # Jobs are bucketed by expiry (in whole seconds of the monotonic clock), each bucket is an OrderedSet in arrival order.
+    # The expiry keys of all non-empty buckets are kept sorted to find the right bucket using bisect.
+    # The number of jobs that every bucket stands for is tracked as well, so that buckets can leave the
+    # queue level count as a whole once they get close to expiry.
     self.lists = {}
+    self.keys = []
+    self.counts = {}
     self.target = 5
     self.count = 0
     self.expirycutoff = 0
+    # Time at which the cleanup thread will wake up next (None if it has nothing to wait for)
+    self.nextcleanup = None
+    self.cleanuprequested = False
     # Initialize taken job list container
     self.takenlists = {}
+    self.takenkeys = []
+    # Job caches by worker group (protected by the work queue lock)
+    self.caches = {}
+    # Taken jobs that still have nonce ranges left to be leased
+    self.leasing = []
     
     
   def add_job(self, job, source = None, subsource = "unknown source"):
@@ -67,15 +150,14 @@ class WorkQueue(Startable):
         mhashes = job.hashes_remaining / 1000000.
         job.worksource.add_pending_mhashes(-mhashes)
         job.worksource.add_deferred_mhashes(mhashes)
+        job.worksource.add_wasted_jobs(job.jobcount, True)
         self.core.log(source, "Discarding one job from %s because it is stale\n" % subsource, 500)
         return False
-      expiry = int(job.expiry)
-      if not expiry in self.lists: self.lists[expiry] = [job]
-      else: self.lists[expiry].append(job)
-      if expiry > self.expirycutoff: self.count += 1
+      self._enqueue(job)
       job.register()
       self.lock.notify_all()
-      self.core.log(source, "Got one job from %s\n" % subsource, 500)
+      if job.jobcount == 1: self.core.log(source, "Got one job from %s\n" % subsource, 500)
+      else: self.core.log(source, "Got %d jobs from %s\n" % (job.jobcount, subsource), 500)
       return True
     
     
@@ -84,58 +166,125 @@ class WorkQueue(Startable):
     with self.lock:
       seen = {}
       accepted = 0
+      jobcount = 0
       dropped = 0
       for job in jobs:
         if not job.blockchain.check_job(job):
           dropped += 1
+          job.worksource.add_wasted_jobs(job.jobcount, True)
           if not job.worksource in seen:
             mhashes = 2**32 / 1000000.
             job.worksource.add_pending_mhashes(-mhashes)
             job.worksource.add_deferred_mhashes(mhashes)
             seen[job.worksource] = True
         else:
-          expiry = int(job.expiry)
-          if not expiry in self.lists: self.lists[expiry] = [job]
-          else: self.lists[expiry].append(job)
-          if expiry > self.expirycutoff: self.count += 1
+          self._enqueue(job)
+          jobcount += job.jobcount
           job.register()
           accepted += 1
       self.lock.notify_all()
-      if accepted: self.core.log(source, "Got %d jobs from %s\n" % (accepted, subsource), 500)
+      if accepted: self.core.log(source, "Got %d jobs from %s\n" % (jobcount, subsource), 500)
       if dropped: self.core.log(source, "Discarding %d jobs from %s because they are stale\n" % (dropped, subsource), 500)
       return accepted
     
     
-  def cancel_jobs(self, jobs, graceful = False):
-    if not jobs: return
-    self.cancelqueue.put((jobs, graceful))
+  # Must be called with the work queue lock held
+  def _enqueue(self, job):
+    expiry = int(job.expiry)
+    self._insert(self.lists, self.keys, expiry, job)
+    self.counts[expiry] = self.counts.get(expiry, 0) + job.jobcount
+    if expiry > self.expirycutoff: self.count += job.jobcount
+    # Wake up the cleanup thread if this bucket needs attention before it was planning to wake up
+    if self.nextcleanup is None or expiry - self.cutoffahead < self.nextcleanup:
+      self.cleanuprequested = True
+      self.cleanupwakeup.notify()
+    
+    
+  # Cancels jobs in the background. If a callback is given, it will be called with the
+  # number of seconds that it took until the workers of all jobs were notified.
+  def cancel_jobs(self, jobs, graceful = False, callback = None):
+    if not jobs:
+      if callback: callback(0)
+      return
+    self.cancelqueue.put((jobs, graceful, callback))
     
     
   def remove_job(self, job):
     with self.lock:
       try:
         expiry = int(job.expiry)
-        try:
-          self.lists[expiry].remove(job)
-          if expiry > self.expirycutoff: self.count -= 1
-        except: pass
-        try: self.takenlists[expiry].remove(job)
+        if self._discard(self.lists, self.keys, expiry, job):
+          if expiry > self.expirycutoff: self.count -= job.jobcount
+          if expiry in self.lists: self.counts[expiry] -= job.jobcount
+          else: del self.counts[expiry]
+        self._discard(self.takenlists, self.takenkeys, expiry, job)
+        try: self.leasing.remove(job)
         except: pass
       except: pass
       
       
-  def get_job(self, worker, expiry_min_ahead, async = False):
+  @staticmethod
+  def _insert(lists, keys, expiry, job):
+    bucket = lists.get(expiry)
+    if bucket is None:
+      bucket = lists[expiry] = OrderedSet()
+      insort(keys, expiry)
+    bucket.add(job)
+    
+    
+  @staticmethod
+  def _discard(lists, keys, expiry, job):
+    bucket = lists.get(expiry)
+    if bucket is None or not bucket.discard(job): return False
+    if not bucket:
+      del lists[expiry]
+      del keys[bisect_left(keys, expiry)]
+    return True
+    
+    
+  @staticmethod
+  def _pop_bucket(lists, keys, index):
+    expiry = keys[index]
+    bucket = lists[expiry]
+    job = bucket.pop(False)
+    if not bucket:
+      del lists[expiry]
+      del keys[index]
+    return job
+      
+      
+  # If nonces is specified, a lease of that many nonces of a job will be returned instead of a whole job.
+  # Leases are handed out from the same job until it is exhausted, so that several workers can share it.
+  def get_job(self, worker, expiry_min_ahead, nonblocking = False, nonces = None):
+    cache = None if nonces else self._get_cache(worker)
+    if cache:
+      job, stale = cache.get_job(monotonic() + expiry_min_ahead)
+      for stalejob in stale: stalejob.destroy()
+      if job:
+        job.set_worker(worker)
+        return job
     with self.lock:
       while True:
+        if nonces:
+          job = self._get_range_internal(worker, expiry_min_ahead, nonces)
+          if job: break
         job = self._get_job_internal(expiry_min_ahead)
         if job:
-          job.set_worker(worker)
           expiry = int(job.expiry)
-          if int(job.expiry) <= self.expirycutoff: self.count += 1
-          if not expiry in self.takenlists: self.takenlists[expiry] = [job]
-          else: self.takenlists[expiry].append(job)
+          if expiry <= self.expirycutoff: self.count += 1
+          if cache:
+            self._fill_cache(cache, job, expiry_min_ahead)
+            job.set_worker(worker)
+          elif not nonces:
+            self._insert(self.takenlists, self.takenkeys, expiry, job)
+            job.set_worker(worker)
+          else:
+            self._insert(self.takenlists, self.takenkeys, expiry, job)
+            self.leasing.append(job)
+            job = self._lease_range(job, worker, nonces)
           break
-        elif async: return None
+        elif nonblocking: return None
+        self.starved += 1
         self.lock.release()
         with self.core.fetcher.lock:
           self.lock.acquire()
@@ -145,26 +294,76 @@ class WorkQueue(Startable):
     return job
 
 
+  # Workers that are part of a group (children of another worker) share a job cache.
+  # Workers without a parent or groups with a single child fetch directly from the queue.
+  def _get_cache(self, worker):
+    while getattr(worker, "parent", None): worker = worker.parent
+    size = min(self.cachesize, len(getattr(worker, "children", ())))
+    if size < 2: return None
+    cache = self.caches.get(worker)
+    if not cache:
+      with self.lock:
+        cache = self.caches.get(worker)
+        if not cache: cache = self.caches[worker] = JobCache(size)
+    return cache
+    
+    
+  # Reserves more jobs for a worker group along with the one that it just took.
+  # Must be called with the work queue lock held.
+  def _fill_cache(self, cache, job, expiry_min_ahead):
+    with cache.lock:
+      cache.taken.add(job)
+      while len(cache.jobs) < cache.size - 1:
+        extra = self._get_job_internal(expiry_min_ahead)
+        if not extra: break
+        if int(extra.expiry) <= self.expirycutoff: self.count += 1
+        cache.jobs.add(extra)
+        
+        
+  def get_lock_statistics(self):
+    with self.lock:
+      lock = self.rawlock
+      stats = Bunch(acquisitions = lock.acquisitions, contentions = lock.contentions, waittime = lock.waittime,
+                    cachehits = 0, cachemisses = 0, cachedjobs = 0)
+      for cache in self.caches.values():
+        stats.cachehits += cache.hits
+        stats.cachemisses += cache.misses
+        stats.cachedjobs += len(cache.jobs)
+    return stats
+
+
+  def _get_range_internal(self, worker, expiry_min_ahead, nonces):
+    min_expiry = monotonic() + expiry_min_ahead
+    for job in self.leasing:
+      if job.expiry > min_expiry and not job.canceled: return self._lease_range(job, worker, nonces)
+    return None
+
+
+  def _lease_range(self, job, worker, nonces):
+    range = job.lease_range(worker, nonces)
+    if job.nextnonce >= 2**32: self.leasing.remove(job)
+    return range
+
+
   def _get_job_internal(self, expiry_min_ahead):
-    keys = sorted(self.lists.keys())
-    min_expiry = time.time() + expiry_min_ahead
+    # There were no jobs at all
+    if not self.keys: return None
+    min_expiry = monotonic() + expiry_min_ahead
     # Look for a job that meets min_expiry as closely as possible
-    for expiry in keys:
-      if expiry <= min_expiry: continue
-      list = self.lists[expiry]
-      if not list: continue
-      self.count -= 1
-      return list.pop(0)
+    index = bisect_right(self.keys, min_expiry)
     # If there was none, look for the job with the latest expiry
-    keys.reverse()
-    for expiry in keys:
-      if expiry > min_expiry: continue
-      list = self.lists[expiry]
-      if not list: continue
-      self.count -= 1
-      return list.pop(0)
-    # There were no jobs at all
-    return None
+    if index == len(self.keys): index -= 1
+    expiry = self.keys[index]
+    self.count -= 1
+    self.counts[expiry] -= 1
+    self.jobstaken += 1
+    for job in self.lists[expiry]:
+      # Templates stay queued until their last job was created
+      if isinstance(job, JobTemplate): return job.mint()
+      break
+    job = self._pop_bucket(self.lists, self.keys, index)
+    if not expiry in self.lists: del self.counts[expiry]
+    return job
 
         
   def _start(self):
@@ -179,7 +378,9 @@ class WorkQueue(Startable):
   
   
   def _stop(self):
-    self.shutdown = True
+    with self.lock:
+      self.shutdown = True
+      self.cleanupwakeup.notify()
     self.cleanupthread.join(5)
     self.cancelqueue.put(None)
     self.cancelthread.join(5)
@@ -187,35 +388,123 @@ class WorkQueue(Startable):
     super(WorkQueue, self)._stop()
 
     
+  # Sleeps until the next expiry bucket gets close to expiry (and stops counting towards the queue level)
+  # or expires, rather than polling. Taken jobs are canceled as soon as their bucket expires.
   def _cleanuploop(self):
     while not self.shutdown:
-      now = time.time()
       cancel = []
       with self.lock:
-        keys = sorted(self.lists.keys())
-        cutoff = now + 10
-        for expiry in keys:
-          if expiry > cutoff: break
-          if expiry > self.expirycutoff and expiry <= cutoff: self.count -= len(self.lists[expiry])
-          if expiry <= now:
-            while self.lists[expiry]: self.lists[expiry].pop(0).destroy()
-            del self.lists[expiry]
+        self.cleanuprequested = False
+        now = monotonic()
+        cutoff = now + self.cutoffahead
+        counted = self.count
+        for expiry in self.keys[bisect_right(self.keys, self.expirycutoff) : bisect_right(self.keys, cutoff)]:
+          self.count -= self.counts[expiry]
         self.expirycutoff = cutoff
-        keys = sorted(self.takenlists.keys())
-        for expiry in keys:
-          if expiry <= now:
-            while self.takenlists[expiry]: cancel.append(self.takenlists[expiry].pop(0))
-            del self.takenlists[expiry]
-      self.core.fetcher.wakeup()
+        expired = bisect_right(self.keys, now)
+        for expiry in self.keys[:expired]:
+          bucket = self.lists.pop(expiry)
+          self.jobsexpired += self.counts.pop(expiry)
+          while bucket: self._expire(bucket.pop(False))
+        del self.keys[:expired]
+        expired = bisect_right(self.takenkeys, now)
+        for expiry in self.takenkeys[:expired]: cancel.extend(self.takenlists.pop(expiry))
+        del self.takenkeys[:expired]
+        caches = list(self.caches.values())
+        for cache in caches:
+          expired, taken = cache.cleanup(now)
+          for job in expired:
+            if not job.destroyed:
+              self.jobsexpired += job.jobcount
+              self._expire(job)
+          cancel.extend(job for job in taken if not job.destroyed)
+        changed = self.count != counted or cancel
+      if changed: self.core.fetcher.wakeup()
       self.cancel_jobs(cancel)
-      time.sleep(1)
+      with self.lock:
+        if self.shutdown or self.cleanuprequested: continue
+        self.nextcleanup = self._get_next_cleanup()
+        if self.nextcleanup is None: self.cleanupwakeup.wait()
+        else: self.cleanupwakeup.wait(max(0, self.nextcleanup - monotonic()))
+        
+        
+  def _expire(self, job):
+    job.worksource.add_wasted_jobs(job.jobcount)
+    job.destroy()
+    
+    
+  # Returns the time at which the cleanup thread has something to do next. Must be called with the work queue lock held.
+  def _get_next_cleanup(self):
+    times = []
+    if self.keys: times.append(self.keys[0])
+    index = bisect_right(self.keys, self.expirycutoff)
+    if index < len(self.keys): times.append(self.keys[index] - self.cutoffahead)
+    if self.takenkeys: times.append(self.takenkeys[0])
+    for cache in self.caches.values():
+      expiry = cache.get_next_expiry()
+      if expiry is not None: times.append(expiry)
+    return min(times) if times else None
 
   
+  # Hands the jobs of each cancellation batch to one thread per worker, so that a slow worker doesn't delay the others.
+  # Jobs that are already waiting to be canceled are only canceled once.
   def _cancelloop(self):
     while True:
       data = self.cancelqueue.get()
       if not data: return
-      jobs, graceful = data
-      for job in jobs:
-        try: job.cancel(graceful)
-        except: self.core.log(self.core, "Error while canceling job: %s\n" % traceback.format_exc(), 100, "r")
+      jobs, graceful, callback = data
+      batch = Bunch(starttime = monotonic(), pending = 1, callback = callback)
+      idle = []
+      with self.cancellock:
+        for job in jobs:
+          # The nonce ranges that were leased from a job are canceled by the threads of the workers that have them
+          leases = list(job.ranges)
+          for lease in leases: self._queue_cancel(lease.worker, lease, graceful, batch)
+          # Jobs without a worker don't need to notify anyone, cancel them right away
+          if job.worker: self._queue_cancel(job.worker, job, graceful, batch)
+          else: idle.append((job, leases))
+      for job, leases in idle: self._cancel_job(job, graceful, leases)
+      self._cancel_done(batch)
+
+
+  # Queues a job to be canceled by the thread of worker as part of batch. Must be called with the cancel lock held.
+  def _queue_cancel(self, worker, job, graceful, batch):
+    pending = self.cancelpending.get(worker)
+    if pending is None: pending = self.cancelpending[worker] = {}
+    entry = pending.get(job)
+    if entry:
+      entry[0] = entry[0] and graceful
+      entry[1].append(batch)
+    else: pending[job] = [graceful, [batch]]
+    batch.pending += 1
+    if not worker in self.cancelthreads:
+      self.cancelthreads.add(worker)
+      thread = Thread(None, self._cancelworkerloop, "workqueue_cancelworker", (worker,))
+      thread.daemon = True
+      thread.start()
+      
+      
+  def _cancelworkerloop(self, worker):
+    while True:
+      with self.cancellock:
+        pending = self.cancelpending.pop(worker, None)
+        if not pending:
+          self.cancelthreads.discard(worker)
+          return
+      for job, (graceful, batches) in pending.items():
+        self._cancel_job(job, graceful)
+        for batch in batches: self._cancel_done(batch)
+          
+          
+  def _cancel_job(self, job, graceful, skipranges = ()):
+    try:
+      if skipranges: job.cancel(graceful, skipranges)
+      else: job.cancel(graceful)
+    except: self.core.log(self.core, "Error while canceling job: %s\n" % traceback.format_exc(), 100, "r")
+    
+    
+  def _cancel_done(self, batch):
+    with self.cancellock:
+      batch.pending -= 1
+      if batch.pending: return
+    if batch.callback: batch.callback(monotonic() - batch.starttime)
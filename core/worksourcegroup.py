@@ -159,6 +159,21 @@ class WorkSourceGroup(BaseWorkSource):
               mhashes_remaining -= mhashes
 
 
+  # The slowest child determines how long it might take until new jobs arrive
+  def get_fetch_latency(self):
+    with self.childlock:
+      latencies = [child.get_fetch_latency() for child in self.children if child.settings.enabled]
+    latencies = [latency for latency in latencies if latency is not None]
+    return max(latencies) if latencies else None
+    
+    
+  def get_job_expiry(self):
+    with self.childlock:
+      expiries = [child.get_job_expiry() for child in self.children if child.settings.enabled]
+    expiries = [expiry for expiry in expiries if expiry is not None]
+    return min(expiries) if expiries else None
+
+
   def _get_start_index(self):
     with self.statelock:
       self.last_index += 1
@@ -0,0 +1,3 @@
+from .cpuminer import DemoCPUWorker
+
+workerclasses = [DemoCPUWorker]
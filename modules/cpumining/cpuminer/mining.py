@@ -1,67 +1,168 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+"""mining.py
+
+Nonce scanning kernels for the cpu-based worker
+
+These functions run inside the worker's process pool, so they must only
+take and return picklable values (bytes and integers). All kernels share
+the same signature and result format, see scan_python.
+"""
+
+import time
 import struct
-import binascii
 from hashlib import sha256
+from core.job import Job
+from core.sha256 import SHA256
+try: import numpy
+except ImportError: numpy = None
+
+
+# Shared job generation counter, set up by init() in every pool process.
+# The worker bumps it to make all running scans return early.
+generation = None
+
+# Number of nonces between two checks of the generation counter
+abort_granularity = 4096
+
+
+def init(shared_generation):
+    """Pool process initializer"""
+    global generation
+    generation = shared_generation
+
+
+def scan_python(data, start, count, jobgeneration = None):
+    """Hashes the nonces start ... start + count - 1 of a job
+
+    data is the (word-swapped) getwork data of the job. Returns a tuple of
+    the number of hashes calculated, the time that took and the list of
+    nonce values whose hash ends with 32 zero bits (H == 0). Stops early
+    if the shared generation counter no longer matches jobgeneration.
+    """
+    starttime = time.time()
+
+    # Swap the header into hashing byte order once, and precompute the
+    # hash state after the first 64 bytes (the midstate). Every nonce
+    # then only needs the 16 byte tail and the second hash.
+    header = struct.pack("<20I", *struct.unpack(">20I", data[:80]))
+    midstate = sha256(header[:64])
+    tail = header[64:76]
+    pack = struct.Struct(">I").pack
+
+    found = []
+    nonce = start
+    end = start + count
+    while nonce < end:
+        if generation is not None and generation.value != jobgeneration:
+            break
+        sliceend = min(end, nonce + abort_granularity)
+        for value in range(nonce, sliceend):
+            hash = midstate.copy()
+            hash.update(tail + pack(value))
+            if sha256(hash.digest()).digest()[-4:] == b"\0\0\0\0":
+                found.append(value)
+        nonce = sliceend
+    return nonce - start, time.time() - starttime, found
+
+
+# Nonces per vector when running the NumPy kernel
+numpy_lanes = 32768
+
+
+def _rotr(x, y):
+    return (x >> numpy.uint32(y)) | (x << numpy.uint32(32 - y))
+
+
+def _rounds(state, w, rounds):
+    """Runs the first rounds of the SHA256 compression function
+
+    state is a list of 8 words and w a list of 16 message words, each of them
+    either a numpy.uint32 scalar or a uint32 vector. Returns the working
+    variables a ... h after the given number of rounds (without adding the
+    initial state, so that callers can stop early).
+    """
+    k = _rounds.k
+    w = list(w)
+    for i in range(16, rounds):
+        s0 = _rotr(w[i - 15], 7) ^ _rotr(w[i - 15], 18) ^ (w[i - 15] >> numpy.uint32(3))
+        s1 = _rotr(w[i - 2], 17) ^ _rotr(w[i - 2], 19) ^ (w[i - 2] >> numpy.uint32(10))
+        w.append(w[i - 16] + s0 + w[i - 7] + s1)
+    a, b, c, d, e, f, g, h = state
+    for i in range(rounds):
+        # Ch and Maj in forms that need one vector operation less each
+        t1 = h + (_rotr(e, 6) ^ _rotr(e, 11) ^ _rotr(e, 25)) + (g ^ (e & (f ^ g))) + k[i] + w[i]
+        t2 = (_rotr(a, 2) ^ _rotr(a, 13) ^ _rotr(a, 22)) + ((a & b) | (c & (a | b)))
+        h, g, f, e, d, c, b, a = g, f, e, d + t1, c, b, a, t1 + t2
+    return [a, b, c, d, e, f, g, h]
+
+
+def scan_numpy(data, start, count, jobgeneration = None):
+    """NumPy version of scan_python
+
+    Evaluates numpy_lanes nonces at once as uint32 vectors, starting from
+    the job's midstate. The second hash stops after round 61: the last
+    state word only depends on e at that point, so nonces with H != 0 can
+    be rejected 3 rounds early. The few remaining candidates are verified
+    with Job.calculate_hash.
+    """
+    starttime = time.time()
+    if not hasattr(_rounds, "k"):
+        _rounds.k = [numpy.uint32(k) for k in SHA256._k]
+    iv = [numpy.uint32(x) for x in SHA256().state]
+
+    # Reading getwork data as little endian words yields the message words
+    midstate = [numpy.uint32(x) for x in struct.unpack("<8I", Job.calculate_midstate(data))]
+    tail = [numpy.uint32(x) for x in struct.unpack("<3I", data[64:76])]
+    padding1 = [numpy.uint32(0x80000000)] + [numpy.uint32(0)] * 10 + [numpy.uint32(640)]
+    padding2 = [numpy.uint32(0x80000000)] + [numpy.uint32(0)] * 6 + [numpy.uint32(256)]
+    target = numpy.uint32(-int(iv[7]) & 0xffffffff)
+
+    found = []
+    nonce = start
+    end = start + count
+    with numpy.errstate(over = "ignore"):
+        while nonce < end:
+            if generation is not None and generation.value != jobgeneration:
+                break
+            sliceend = min(end, nonce + numpy_lanes)
+            nonces = numpy.arange(nonce, sliceend, dtype = numpy.uint64).astype(numpy.uint32)
+
+            # First hash: second block of the header, starting from the midstate
+            hash1 = _rounds(midstate, tail + [nonces] + padding1, 64)
+            hash1 = [x + y for x, y in zip(midstate, hash1)]
+
+            # Second hash: h after round 64 equals e after round 61
+            hash2 = _rounds(iv, hash1 + padding2, 61)
+            for index in numpy.nonzero(hash2[4] == target)[0]:
+                value = int(nonces[index])
+                candidate = data[:76] + struct.pack("<I", value) + data[80:]
+                if Job.calculate_hash(candidate)[-4:] == b"\0\0\0\0":
+                    found.append(value)
+            nonce = sliceend
+    return nonce - start, time.time() - starttime, found
 
 
-def calculate_hash(data, debug=True):
-    bige_data = struct.unpack(">20I", data[:80])
-    header_bin = struct.pack("<20I", *bige_data)
-    
-    if debug:
-        print "hashing:", header_bin.encode("hex")
-    
-    return sha256(sha256(header_bin).digest()).digest()
-
-
-if __name__ == "__main__":
-    data = binascii.unhexlify(b"00000001c3bf95208a646ee98a"+\
-                                "58cf97c3a0c4b7bf5de4c89ca"+\
-                                "04495000005200000000024d1"+\
-                                "fff8d5d73ae11140e4e48032c"+\
-                                "d88ee01d48c67147f9a09cd41"+\
-                                "fdec2e25824f5c038d1a0b350c5eb01f04")
-    
-    # some data from block 64
-    # -----------------------
-    exp_hash = "0000000031975f17c5642a9c7e53ae4201a70a6ba6363036b55497b8754d1866"
-    version = 1
-    prev_block = "00000000ebff91c88984bff39511f544a1c4ef6ec4f33e2ea531e47c2685628e"
-    mrkl_root =  "ebdb8335d5b148e9cc1b1bb795ee619a649bd1638e5514fdfc3004b1c56fd6a4"
-    time = 1231624107
-    bits = 486604799
-    nonce = 82803279
-    
-    print "len(prev_block):",len(prev_block)
-    
-    # create a hex version of this header
-    hex_hdr = "%8x" % version +\
-                prev_block[::-1] +\
-                mrkl_root[::-1] +\
-                b"%8x%8x%8x" % (time, bits, nonce)
-    
-    hex_hdr = hex_hdr.replace(" ","0")
-    
-    print "hex_hdr:", hex_hdr
-    
-    # create a binary version of that hex header
-    data = binascii.unhexlify(hex_hdr)
-    
-    
-    target = ("00000000FFFF0000000000000000000000000000000"+\
-                "000000000000000000000").decode("hex")
-                
-    print "target:",target.encode("hex")
-    
-    print "starting with %d bytes" % len(data)
-    
-    print "hashing..."
-    
-    hash_val = calculate_hash(data)
-    
-    print "value:    ",hash_val.encode("hex")[::-1]
-    print "expecting:",exp_hash
-    
-    if hash_val[::-1] > target:
-        print "hash didn't meet difficulty"
-    else:
-        print "hash was a block solution"
\ No newline at end of file
+# Available kernels by name, as (function, minimum work unit size) tuples
+kernels = {"python": (scan_python, abort_granularity)}
+if numpy: kernels["numpy"] = (scan_numpy, numpy_lanes)
@@ -0,0 +1,224 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+####################################################
+# HTTP connection pools for BCJSONRPC work sources #
+####################################################
+
+
+
+import socket
+from heapq import heappush
+from threading import RLock, Condition
+from core.util import monotonic
+try: import http.client as http_client
+except ImportError: import httplib as http_client
+
+
+
+# Request priorities, lower values are served first
+PRIORITY_UPLOAD = 0
+PRIORITY_GETWORK = 1
+
+
+
+# Raised if no pooled connection became available in time. That only means that the other
+# users of the pool kept all connections busy, not that something is wrong with the server.
+class PoolTimeout(Exception): pass
+
+
+
+# An HTTP connection that connects to the address that its pool resolved
+class PooledHTTPConnection(http_client.HTTPConnection):
+
+  def __init__(self, pool, timeout):
+    http_client.HTTPConnection.__init__(self, pool.host, pool.port, timeout = timeout)
+    self.pool = pool
+    self.lastused = monotonic()
+
+
+  def connect(self):
+    try: self.sock = socket.create_connection(self.pool.resolve(), self.timeout)
+    except:
+      # The server might have moved
+      self.pool.forget_address()
+      raise
+    # Headers and body are sent separately, which would otherwise be delayed until the server acknowledges
+    # the headers on keep-alive connections (which it only does after its delayed ACK timeout)
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+
+# Keep-alive connections to one HTTP server, shared by all work sources that use it.
+# Every user sets how many connections it wants, the pool opens at most the largest of these
+# at once. Some of them can be reserved for uploads, which job fetches may not use.
+# If all connections are busy, waiting requests are served in priority order.
+class HTTPConnectionPool(object):
+
+  # Seconds that a resolved address is used before resolving the host name again
+  dnscachetime = 300
+  # Seconds that an idle connection is kept open
+  idletime = 60
+
+
+  def __init__(self, host, port):
+    self.host = host
+    self.port = port
+    self.lock = Condition()
+    self.limits = {}
+    self.limit = 0
+    self.reserved = 0
+    self.busy = 0
+    self.idle = []
+    self.waiters = []
+    self.waiterseq = 0
+    self.address = None
+    self.addresstime = 0
+    self.connectionsopened = 0
+
+
+  # Sets the number of connections that user wants and how many of them are reserved for uploads.
+  # A limit of 0 removes the user from the pool.
+  def set_limit(self, user, limit, reserved = 0):
+    with self.lock:
+      if limit: self.limits[user] = (limit, reserved)
+      else: self.limits.pop(user, None)
+      self.limit = max(limit for limit, reserved in self.limits.values()) if self.limits else 0
+      self.reserved = max(reserved for limit, reserved in self.limits.values()) if self.limits else 0
+      if not self.limits: self._close_idle(0)
+      self.lock.notify_all()
+
+
+  # Returns the (host, port) address to connect to, resolving the host name if the cached one is too old
+  def resolve(self):
+    with self.lock:
+      if self.address and monotonic() - self.addresstime < self.dnscachetime: return self.address
+    address = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)[0][4][:2]
+    with self.lock:
+      self.address = address
+      self.addresstime = monotonic()
+    return address
+
+
+  def forget_address(self):
+    with self.lock: self.address = None
+
+
+  # Called with the lock held, closes connections that were idle for more than maxidle seconds
+  def _close_idle(self, maxidle):
+    now = monotonic()
+    for conn in [conn for conn in self.idle if now - conn.lastused >= maxidle]:
+      self.idle.remove(conn)
+      conn.close()
+
+
+  # Waits until a connection may be used, returns a keep-alive connection or a new one.
+  # Raises PoolTimeout if no connection became available within timeout seconds.
+  def acquire(self, priority, timeout):
+    deadline = monotonic() + timeout
+    with self.lock:
+      self.waiterseq += 1
+      waiter = (priority, self.waiterseq)
+      heappush(self.waiters, waiter)
+      limit = self.limit if priority == PRIORITY_UPLOAD else self.limit - self.reserved
+      try:
+        while self.waiters[0] != waiter or self.busy >= limit:
+          remaining = deadline - monotonic()
+          if remaining <= 0: raise PoolTimeout("Timed out waiting for a connection to %s:%d" % (self.host, self.port))
+          self.lock.wait(remaining)
+          limit = self.limit if priority == PRIORITY_UPLOAD else self.limit - self.reserved
+      finally:
+        self.waiters.remove(waiter)
+        self.waiters.sort()
+        # The next waiter might be allowed to go ahead as well
+        self.lock.notify_all()
+      self.busy += 1
+      self._close_idle(self.idletime)
+      # The most recently used connection is the least likely to have been closed by the server
+      if self.idle: conn = self.idle.pop()
+      else:
+        conn = PooledHTTPConnection(self, timeout)
+        self.connectionsopened += 1
+    conn.timeout = timeout
+    if conn.sock: conn.sock.settimeout(timeout)
+    return conn
+
+
+  # Hands a connection back. It is kept open for later requests if reuse is true.
+  def release(self, conn, reuse):
+    with self.lock:
+      self.busy -= 1
+      if reuse and self.busy + len(self.idle) < self.limit:
+        conn.lastused = monotonic()
+        self.idle.append(conn)
+      else: conn.close()
+      self.lock.notify_all()
+
+
+  # Sends a request on a connection from acquire(), returns the response and its body.
+  # The connection is handed back afterwards, even if the request failed.
+  # If a keep-alive connection turns out to be dead before the server got the request, it is retried once on a new one.
+  # It isn't retried if it might have been processed already (e.g. after a timeout), that could submit a share twice.
+  def request(self, conn, method, path, body, headers):
+    reused = conn.sock is not None
+    try:
+      try: conn.request(method, path, body, headers)
+      except socket.error:
+        if not reused: raise
+        conn.close()
+        reused = False
+        conn.request(method, path, body, headers)
+      try: response = conn.getresponse()
+      except Exception as e:
+        if not reused or not _closed_without_response(e): raise
+        conn.close()
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+      data = response.read()
+    except:
+      self.release(conn, False)
+      raise
+    self.release(conn, not response.will_close)
+    return response, data
+
+
+
+# Returns whether the server closed a keep-alive connection without sending a single byte of a response.
+# Servers do that if the connection was idle for too long, before they read the request.
+def _closed_without_response(e):
+  if isinstance(e, getattr(http_client, "RemoteDisconnected", ())): return True
+  return isinstance(e, http_client.BadStatusLine) and e.line in ("", "''")
+
+
+
+pools = {}
+poolslock = RLock()
+
+
+# Returns the pool for host:port, all work sources that use the same server share it
+def get_pool(host, port):
+  with poolslock:
+    pool = pools.get((host, port))
+    if not pool:
+      pool = HTTPConnectionPool(host, port)
+      pools[(host, port)] = pool
+    return pool
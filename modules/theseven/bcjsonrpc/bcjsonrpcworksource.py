@@ -28,15 +28,16 @@
 
 import time
 import json
-import struct
 import base64
 import traceback
 from binascii import hexlify, unhexlify
-from threading import Thread, RLock, Condition
+from threading import Thread, RLock, Condition, current_thread
 from core.actualworksource import ActualWorkSource
-from core.job import Job
-try: from queue import Queue
-except: from Queue import Queue
+from core.util import monotonic, LatencyHistogram
+from core.job import Job, JobTemplate
+from .bcjsonrpcpool import get_pool, PoolTimeout, PRIORITY_GETWORK, PRIORITY_UPLOAD
+try: from queue import Queue, Empty
+except: from Queue import Queue, Empty
 try: import http.client as http_client
 except ImportError: import httplib as http_client
 
@@ -58,21 +59,30 @@ class BCJSONRPCWorkSource(ActualWorkSource):
     "password": {"title": "Password", "type": "password", "position": 1120},
     "useragent": {"title": "User agent string", "type": "string", "position": 1200},
     "getworkconnections": {"title": "Job fetching connnections", "type": "int", "position": 1300},
+    "autotune": {"title": "Tune connection counts automatically (up to the configured ones)", "type": "boolean", "position": 1350},
     "uploadconnections": {"title": "Share upload connnections", "type": "int", "position": 1400},
     "longpollconnections": {"title": "Long poll connnections", "type": "int", "position": 1500},
     "expirymargin": {"title": "Job expiry safety margin", "type": "int", "position": 1600},
   })
+  # Seconds that a connection needs to be idle before the auto tuner closes it
+  idletime = 60
   
 
   def __init__(self, core, state = None):
     self.fetcherlock = Condition()
     self.fetcherthreads = []
+    self.fetchertarget = 0
     self.fetchersrunning = 0
     self.fetcherspending = 0
     self.fetcherjobsrunning = 0
     self.fetcherjobspending = 0
     self.uploadqueue = Queue()
+    self.uploaderlock = RLock()
     self.uploaderthreads = []
+    self.uploadertarget = 0
+    self.uploadersbusy = 0
+    self.longpollendpoint = None
+    self.pool = None
     super(BCJSONRPCWorkSource, self).__init__(core, state)
     self.extensions = "longpoll midstate rollntime"
     self.runcycle = 0
@@ -104,11 +114,23 @@ class BCJSONRPCWorkSource(ActualWorkSource):
     if self.settings.useragent: self.useragent = self.settings.useragent
     else: self.useragent = "%s (%s)" % (self.core.__class__.version, self.__class__.version)
     if not "getworkconnections" in self.settings: self.settings.getworkconnections = 1
-    if self.started and self.settings.getworkconnections != self.getworkconnections: self.async_restart()
+    if not "autotune" in self.settings: self.settings.autotune = False
     if not "uploadconnections" in self.settings: self.settings.uploadconnections = 1
-    if self.started and self.settings.uploadconnections != self.uploadconnections: self.async_restart()
     if not "longpollconnections" in self.settings: self.settings.longpollconnections = 1
-    if self.started and self.settings.longpollconnections != self.longpollconnections: self.async_restart()
+    # Connection counts can be changed without restarting. A work source that isn't connected to a server
+    # or that is about to restart because the server changed gets the new counts when it starts.
+    if self.started and self.pool and self.settings.host == self.host and self.settings.port == self.port:
+      self.pool.set_limit(self, self.settings.getworkconnections + self.settings.uploadconnections, self.settings.uploadconnections)
+      if self.settings.autotune:
+        self._set_fetcher_count(min(self.fetchertarget, self.settings.getworkconnections))
+        self._set_uploader_count(min(self.uploadertarget, self.settings.uploadconnections))
+      else:
+        self._set_fetcher_count(self.settings.getworkconnections)
+        self._set_uploader_count(self.settings.uploadconnections)
+      if self.settings.longpollconnections != self.longpollconnections:
+        self.longpollconnections = self.settings.longpollconnections
+        self.runcycle += 1
+        if self.longpollendpoint: self._start_longpolling(*self.longpollendpoint)
     if not "expirymargin" in self.settings: self.settings.expirymargin = 5
 
     
@@ -121,47 +143,78 @@ class BCJSONRPCWorkSource(ActualWorkSource):
     self.fetcherjobsrunning = 0
     self.fetcherjobspending = 0
     self.fetcherthreads = []
+    self.fetchertarget = 0
     self.uploadqueue = Queue()
     self.uploaderthreads = []
+    self.uploadertarget = 0
+    self.uploadersbusy = 0
+    self.longpollendpoint = None
     self.lastidentifier = None
     self.jobepoch = 0
     self.lpepoch = 0
+    self.getworklatency = LatencyHistogram()
+    self.uploadlatency = LatencyHistogram()
+    self.longpolllatency = LatencyHistogram()
     
     
   def _start(self):
     super(BCJSONRPCWorkSource, self)._start()
     self.host = self.settings.host
     self.port = self.settings.port
-    self.getworkconnections = self.settings.getworkconnections
-    self.uploadconnections = self.settings.uploadconnections
     self.longpollconnections = self.settings.longpollconnections
     if not self.settings.host or not self.settings.port: return
     self.shutdown = False
-    for i in range(self.getworkconnections):
-      thread = Thread(None, self.fetcher, "%s_fetcher_%d" % (self.settings.name, i))
-      thread.daemon = True
-      thread.start()
-      self.fetcherthreads.append(thread)
-    for i in range(self.uploadconnections):
-      thread = Thread(None, self.uploader, "%s_uploader_%d" % (self.settings.name, i))
-      thread.daemon = True
-      thread.start()
-      self.uploaderthreads.append(thread)
+    # Fetchers and uploaders of all work sources that use the same server share its connections
+    self.pool = get_pool(self.host, self.port)
+    self.pool.set_limit(self, self.settings.getworkconnections + self.settings.uploadconnections, self.settings.uploadconnections)
+    # The auto tuner starts out with a single connection of each kind
+    self._set_fetcher_count(1 if self.settings.autotune else self.settings.getworkconnections)
+    self._set_uploader_count(1 if self.settings.autotune else self.settings.uploadconnections)
+    
+    
+  # Starts or stops fetcher threads. Threads that are no longer needed exit once they are idle.
+  def _set_fetcher_count(self, count):
+    with self.fetcherlock:
+      self.fetchertarget = count
+      while len(self.fetcherthreads) < count:
+        thread = Thread(None, self.fetcher, "%s_fetcher_%d" % (self.settings.name, len(self.fetcherthreads)))
+        thread.daemon = True
+        self.fetcherthreads.append(thread)
+        thread.start()
+      if len(self.fetcherthreads) > count: self.fetcherlock.notify_all()
+      
+      
+  def _set_uploader_count(self, count):
+    with self.uploaderlock:
+      self.uploadertarget = count
+      while len(self.uploaderthreads) < count:
+        thread = Thread(None, self.uploader, "%s_uploader_%d" % (self.settings.name, len(self.uploaderthreads)))
+        thread.daemon = True
+        self.uploaderthreads.append(thread)
+        thread.start()
+      for i in range(len(self.uploaderthreads) - count): self.uploadqueue.put(None)
     
     
   def _stop(self):
     self.runcycle += 1
     self.shutdown = True
     with self.fetcherlock: self.fetcherlock.notify_all()
-    for thread in self.fetcherthreads: thread.join(1)
+    for thread in list(self.fetcherthreads): thread.join(1)
     for i in self.uploaderthreads: self.uploadqueue.put(None)
-    for thread in self.uploaderthreads: thread.join(1)
+    for thread in list(self.uploaderthreads): thread.join(1)
+    if self.pool: self.pool.set_limit(self, 0)
+    self.pool = None
     super(BCJSONRPCWorkSource, self)._stop()
     
     
   def _get_statistics(self, stats, childstats):
     super(BCJSONRPCWorkSource, self)._get_statistics(stats, childstats)
     stats.supports_rollntime = self.stats.supports_rollntime
+    stats.getworkconnections = len(self.fetcherthreads)
+    stats.uploadconnections = len(self.uploaderthreads)
+    stats.getwork_latency = self.getworklatency.get_statistics()
+    stats.upload_latency = self.uploadlatency.get_statistics()
+    stats.longpoll_latency = self.longpolllatency.get_statistics()
     
   
   def _get_running_fetcher_count(self):
@@ -172,7 +225,12 @@ class BCJSONRPCWorkSource(ActualWorkSource):
     count = len(self.fetcherthreads)
     if not count: return False, 0
     with self.fetcherlock:
-      if self.fetchersrunning >= count: return 0, 0
+      if self.fetchersrunning >= count:
+        # All connections are busy, but more jobs are needed
+        if self.settings.autotune and count < self.settings.getworkconnections:
+          self.core.log(self, "Opening another job fetching connection\n", 500)
+          self._set_fetcher_count(count + 1)
+        return 0, 0
       self.fetcherjobspending += self.estimated_jobs
       self.fetchersrunning += 1
       self.fetcherspending += 1
@@ -181,12 +239,19 @@ class BCJSONRPCWorkSource(ActualWorkSource):
 
 
   def fetcher(self):
-    conn = None
     while not self.shutdown:
       with self.fetcherlock:
         while not self.fetcherspending:
-          self.fetcherlock.wait()
+          starttime = monotonic()
+          self.fetcherlock.wait(self.idletime if self.settings.autotune else None)
           if self.shutdown: return
+          if self.fetcherspending: break
+          # Let the auto tuner close connections that weren't used for a while
+          if self.settings.autotune and monotonic() - starttime >= self.idletime and self.fetchertarget > 1:
+            self.fetchertarget -= 1
+          if len(self.fetcherthreads) > self.fetchertarget:
+            self.fetcherthreads.remove(current_thread())
+            return
         self.fetcherspending -= 1
         myjobs = self.estimated_jobs
         self.fetcherjobsrunning += myjobs
@@ -198,27 +263,17 @@ class BCJSONRPCWorkSource(ActualWorkSource):
         headers = {"User-Agent": self.useragent, "X-Mining-Extensions": self.extensions,
                    "Content-Type": "application/json", "Content-Length": len(req), "Connection": "Keep-Alive"}
         if self.auth != None: headers["Authorization"] = self.auth
+        conn = self._acquire_connection(PRIORITY_GETWORK, self.settings.getworktimeout)
         try:
-          if conn:
-            try:
-              epoch = self.jobepoch
-              now = time.time()
-              conn.request("POST", self.settings.path, req, headers)
-              conn.sock.settimeout(self.settings.getworktimeout)
-              response = conn.getresponse()
-            except:
-              conn = None
-              self.core.log(self, "Keep-alive job fetching connection died\n", 500)
-          if not conn:
-            conn = http_client.HTTPConnection(self.settings.host, self.settings.port, True, self.settings.getworktimeout)
-            epoch = self.jobepoch
-            now = time.time()
-            conn.request("POST", self.settings.path, req, headers)
-            conn.sock.settimeout(self.settings.getworktimeout)
-            response = conn.getresponse()
-          data = response.read()
+          # Time spent waiting for a pooled connection doesn't count towards the latency of the server
+          epoch = self.jobepoch
+          now = monotonic()
+          response, data = self.pool.request(conn, "POST", self.settings.path, req, headers)
+          latency = monotonic() - now
+          self._handle_fetch_latency(latency)
+          self.getworklatency.add(latency)
         except:
-          conn = None
+          self.getworklatency.add_error()
           raise
         with self.statelock:
           if not self.settings.longpollconnections: self.signals_new_block = False
@@ -244,10 +299,7 @@ class BCJSONRPCWorkSource(ActualWorkSource):
                   self.core.log(self, "Found long polling URL: %s\n" % (url), 500, "g")
                   self.signals_new_block = True
                   self.runcycle += 1
-                  for i in range(self.settings.longpollconnections):
-                    thread = Thread(None, self._longpollingworker, "%s_longpolling_%d" % (self.settings.name, i), (host, port, path))
-                    thread.daemon = True
-                    thread.start()
+                  self._start_longpolling(host, port, path)
                 except Exception as e:
                   self.core.log(self, "Invalid long polling URL: %s (%s)\n" % (url, str(e)), 200, "y")
                 break
@@ -255,6 +307,7 @@ class BCJSONRPCWorkSource(ActualWorkSource):
               self.runcycle += 1
               self.signals_new_block = False
         jobs = self._build_jobs(response, data, epoch, now, "getwork")
+      except PoolTimeout: pass
       except:
         self.core.log(self, "Error while fetching job: %s\n" % (traceback.format_exc()), 200, "y")
         self._handle_error()
@@ -266,60 +319,96 @@ class BCJSONRPCWorkSource(ActualWorkSource):
         self._push_jobs(jobs, "getwork response")
         
         
+  # Waits for a connection from the pool. Other work sources that use the same server may keep all
+  # of its connections busy for a while, which isn't an error of the server, so waiting continues
+  # until one becomes available. Raises PoolTimeout only if the work source is shutting down.
+  def _acquire_connection(self, priority, timeout):
+    pool = self.pool
+    while True:
+      try: return pool.acquire(priority, timeout)
+      except PoolTimeout:
+        if self.shutdown: raise
+
+
   def nonce_found(self, job, data, nonce, noncediff):
     self.uploadqueue.put((job, data, nonce, noncediff))
+    if self.settings.autotune:
+      with self.uploaderlock:
+        # More shares are waiting than there are idle connections
+        if self.uploadqueue.qsize() > self.uploadertarget - self.uploadersbusy and self.uploadertarget < self.settings.uploadconnections:
+          self.core.log(self, "Opening another share upload connection\n", 500)
+          self._set_uploader_count(self.uploadertarget + 1)
       
       
   def uploader(self):
-    conn = None
     while not self.shutdown:
-      share = self.uploadqueue.get()
-      if not share: continue
-      job, data, nonce, noncediff = share
-      tries = 0
-      while True:
-        try:
-          req = json.dumps({"method": "getwork", "params": [hexlify(data).decode("ascii")], "id": 0}).encode("utf_8")
-          headers = {"User-Agent": self.useragent, "X-Mining-Extensions": self.extensions,
-                     "Content-Type": "application/json", "Content-Length": len(req)}
-          if self.auth != None: headers["Authorization"] = self.auth
-          try:
-            if conn:
-              try:
-                conn.request("POST", self.settings.path, req, headers)
-                response = conn.getresponse()
-              except:
-                conn = None
-                self.core.log(self, "Keep-alive share upload connection died\n", 500)
-            if not conn:
-              conn = http_client.HTTPConnection(self.settings.host, self.settings.port, True, self.settings.sendsharetimeout)
-              conn.request("POST", self.settings.path, req, headers)
-              response = conn.getresponse()
-            rdata = response.read()
-          except:
-            conn = None
-            raise
-          rdata = json.loads(rdata.decode("utf_8"))
-          result = False
-          if rdata["result"] == True: result = True
-          elif rdata["error"] != None: result =  rdata["error"]
-          else:
-            headers = response.getheaders()
-            for h in headers:
-              if h[0].lower() == "x-reject-reason":
-                result = h[1]
-                break
-          if result is not True:
-            self.jobepoch += 1
-            self._cancel_jobs(True)
-          self._handle_success()
-          job.nonce_handled_callback(nonce, noncediff, result)
-          break
+      try: share = self.uploadqueue.get(True, self.idletime if self.settings.autotune else None)
+      except Empty:
+        # Let the auto tuner close connections that weren't used for a while
+        with self.uploaderlock:
+          if self.settings.autotune and self.uploadertarget > 1: self.uploadertarget -= 1
+        share = None
+      if not share:
+        with self.uploaderlock:
+          if len(self.uploaderthreads) > self.uploadertarget:
+            self.uploaderthreads.remove(current_thread())
+            return
+        continue
+      with self.uploaderlock: self.uploadersbusy += 1
+      try: self._upload(share)
+      finally:
+        with self.uploaderlock: self.uploadersbusy -= 1
+        
+        
+  def _upload(self, share):
+    job, data, nonce, noncediff = share
+    tries = 0
+    while True:
+      try:
+        req = json.dumps({"method": "getwork", "params": [hexlify(data).decode("ascii")], "id": 0}).encode("utf_8")
+        headers = {"User-Agent": self.useragent, "X-Mining-Extensions": self.extensions,
+                   "Content-Type": "application/json", "Content-Length": len(req), "Connection": "Keep-Alive"}
+        if self.auth != None: headers["Authorization"] = self.auth
+        # Shares are sent before any waiting job fetches, their latency decides whether they are still accepted
+        conn = self._acquire_connection(PRIORITY_UPLOAD, self.settings.sendsharetimeout)
+        starttime = monotonic()
+        try: response, rdata = self.pool.request(conn, "POST", self.settings.path, req, headers)
         except:
-          self.core.log(self, "Error while sending share %s (difficulty %.5f): %s\n" % (hexlify(nonce).decode("ascii"), noncediff, traceback.format_exc()), 200, "y")
-          tries += 1
-          self._handle_error(True)
-          time.sleep(min(30, tries))
+          self.uploadlatency.add_error()
+          raise
+        self.uploadlatency.add(monotonic() - starttime)
+        rdata = json.loads(rdata.decode("utf_8"))
+        result = False
+        if rdata["result"] == True: result = True
+        elif rdata["error"] != None: result =  rdata["error"]
+        else:
+          headers = response.getheaders()
+          for h in headers:
+            if h[0].lower() == "x-reject-reason":
+              result = h[1]
+              break
+        if result is not True:
+          self.jobepoch += 1
+          self._cancel_jobs(True)
+        self._handle_success()
+        job.nonce_handled_callback(nonce, noncediff, result)
+        return
+      except PoolTimeout:
+        job.nonce_handled_callback(nonce, noncediff, "shutting down")
+        return
+      except:
+        self.core.log(self, "Error while sending share %s (difficulty %.5f): %s\n" % (hexlify(nonce).decode("ascii"), noncediff, traceback.format_exc()), 200, "y")
+        tries += 1
+        self._handle_error(True)
+        time.sleep(min(30, tries))
+
+
+  def _start_longpolling(self, host, port, path):
+    self.longpollendpoint = (host, port, path)
+    for i in range(self.longpollconnections):
+      thread = Thread(None, self._longpollingworker, "%s_longpolling_%d" % (self.settings.name, i), (host, port, path))
+      thread.daemon = True
+      thread.start()
 
 
   def _longpollingworker(self, host, port, path):
@@ -332,6 +421,7 @@ class BCJSONRPCWorkSource(ActualWorkSource):
       try:
         headers = {"User-Agent": self.useragent, "X-Mining-Extensions": self.extensions, "Connection": "Keep-Alive"}
         if self.auth != None: headers["Authorization"] = self.auth
+        requesttime = monotonic()
         if conn:
           try:
             if conn.sock: conn.sock.settimeout(self.settings.longpolltimeout)
@@ -343,7 +433,7 @@ class BCJSONRPCWorkSource(ActualWorkSource):
             conn = None
             self.core.log(self, "Keep-alive long poll connection died\n", 500)
         if not conn:
-          conn = http_client.HTTPConnection(host, port, True, self.settings.longpolltimeout)
+          conn = http_client.HTTPConnection(host, port, timeout = self.settings.longpolltimeout)
           epoch = self.lpepoch + 1
           conn.request("GET", path, None, headers)
           conn.sock.settimeout(self.settings.longpollresponsetimeout)
@@ -354,11 +444,13 @@ class BCJSONRPCWorkSource(ActualWorkSource):
           self.jobepoch += 1
           self._cancel_jobs(True)
         data = response.read()
-        jobs = self._build_jobs(response, data, self.jobepoch, time.time() - 1, "long poll", True, True)
+        self.longpolllatency.add(monotonic() - requesttime)
+        jobs = self._build_jobs(response, data, self.jobepoch, monotonic() - 1, "long poll", True, True)
         if not jobs: continue
         self._push_jobs(jobs, "long poll response")
       except:
         conn = None
+        self.longpolllatency.add_error()
         self.core.log(self, "Long poll failed: %s\n" % (traceback.format_exc()), 200, "y")
         tries += 1
         if time.time() - starttime >= 60: tries = 0
@@ -406,8 +498,6 @@ class BCJSONRPCWorkSource(ActualWorkSource):
       return
     expiry += now - self.settings.expirymargin
     midstate = Job.calculate_midstate(data)
-    prefix = data[:68]
-    timebase = struct.unpack(">I", data[68:72])[0]
-    suffix = data[72:]
-    return [Job(self.core, self, expiry, prefix + struct.pack(">I", timebase + i) + suffix, target, midstate, identifier) for i in range(roll_ntime)]
+    if roll_ntime == 1: return [Job(self.core, self, expiry, data, target, midstate, identifier)]
+    return [JobTemplate(self.core, self, expiry, data, target, midstate, identifier, roll_ntime)]
   
\ No newline at end of file
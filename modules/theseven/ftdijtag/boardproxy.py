@@ -142,7 +142,7 @@ class FTDIJTAGBoardProxy(Process):
       while not self.shutdown:
         # Poll for nonces
         nonces = self.device.read_nonces()
-        for fpga in nonces: self.send("nonce_found", fpga, time.time(), nonces[fpga])
+        if nonces: self.send("nonces_found", time.time(), nonces)
         
         counter += 1
         if counter >= 20:
@@ -187,7 +187,7 @@ class FTDIJTAGWorker(BaseWorker):
           elif data[0] == "dying": raise Exception("Proxy died!")
           elif data[0] == "response": self.response_queue.put(data[1:])
           elif data[0] == "started_up": self._notify_proxy_started_up(*data[1:])
-          elif data[0] == "nonce_found": self._notify_nonce_found(*data[1:])
+          elif data[0] == "nonces_found": self._notify_nonces_found(*data[1:])
           elif data[0] == "temperatures_read": self._notify_temperatures_read(*data[1:])
           else: raise Exception("Proxy sent unknown message: %s" % str(data))
         
@@ -254,6 +254,10 @@ class FTDIJTAGWorker(BaseWorker):
       except Exception as e: self.children[fpga].error = e
 
 
+  def _notify_nonces_found(self, now, nonces):
+    for fpga in nonces: self._notify_nonce_found(fpga, now, nonces[fpga])
+
+
   def _notify_temperatures_read(self, temperatures):
     if self.children:
       for fpga in temperatures:
@@ -138,10 +138,6 @@ class MMQBoardProxy(Process):
     self.send("log", message, loglevel, format)
     
     
-  def nonce_found(self, fpga, nonce):
-    self.send("nonce_found", fpga, time.time(), nonce)
-    
-  
   def temperatures_read(self, temperatures):
     self.send("temperatures_read", temperatures)
     
@@ -157,7 +153,7 @@ class MMQBoardProxy(Process):
       while not self.shutdown:
         # Poll for nonces
         nonces = self.device.read_nonces()
-        for fpga in nonces: self.nonce_found(fpga, nonces[fpga])
+        if nonces: self.send("nonces_found", time.time(), nonces)
         
         counter += 1
         if counter >= 20:
@@ -192,11 +192,12 @@ class SQLiteStats(BaseFrontend):
 
   def _get_job_id(self, job):
     if job is None: return None
-    if hasattr(job, "_ext_theseven_sqlite_jobid"): return job._ext_theseven_sqlite_jobid
+    id = job.get_ext("theseven_sqlite_jobid")
+    if id is not None: return id
     worksource = self._get_object_id(job.worksource)
     self.cursor.execute("INSERT INTO [job]([worksource], [data]) VALUES(:worksource, :data)",
                         {"worksource": worksource, "data": job.data[:76]})
-    job._ext_theseven_sqlite_jobid = self.cursor.lastrowid
+    job.set_ext("theseven_sqlite_jobid", self.cursor.lastrowid)
     return self.cursor.lastrowid
 
 
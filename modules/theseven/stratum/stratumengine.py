@@ -0,0 +1,333 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+#################################################
+# Event loop shared by all Stratum work sources #
+#################################################
+
+
+
+import errno
+import select
+import socket
+import traceback
+from heapq import heappush, heappop
+from threading import Thread, RLock, current_thread
+from core.util import monotonic
+
+
+
+# A line based, non-blocking client connection, driven by the engine's loop thread.
+# All callbacks are called from the loop thread: connected(), line_received(line) for every
+# received line (without the line terminator) and closed(reason) if the connection died.
+class StratumConnection(object):
+
+  # Bytes that are received at once
+  recvsize = 65536
+
+  def __init__(self, engine, host, port, timeout, connected, line_received, closed):
+    self.engine = engine
+    self.host = host
+    self.port = port
+    self.connected = connected
+    self.line_received = line_received
+    self.closed = closed
+    self.sock = None
+    self.connecting = True
+    self.active = True
+    self.recvbuffer = bytearray(self.recvsize)
+    self.inbuffer = bytearray()
+    self.outbuffer = bytearray()
+    self.timer = engine.schedule(monotonic() + timeout, self._connect_timeout)
+
+
+  def fileno(self):
+    return self.sock.fileno()
+
+
+  # Called from a helper thread, because resolving the host name can block for a long time.
+  # Hands the address over to the loop thread, which opens the socket.
+  def _resolve(self):
+    try: addrinfo = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)[0]
+    except:
+      self.engine.call(self.close, traceback.format_exc())
+      return
+    self.engine.call(self.engine._open, self, addrinfo)
+
+
+  # Called from the loop thread
+  def _connect(self, addrinfo):
+    family, type, proto, name, address = addrinfo
+    self.sock = socket.socket(family, type, proto)
+    self.sock.setblocking(0)
+    error = self.sock.connect_ex(address)
+    if error and not error in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, getattr(errno, "WSAEWOULDBLOCK", 0)):
+      raise socket.error(error, "Could not connect: %s" % errno.errorcode.get(error, error))
+
+
+  def _connect_timeout(self):
+    self.close("Connect timed out")
+
+
+  def _connect_finished(self):
+    error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if error: raise socket.error(error, "Could not connect: %s" % errno.errorcode.get(error, error))
+    self.connecting = False
+    self.engine.cancel(self.timer)
+    self.timer = None
+    self.connected()
+
+
+  def _read(self):
+    try: size = self.sock.recv_into(self.recvbuffer)
+    except socket.error as e:
+      if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR): return
+      raise
+    if not size: raise Exception("Connection closed by peer")
+    # Only the new data needs to be searched for the end of the last complete line
+    start = len(self.inbuffer)
+    self.inbuffer += self.recvbuffer[:size]
+    end = self.inbuffer.rfind(b"\n", start)
+    if end < 0: return
+    # All complete lines of a burst are decoded at once
+    lines = self.inbuffer[:end].decode("utf_8").split("\n")
+    del self.inbuffer[:end + 1]
+    for line in lines:
+      if not self.active: return
+      self.line_received(line)
+
+
+  def _write(self):
+    with self.engine.lock:
+      try: sent = self.sock.send(self.outbuffer)
+      except socket.error as e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR): return
+        raise
+      del self.outbuffer[:sent]
+
+
+  # Queues a line (without the line terminator) for sending. Thread safe.
+  # Lines that are queued by the loop thread are sent in a single write once it returns to select().
+  def send(self, line):
+    with self.engine.lock:
+      if not self.active: raise Exception("Connection is not active")
+      self.outbuffer += line.encode("utf_8")
+      self.outbuffer += b"\n"
+    self.engine.wakeup()
+
+
+  # Closes the connection, must be called from the loop thread (use engine.call otherwise).
+  # The closed callback is only called if a reason is passed.
+  def close(self, reason = None):
+    with self.engine.lock:
+      if not self.active: return
+      self.active = False
+      self.engine.connections.discard(self)
+    if self.timer: self.engine.cancel(self.timer)
+    if self.sock:
+      try: self.sock.close()
+      except: pass
+    if reason: self.closed(reason)
+
+
+
+# Runs the sockets and timers of all Stratum work sources in a single thread.
+# The thread is started on demand and exits when there is nothing left to wait for.
+class StratumEngine(object):
+
+  def __init__(self):
+    self.lock = RLock()
+    self.thread = None
+    self.connections = set()
+    self.timers = []
+    self.timerseq = 0
+    self.calls = []
+    self.wakeupsocks = None
+    self.wakeuppending = False
+
+
+  # Creates a socket pair that is used to interrupt select() from other threads
+  def _create_wakeup_socks(self):
+    try: return socket.socketpair()
+    except (AttributeError, socket.error): pass
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+      listener.bind(("127.0.0.1", 0))
+      listener.listen(1)
+      writer = socket.create_connection(listener.getsockname())
+      reader, address = listener.accept()
+    finally: listener.close()
+    return reader, writer
+
+
+  # Called with the lock held
+  def _ensure_running(self):
+    if self.thread: return
+    if not self.wakeupsocks:
+      self.wakeupsocks = self._create_wakeup_socks()
+      for sock in self.wakeupsocks: sock.setblocking(0)
+    self.thread = Thread(None, self._main, "stratum_engine")
+    self.thread.daemon = True
+    self.thread.start()
+
+
+  # Interrupts the loop thread if it is waiting in select()
+  def wakeup(self):
+    with self.lock:
+      if self.wakeuppending or not self.wakeupsocks or current_thread() == self.thread: return
+      self.wakeuppending = True
+      try: self.wakeupsocks[1].send(b"\0")
+      except socket.error: pass
+
+
+  # Runs function(*args) in the loop thread as soon as possible
+  def call(self, function, *args):
+    with self.lock:
+      self.calls.append((function, args))
+      self._ensure_running()
+    self.wakeup()
+
+
+  # Runs function(*args) in the loop thread once the monotonic clock reaches deadline.
+  # Returns a handle that can be passed to cancel.
+  def schedule(self, deadline, function, *args):
+    with self.lock:
+      self.timerseq += 1
+      timer = [deadline, self.timerseq, function, args]
+      heappush(self.timers, timer)
+      self._ensure_running()
+    self.wakeup()
+    return timer
+
+
+  def cancel(self, timer):
+    # Canceled timers stay in the heap until they are due, their function is just dropped
+    timer[2] = None
+
+
+  # Opens a connection, see StratumConnection for the callbacks
+  def connect(self, host, port, timeout, connected, line_received, closed):
+    conn = StratumConnection(self, host, port, timeout, connected, line_received, closed)
+    thread = Thread(None, conn._resolve, "stratum_resolver")
+    thread.daemon = True
+    thread.start()
+    return conn
+
+
+  def _open(self, conn, addrinfo):
+    if not conn.active: return
+    try: conn._connect(addrinfo)
+    except:
+      conn.close(traceback.format_exc())
+      return
+    with self.lock: self.connections.add(conn)
+
+
+  def _run(self, function, args):
+    try: function(*args)
+    except: self._log_exception(function)
+
+
+  # Logs the exception that function raised in the loop thread, on behalf of the work source that it belongs to
+  def _log_exception(self, function):
+    owner = getattr(function, "__self__", None)
+    if isinstance(owner, StratumConnection): owner = getattr(owner.closed, "__self__", None)
+    core = getattr(owner, "core", None)
+    if core: core.log(owner, "Error in Stratum event loop: %s\n" % traceback.format_exc(), 100, "rB")
+    else: traceback.print_exc()
+
+
+  def _handle(self, conn, handler):
+    if not conn.active: return
+    try: handler()
+    except: conn.close(traceback.format_exc())
+
+
+  # Closes the connections whose sockets select() refuses to wait for
+  def _drop_broken_connections(self):
+    with self.lock: connections = list(self.connections)
+    for conn in connections:
+      try: select.select([conn], [], [conn], 0)
+      except: conn.close(traceback.format_exc())
+
+
+  def _main(self):
+    try: self._loop()
+    finally:
+      # Let the next call or timer start a new thread if this one died
+      with self.lock:
+        if self.thread == current_thread(): self.thread = None
+
+
+  def _loop(self):
+    while True:
+      with self.lock:
+        calls = self.calls
+        self.calls = []
+      for function, args in calls: self._run(function, args)
+      now = monotonic()
+      while True:
+        with self.lock:
+          if not self.timers or self.timers[0][0] > now: break
+          deadline, seq, function, args = heappop(self.timers)
+        if function: self._run(function, args)
+      with self.lock:
+        if self.calls: continue
+        if not self.connections:
+          # Nothing will happen any more if only canceled timers are left
+          if self.timers and not any(timer[2] for timer in self.timers): self.timers = []
+          if not self.timers:
+            self.thread = None
+            return
+        timeout = max(0, self.timers[0][0] - now) if self.timers else None
+        readers = [self.wakeupsocks[0]]
+        writers = []
+        errors = []
+        for conn in self.connections:
+          if conn.connecting:
+            writers.append(conn)
+            errors.append(conn)
+          else:
+            readers.append(conn)
+            if conn.outbuffer: writers.append(conn)
+      try: readable, writable, failed = select.select(readers, writers, errors, timeout)
+      except (select.error, socket.error, ValueError) as e:
+        if e.args and e.args[0] == errno.EINTR: continue
+        self._drop_broken_connections()
+        continue
+      if self.wakeupsocks[0] in readable:
+        readable.remove(self.wakeupsocks[0])
+        with self.lock:
+          self.wakeuppending = False
+          try:
+            while self.wakeupsocks[0].recv(4096): pass
+          except socket.error: pass
+      for conn in failed: self._handle(conn, conn._connect_finished)
+      for conn in writable:
+        if conn.connecting: self._handle(conn, conn._connect_finished)
+        else: self._handle(conn, conn._write)
+      for conn in readable: self._handle(conn, conn._read)
+
+
+
+# The engine that is shared by all Stratum work sources
+engine = StratumEngine()
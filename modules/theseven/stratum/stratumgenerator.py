@@ -0,0 +1,79 @@
+# Modular Python Bitcoin Miner
+# Copyright (C) 2012 Michael Sparmann (TheSeven)
+#
+#     This program is free software; you can redistribute it and/or
+#     modify it under the terms of the GNU General Public License
+#     as published by the Free Software Foundation; either version 2
+#     of the License, or (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Please consider donating to 1PLAPWDejJPJnY2ppYCgtw5ko8G5Q4hPzh if you
+# want to support further development of the Modular Python Bitcoin Miner.
+
+
+
+#####################################################
+# Background job generator for Stratum work sources #
+#####################################################
+
+
+
+import traceback
+from threading import Thread, Condition
+from core.util import OrderedSet
+
+
+
+# Refills the job rings of all Stratum work sources in a single background thread.
+# Sources that want more jobs are served round robin, one batch at a time, by calling
+# their _generate_jobs method, which returns whether the source wants another batch.
+class StratumJobGenerator(object):
+
+  # Seconds without any requests after which the thread exits (it is restarted on demand)
+  idletime = 60
+
+
+  def __init__(self):
+    self.lock = Condition()
+    self.pending = OrderedSet()
+    self.thread = None
+
+
+  # Asks the generator to call source._generate_jobs soon
+  def request(self, source):
+    with self.lock:
+      if source in self.pending: return
+      self.pending.add(source)
+      if not self.thread:
+        self.thread = Thread(None, self._loop, "stratum_generator")
+        self.thread.daemon = True
+        self.thread.start()
+      self.lock.notify()
+
+
+  def _loop(self):
+    while True:
+      with self.lock:
+        if not self.pending: self.lock.wait(self.idletime)
+        if not self.pending:
+          self.thread = None
+          return
+        source = self.pending.pop(False)
+      try: more = source._generate_jobs()
+      except:
+        source.core.log(source, "Error while generating jobs: %s\n" % traceback.format_exc(), 100, "rB")
+        more = False
+      if more: self.request(source)
+
+
+
+# The generator that is shared by all Stratum work sources
+generator = StratumJobGenerator()
@@ -26,17 +26,18 @@
 
 
 
-import sys
-import socket
 import time
 import json
 import struct
-import traceback
 from binascii import hexlify, unhexlify
-from threading import Thread, RLock, Condition
-from hashlib import sha256
+from collections import deque
+from threading import RLock, Event
 from core.actualworksource import ActualWorkSource
+from core.util import Bunch, LatencyHistogram, monotonic
 from core.job import Job
+from core.merkle import calculate_merkle_roots
+from .stratumengine import engine
+from .stratumgenerator import generator
 
 
 
@@ -44,6 +45,8 @@ class StratumWorkSource(ActualWorkSource):
   
   version = "theseven.stratum work source v0.1.0"
   default_name = "Untitled Stratum work source"
+  # Version bits that may be rolled (those that BIP 320 reserves for general use)
+  requestedversionmask = 0x1fffe000
   settings = dict(ActualWorkSource.settings, **{
     "connecttimeout": {"title": "Connect timeout", "type": "float", "position": 19000},
     "responsetimeout": {"title": "Response timeout", "type": "float", "position": 19100},
@@ -51,6 +54,11 @@ class StratumWorkSource(ActualWorkSource):
     "port": {"title": "Port", "type": "int", "position": 1010},
     "username": {"title": "User name", "type": "string", "position": 1100},
     "password": {"title": "Password", "type": "password", "position": 1120},
+    "jobbatchsize": {"title": "Jobs per generator run", "type": "int", "position": 1200},
+    "jobringsize": {"title": "Prebuilt jobs", "type": "int", "position": 1210},
+    "versionrolling": {"title": "Version rolling jobs per merkle root", "type": "int", "position": 1220},
+    "submitwindow": {"title": "Shares in flight", "type": "int", "position": 1300},
+    "submitqueuesize": {"title": "Share queue size", "type": "int", "position": 1310},
   })
   
 
@@ -58,7 +66,6 @@ class StratumWorkSource(ActualWorkSource):
     super(StratumWorkSource, self).__init__(core, state)
     self.datalock = RLock()
     self.txnlock = RLock()
-    self.wakeup = Condition()
     self.tail = unhexlify(b"00000000000000800000000000000000000000000000000000000000000000000000000000000000000000000000000080020000")
     
     
@@ -72,18 +79,39 @@ class StratumWorkSource(ActualWorkSource):
     if not "port" in self.settings or not self.settings.port: self.settings.port = 3333
     if not "username" in self.settings: self.settings.username = ""
     if not "password" in self.settings: self.settings.password = ""
-    if self.started and (self.settings.host != self.host or self.settings.port != self.port or self.settings.username != self.username or self.settings.password != self.password): self.async_restart()
+    if not "jobbatchsize" in self.settings or not self.settings.jobbatchsize: self.settings.jobbatchsize = 32
+    if not "jobringsize" in self.settings: self.settings.jobringsize = 128
+    if not "versionrolling" in self.settings: self.settings.versionrolling = 0
+    if not "submitwindow" in self.settings or not self.settings.submitwindow: self.settings.submitwindow = 8
+    if not "submitqueuesize" in self.settings or not self.settings.submitqueuesize: self.settings.submitqueuesize = 1000
+    if self.started and (self.settings.host != self.host or self.settings.port != self.port or self.settings.username != self.username or self.settings.password != self.password or bool(self.settings.versionrolling) != self.versionrolling): self.async_restart()
 
     
   def _reset(self):
     super(StratumWorkSource, self)._reset()
-    self.timeoutthread = None
-    self.listenerthread = None
+    self.conn = None
+    self.reconnecttimer = None
+    self.stopped = Event()
+    self.shutdown = True
+    self.session = 0
+    self.subscriptionid = None
+    self.extranonce1 = None
+    self.authorized = False
+    self.versionrolling = False
+    self.versionmask = 0
     self.data = None
+    self.ring = deque()
     self.txns = {}
     self.txnid = 1
+    self.submitqueue = deque()
+    self.submitsinflight = 0
+    self.submitlatency = LatencyHistogram()
+    self.sharesreplayed = 0
+    self.sharesdropped = 0
     self.difficulty = 1
     self._calculate_target()
+    self.stats.difficultychanges = 0
+    self.stats.cancelsavoided = 0
     
     
   def _start(self):
@@ -92,21 +120,18 @@ class StratumWorkSource(ActualWorkSource):
     self.port = self.settings.port
     self.username = self.settings.username
     self.password = self.settings.password
+    self.versionrolling = bool(self.settings.versionrolling)
     if not self.settings.host or not self.settings.port: return
     self.shutdown = False
-    self.listenerthread = Thread(None, self._listener, "%s_listener" % self.settings.name)
-    self.listenerthread.daemon = True
-    self.listenerthread.start()
-    self.timeoutthread = Thread(None, self._timeout, "%s_timeout" % self.settings.name)
-    self.timeoutthread.daemon = True
-    self.timeoutthread.start()
+    self.tries = 0
+    self.triestime = monotonic()
+    engine.call(self._connect)
     
     
   def _stop(self):
     self.shutdown = True
-    with self.wakeup: self.wakeup.notify()
-    if self.timeoutthread: self.timeoutthread.join(3)
-    if self.listenerthread: self.listenerthread.join(3)
+    engine.call(self._shutdown)
+    self.stopped.wait(3)
     super(StratumWorkSource, self)._stop()
     
     
@@ -118,165 +143,314 @@ class StratumWorkSource(ActualWorkSource):
       target >>= 32    
     
     
+  def _get_statistics(self, stats, childstats):
+    super(StratumWorkSource, self)._get_statistics(stats, childstats)
+    with self.txnlock:
+      stats.submitqueue = len(self.submitqueue)
+      stats.submitsinflight = self.submitsinflight
+      stats.sharesreplayed = self.sharesreplayed
+      stats.sharesdropped = self.sharesdropped
+    stats.submit_latency = self.submitlatency.get_statistics()
+    stats.difficultychanges = self.stats.difficultychanges
+    stats.cancelsavoided = self.stats.cancelsavoided
+    
+    
   def _get_running_fetcher_count(self):
     return 0, 0
   
   
   def _start_fetcher(self):
+    starttime = monotonic()
+    count = max(1, min(self.settings.jobbatchsize, self.core.workqueue.target - self.core.workqueue.count))
+    with self.datalock:
+      data = self.data
+      if not data or self.shutdown: return False, 0
+      jobs = [self.ring.popleft() for i in range(min(count, len(self.ring)))]
+      if not jobs:
+        roots = self._get_merkle_root_count(data, count)
+        first = self._reserve_extranonce2(data, roots)
+    # The ring might not have been filled yet after a new mining.notify
+    if not jobs: jobs = self._build_jobs(data, first, roots)
+    generator.request(self)
+    expiry = monotonic() + 60
+    for i, (header, extranonce2, ntime, versionbits, midstate) in enumerate(jobs):
+      job = Job(self.core, self, expiry, header, data["target"], midstate)
+      job.set_ext("theseven_stratum", (data["job_id"], extranonce2, ntime, data["session"], data["extranonce1"], versionbits))
+      jobs[i] = job
+    self._handle_fetch_latency(monotonic() - starttime)
+    self._push_jobs(jobs, "stratum generator")
+    return 1, len(jobs)
+  
+  
+  # Replaces the job generation data and drops all jobs that were prebuilt from the old data
+  def _set_data(self, data):
+    with self.datalock:
+      self.data = data
+      self.ring = deque()
+    if data: generator.request(self)
+    
+    
+  # Returns how many merkle roots are needed for count jobs
+  def _get_merkle_root_count(self, data, count):
+    return (count + len(data["versions"]) - 1) // len(data["versions"])
+    
+    
+  # Called with datalock held, returns the first of count extranonce2 values that are reserved for the caller
+  def _reserve_extranonce2(self, data, count):
+    first = data["extranonce2"]
+    data["extranonce2"] += count
+    return first
+    
+    
+  # Builds the (header, extranonce2, ntime, versionbits, midstate) tuples for the jobs of count merkle roots,
+  # without holding any locks. With version rolling, every merkle root yields one job per entry of data["versions"].
+  def _build_jobs(self, data, first, count):
+    extranonce2format = "%%0%dx" % (2 * data["extranonce2len"])
+    extranonce2s = [extranonce2format % extranonce2 for extranonce2 in range(first, first + count)]
+    merkles = calculate_merkle_roots(data["coinbaseprefix"], data["coinb2"], data["merkle_branch"], [unhexlify(extranonce2.encode("ascii")) for extranonce2 in extranonce2s])
+    ntime = struct.pack(">I", data["ntime"] + int(time.time()))
+    headersuffix = ntime + data["nbits"] + self.tail
+    jobs = []
+    for extranonce2, merkle in zip(extranonce2s, merkles):
+      merkle = data["prevhash"] + struct.pack("<8I", *struct.unpack(">8I", merkle)) + headersuffix
+      for version, versionbits in data["versions"]: jobs.append((version + merkle, extranonce2, versionbits))
+    midstates = Job.calculate_midstates([header for header, extranonce2, versionbits in jobs])
+    ntime = hexlify(ntime).decode("ascii")
+    return [(header, extranonce2, ntime, versionbits, midstates[i]) for i, (header, extranonce2, versionbits) in enumerate(jobs)]
+    
+    
+  # Called by the job generator thread. Adds a batch of jobs to the ring and returns whether it wants another one.
+  def _generate_jobs(self):
     with self.datalock:
-      if not self.data or self.shutdown: return False, 0
-      extranonce2 = unhexlify((("%%0%dx" % (2 * self.data["extranonce2len"])) % self.data["extranonce2"]).encode("ascii"))
-      self.data["extranonce2"] += 1
-      coinbase = self.data["coinb1"] + self.data["extranonce1"] + extranonce2 + self.data["coinb2"]
-      merkle = sha256(sha256(coinbase).digest()).digest()
-      for branch in self.data["merkle_branch"]: merkle = sha256(sha256(merkle + branch).digest()).digest()
-      merkle = struct.pack("<8I", *struct.unpack(">8I", merkle))
-      ntime = struct.pack(">I", self.data["ntime"] + int(time.time()))
-      data = self.data["version"] + self.data["prevhash"] + merkle + ntime + self.data["nbits"] + self.tail
-      target = self.data["target"]
-      job_id = self.data["job_id"]
-    job = Job(self.core, self, time.time() + 60, data, target)
-    job._stratum_job_id = job_id
-    job._stratum_extranonce2 = hexlify(extranonce2).decode("ascii")
-    job._stratum_ntime = hexlify(ntime).decode("ascii")
-    self._push_jobs([job], "stratum generator")
-    return 1, 1
+      data = self.data
+      if not data or self.shutdown: return False
+      count = min(self.settings.jobbatchsize, self.settings.jobringsize - len(self.ring))
+      if count <= 0: return False
+      roots = self._get_merkle_root_count(data, count)
+      first = self._reserve_extranonce2(data, roots)
+    jobs = self._build_jobs(data, first, roots)
+    with self.datalock:
+      # Drop the batch if new job generation data arrived in the meantime
+      if self.data is not data: return False
+      self.ring.extend(jobs)
+      return len(self.ring) < self.settings.jobringsize
   
   
   def _txn(self, method, params = None, callback = None, errorcallback = None, timeoutcallback = None, timeout = None):
     if not timeout: timeout = self.settings.responsetimeout
     with self.txnlock:
-      if not self.conn: raise Exception("Connection is not active")
+      if not self.conn or self.conn.connecting: raise Exception("Connection is not active")
       txn = self.txnid
       self.txnid += 1
       self.txns[txn] = {
         "method": method,
         "params": params,
-        "timeout": time.time() + timeout,
         "callback": callback,
         "errorcallback": errorcallback,
         "timeoutcallback": timeoutcallback,
+        "timer": engine.schedule(monotonic() + timeout, self._txn_timeout, txn),
       }
-      self.connw.write(json.dumps({"id": txn, "method": method, "params": params}) + "\n")
-      self.connw.flush()
+      try: self.conn.send(json.dumps({"id": txn, "method": method, "params": params}))
+      except:
+        engine.cancel(self.txns.pop(txn)["timer"])
+        raise
+      return txn
+
+
+  # Connection handling and the transaction callbacks below run in the engine's loop thread
+  def _connect(self):
+    self.reconnecttimer = None
+    if self.shutdown: return
+    with self.txnlock:
+      self.conn = engine.connect(self.host, self.port, self.settings.connecttimeout, self._connected, self._handle_line, self._connection_died)
+
+
+  def _connected(self):
+    self.session += 1
+    self.versionmask = 0
+    # Negotiate version rolling (BIP 310) first, the pool answers the requests in order
+    if self.versionrolling:
+      params = [["version-rolling"], {"version-rolling.mask": "%08x" % self.requestedversionmask, "version-rolling.min-bit-count": 2}]
+      self._txn("mining.configure", params, self._configured, self._configure_failed, self._configure_timeout)
+    self._txn("mining.authorize", [self.username, self.password], self._authorized, self._setup_failed, self._setup_timeout)
+
+
+  def _connection_died(self, reason):
+    self.core.log(self, "Stratum connection died: %s\n" % reason, 200, "r")
+    self._close_connection()
 
 
   def _close_connection(self):
+    self._set_data(None)
     with self.txnlock:
-      try: self.connw.close()
-      except: pass
-      try: self.connr.close()
-      except: pass
-      try: self.conn.shutdown()
-      except: pass
-      try: self.conn.close()
-      except: pass
+      conn = self.conn
       self.conn = None
+      self.authorized = False
+      # Responses to the transactions of this connection will never arrive. Shares that
+      # were in flight go back to the front of the queue to be replayed after reconnecting.
+      txns = self.txns
+      self.txns = {}
+      shares = [txns[txn]["share"] for txn in sorted(txns) if "share" in txns[txn]]
+      self.submitqueue.extendleft(reversed(shares))
+      self.submitsinflight = 0
+    for txn in txns.values(): engine.cancel(txn["timer"])
+    if not conn: return
+    conn.close()
     self._cancel_jobs()
-      
-  
-  def _listener(self):
-    tries = 0
-    starttime = time.time()
-    while not self.shutdown:
-      try:
-        with self.txnlock:
-          self.conn = socket.create_connection((self.host, self.port), self.settings.connecttimeout)
-          self.conn.settimeout(None)
-          if sys.version_info[0] < 3:
-            self.connr = self.conn.makefile("r", 1)
-            self.connw = self.conn.makefile("w", 1)
-          else:
-            self.connr = self.conn.makefile("r", buffering = 1, encoding = "utf_8", newline = "\n")
-            self.connw = self.conn.makefile("w", buffering = 1, encoding = "utf_8", newline = "\n")
-          self._txn("mining.authorize", [self.username, self.password], self._authorized, self._setup_failed, self._setup_timeout)
-        while not self.shutdown:
-          msgs = json.loads(self.connr.readline())
-          if not isinstance(msgs, list): msgs = [msgs]
-          for msg in msgs: 
-            if "id" in msg and msg["id"]:
-              with self.txnlock:
-                if not msg["id"] in self.txns:
-                  self.core.log(self, "Received unexpected Stratum response: %s\n" % msg, 200, "y")
-                  continue
-                txn = self.txns[msg["id"]]
-                if "error" in msg and msg["error"]:
-                  if txn["errorcallback"]: txn["errorcallback"](txn, msg["error"])
-                  else: self._default_error_handler(txn, msg["error"])
-                elif txn["callback"]: txn["callback"](txn, msg["result"])
-                del self.txns[msg["id"]]
-            elif msg["method"] == "mining.notify":
-              with self.datalock:
-                self.data = {
-                  "job_id": msg["params"][0],
-                  "prevhash": unhexlify(msg["params"][1].encode("ascii")),
-                  "coinb1": unhexlify(msg["params"][2].encode("ascii")),
-                  "coinb2": unhexlify(msg["params"][3].encode("ascii")),
-                  "merkle_branch": [unhexlify(branch.encode("ascii")) for branch in msg["params"][4]],
-                  "version": unhexlify(msg["params"][5].encode("ascii")),
-                  "nbits": unhexlify(msg["params"][6].encode("ascii")),
-                  "ntime": struct.unpack(">I", unhexlify(msg["params"][7].encode("ascii")))[0] - int(time.time()),
-                  "extranonce1": self.extranonce1,
-                  "extranonce2len": self.extranonce2len,
-                  "extranonce2": 0,
-                  "difficulty": self.difficulty,
-                  "target": self.target,
-                }
-              self.core.log(self, "Received new job generation data (%sflushing old jobs)\n" % ("" if msg["params"][8] else "not "), 500)
-              if msg["params"][8]: self._cancel_jobs()
-              self.blockchain.check_job(Job(self.core, self, 0, self.data["version"] + self.data["prevhash"] + b"\0" * 68 + self.data["nbits"] + self.tail, self.target, True))
-            elif msg["method"] == "mining.set_difficulty":
-              self.difficulty = float(msg["params"][0])
-              self._calculate_target()
-              self.core.log(self, "Received new job difficulty: %f\n" % self.difficulty, 500)
-              self._cancel_jobs()
-            else: self.core.log(self, "Received unknown Stratum notification: %s\n" % msg, 300, "y")
-      except:
-        with self.datalock: self.data = None
-        self.core.log(self, "Stratum connection died: %s\n" % (traceback.format_exc()), 200, "r")
-        self._close_connection()
-        tries += 1
-        if time.time() - starttime >= 60: tries = 0
-        if tries > 5: time.sleep(30)
-        else: time.sleep(1)
-        starttime = time.time()
+    if self.shutdown: return
+    now = monotonic()
+    self.tries += 1
+    if now - self.triestime >= 60: self.tries = 0
+    self.triestime = now
+    self.reconnecttimer = engine.schedule(now + (30 if self.tries > 5 else 1), self._connect)
 
 
-  def _timeout(self):
-    with self.wakeup:
-      while not self.shutdown:
-        with self.txnlock:
-          now = time.time()
-          for txn in list(self.txns):
-            if self.txns[txn]["timeout"] < now:
-              if self.txns[txn]["timeoutcallback"]: self.txns[txn]["timeoutcallback"](self.txns[txn], False)
-              else: self._default_timeout_handler(self.txns[txn], False)
-              del self.txns[txn]
-        self.wakeup.wait(1)
-      for txn in list(self.txns):
-        if self.txns[txn]["timeoutcallback"]: self.txns[txn]["timeoutcallback"](self.txns[txn], True)
-        else: self._default_timeout_handler(self.txns[txn], True)
+  def _shutdown(self):
+    if self.reconnecttimer: engine.cancel(self.reconnecttimer)
+    self.reconnecttimer = None
+    with self.txnlock:
+      txns = self.txns
+      self.txns = {}
+    for txn in txns.values():
+      engine.cancel(txn["timer"])
+      if txn["timeoutcallback"]: txn["timeoutcallback"](txn, True)
+      else: self._default_timeout_handler(txn, True)
+    with self.txnlock:
+      shares = list(self.submitqueue)
+      self.submitqueue.clear()
+    for share in shares: share.job.nonce_handled_callback(share.nonce, share.noncediff, "shutting down")
     self._close_connection()
+    self.stopped.set()
+
+
+  def _txn_timeout(self, txn):
+    with self.txnlock: txn = self.txns.pop(txn, None)
+    if not txn: return
+    if txn["timeoutcallback"]: txn["timeoutcallback"](txn, False)
+    else: self._default_timeout_handler(txn, False)
+
+
+  def _handle_line(self, line):
+    msgs = json.loads(line)
+    if not isinstance(msgs, list): msgs = [msgs]
+    for msg in msgs: 
+      if "id" in msg and msg["id"]:
+        with self.txnlock: txn = self.txns.pop(msg["id"], None)
+        if not txn:
+          self.core.log(self, "Received unexpected Stratum response: %s\n" % msg, 200, "y")
+          continue
+        engine.cancel(txn["timer"])
+        if "error" in msg and msg["error"]:
+          if txn["errorcallback"]: txn["errorcallback"](txn, msg["error"])
+          else: self._default_error_handler(txn, msg["error"])
+        elif txn["callback"]: txn["callback"](txn, msg["result"])
+      elif msg["method"] == "mining.notify":
+        data = {
+          "job_id": msg["params"][0],
+          "prevhash": unhexlify(msg["params"][1].encode("ascii")),
+          "coinbaseprefix": unhexlify(msg["params"][2].encode("ascii")) + self.extranonce1,
+          "coinb2": unhexlify(msg["params"][3].encode("ascii")),
+          "merkle_branch": [unhexlify(branch.encode("ascii")) for branch in msg["params"][4]],
+          "versions": self._get_versions(unhexlify(msg["params"][5].encode("ascii"))),
+          "nbits": unhexlify(msg["params"][6].encode("ascii")),
+          "ntime": struct.unpack(">I", unhexlify(msg["params"][7].encode("ascii")))[0] - int(time.time()),
+          "extranonce2len": self.extranonce2len,
+          "extranonce2": 0,
+          "difficulty": self.difficulty,
+          "target": self.target,
+          "session": self.session,
+          "extranonce1": self.extranonce1,
+        }
+        self._set_data(data)
+        self.core.log(self, "Received new job generation data (%sflushing old jobs)\n" % ("" if msg["params"][8] else "not "), 500)
+        if msg["params"][8]: self._cancel_jobs()
+        self.blockchain.check_job(Job(self.core, self, 0, data["versions"][0][0] + data["prevhash"] + b"\0" * 68 + data["nbits"] + self.tail, self.target, True))
+        # Shares that were found before reconnecting can be checked against the new block now
+        self._send_shares()
+      elif msg["method"] == "mining.set_difficulty":
+        self.difficulty = float(msg["params"][0])
+        self._calculate_target()
+        self.core.log(self, "Received new job difficulty: %f\n" % self.difficulty, 500)
+        # The new difficulty applies from the next mining.notify on. Existing jobs keep the target that they
+        # were built with, so workers keep hashing on them and their shares are still checked against it.
+        with self.core.workqueue.lock: jobs = sum(job.jobcount for job in self.jobs)
+        with self.stats.lock:
+          self.stats.difficultychanges += 1
+          self.stats.cancelsavoided += jobs
+      elif msg["method"] == "mining.set_version_mask":
+        self.versionmask = int(msg["params"][0], 16) & self.requestedversionmask
+        self.core.log(self, "Received new version rolling mask: %08x\n" % self.versionmask, 500)
+        # Jobs that were already built might use bits that the pool does not allow any more
+        with self.datalock:
+          if self.data: self._set_data(dict(self.data, versions = self._get_versions(self.data["versions"][0][0])))
+      else: self.core.log(self, "Received unknown Stratum notification: %s\n" % msg, 300, "y")
     
     
-  def _default_error_handler(txn, error):
+  def _default_error_handler(self, txn, error):
     self.core.log(self, "Stratum transaction failed: method=%s, params=%s, error=%s\n" % (txn["method"], txn["params"], error), 200, "y")
     
     
-  def _default_timeout_handler(txn, shutdown):
+  def _default_timeout_handler(self, txn, shutdown):
     if shutdown: return
     self.core.log(self, "Stratum transaction timed out: method=%s, params=%s\n" % (txn["method"], txn["params"]), 200, "y")
     
     
+  # Returns the (version, versionbits) pairs of the jobs that are built from one merkle root
+  def _get_versions(self, version):
+    if not self.versionmask or not self.versionrolling: return [(version, None)]
+    version = struct.unpack(">I", version)[0]
+    bits = [1 << bit for bit in range(32) if self.versionmask & (1 << bit)]
+    versions = []
+    for i in range(min(self.settings.versionrolling, 1 << len(bits))):
+      # Spread the bits of i over the bits that may be changed
+      rolled = version ^ sum(bit for index, bit in enumerate(bits) if i & (1 << index))
+      versions.append((struct.pack(">I", rolled), "%08x" % (rolled & self.versionmask)))
+    return versions
+    
+    
+  def _configured(self, txn, response):
+    if not response.get("version-rolling"):
+      self.core.log(self, "Stratum service does not support version rolling\n", 300, "y")
+      return
+    self.versionmask = int(response.get("version-rolling.mask", "0"), 16) & self.requestedversionmask
+    self.core.log(self, "Version rolling enabled (mask %08x)\n" % self.versionmask, 400, "g")
+    
+    
+  def _configure_failed(self, txn, error):
+    self.core.log(self, "Stratum service does not support version rolling: %s\n" % error, 300, "y")
+    
+    
+  def _configure_timeout(self, txn, shutdown):
+    if shutdown: return
+    self.core.log(self, "Stratum version rolling negotiation timed out\n", 300, "y")
+    
+    
   def _subscribed(self, txn, response):
-    self.extranonce1 = unhexlify(response[1].encode("ascii"))
+    self.subscriptionid = self._get_subscription_id(response[0])
+    extranonce1 = unhexlify(response[1].encode("ascii"))
+    if txn["params"] and extranonce1 == self.extranonce1: self.core.log(self, "Resumed Stratum session\n", 400, "g")
+    self.extranonce1 = extranonce1
     self.extranonce2len = int(response[2])
     self.core.log(self, "Successfully subscribed to Stratum service\n", 400, "g")
 
+
+  # Returns the id of the mining.notify subscription, which can be passed to mining.subscribe to resume the session
+  def _get_subscription_id(self, subscriptions):
+    try:
+      if not isinstance(subscriptions[0], list): subscriptions = [subscriptions]
+      for subscription in subscriptions:
+        if subscription[0] == "mining.notify": return subscription[1]
+    except: pass
+    return None
+
   
   def _authorized(self, txn, response):
-    self._txn("mining.subscribe", [], self._subscribed, self._setup_failed, self._setup_timeout)
+    # Ask the pool to resume the last session, so that shares which were found before reconnecting are still valid
+    params = [self.__class__.version, self.subscriptionid] if self.subscriptionid else []
+    self._txn("mining.subscribe", params, self._subscribed, self._setup_failed, self._setup_timeout)
     self.core.log(self, "Successfully authorized Stratum worker %s\n" % self.settings.username, 400, "g")
+    with self.txnlock: self.authorized = True
+    self._send_shares()
     
     
   def _setup_failed(self, txn, error):
@@ -290,6 +464,57 @@ class StratumWorkSource(ActualWorkSource):
     self._close_connection()
     
     
+  # Submits queued shares until the window of shares in flight is full
+  def _send_shares(self):
+    while True:
+      with self.txnlock:
+        if self.shutdown or not self.authorized or not self.submitqueue or self.submitsinflight >= self.settings.submitwindow: return
+        share = self.submitqueue[0]
+        stale = None
+        if share.session != self.session:
+          # The share was found on a job of an earlier connection. The pool will only accept it if it resumed
+          # that session (otherwise it doesn't know the job and extranonce1) and if it is still for the current
+          # block. Both are known after the first notify, which arrives after the subscription.
+          with self.datalock: data = self.data
+          if not data: return
+          if share.job.prevhash != data["prevhash"]: stale = "stale (new block while reconnecting)"
+          elif share.extranonce1 != data["extranonce1"]: stale = "stale (session changed)"
+          else: self.sharesreplayed += 1
+        self.submitqueue.popleft()
+        if not stale: self.submitsinflight += 1
+      if stale: share.job.nonce_handled_callback(share.nonce, share.noncediff, stale)
+      else: self._submit(share)
+      
+      
+  def _submit(self, share):
+    starttime = monotonic()
+    submitted = lambda txn, result: self._share_handled(share, starttime, result)
+    submit_failed = lambda txn, error: self._share_handled(share, starttime, error)
+    submit_timeout = lambda txn, shutdown: self._share_timeout(share, shutdown)
+    try:
+      with self.txnlock:
+        txn = self._txn("mining.submit", share.params, submitted, submit_failed, submit_timeout)
+        self.txns[txn]["share"] = share
+    except:
+      # The connection died, try again after reconnecting
+      with self.txnlock:
+        self.submitqueue.appendleft(share)
+        self.submitsinflight -= 1
+      
+      
+  def _share_handled(self, share, starttime, result):
+    self.submitlatency.add(monotonic() - starttime)
+    with self.txnlock: self.submitsinflight -= 1
+    share.job.nonce_handled_callback(share.nonce, share.noncediff, result)
+    self._send_shares()
+      
+      
+  def _share_timeout(self, share, shutdown):
+    if not shutdown: self.submitlatency.add_error()
+    with self.txnlock: self.submitsinflight -= 1
+    share.job.nonce_handled_callback(share.nonce, share.noncediff, self._nonce_timeout_err(shutdown))
+    
+    
   def _nonce_timeout_err(self, shutdown):
     if shutdown: return "shutting down"
     self._close_connection()
@@ -297,9 +522,19 @@ class StratumWorkSource(ActualWorkSource):
         
         
   def nonce_found(self, job, data, nonce, noncediff):
-    data = [self.username, job._stratum_job_id, job._stratum_extranonce2, job._stratum_ntime, hexlify(nonce).decode("ascii")]
-    submitted = lambda txn, result: job.nonce_handled_callback(nonce, noncediff, result)
-    submit_failed = lambda txn, error: job.nonce_handled_callback(nonce, noncediff, error)
-    submit_timeout = lambda txn, shutdown: job.nonce_handled_callback(nonce, noncediff, self._nonce_timeout_err(shutdown))
-    try: self._txn("mining.submit", data, submitted, submit_failed, submit_timeout)
-    except Exception as e: job.nonce_handled_callback(nonce, noncediff, str(e))
+    job_id, extranonce2, ntime, session, extranonce1, versionbits = job.get_ext("theseven_stratum")
+    params = [self.username, job_id, extranonce2, ntime, hexlify(nonce).decode("ascii")]
+    if versionbits: params.append(versionbits)
+    share = Bunch(job = job, nonce = nonce, noncediff = noncediff, params = params, session = session, extranonce1 = extranonce1)
+    if self.shutdown:
+      job.nonce_handled_callback(nonce, noncediff, "shutting down")
+      return
+    dropped = None
+    with self.txnlock:
+      self.submitqueue.append(share)
+      # Memory is bounded, the oldest shares are the least likely to be accepted
+      if len(self.submitqueue) > self.settings.submitqueuesize:
+        dropped = self.submitqueue.popleft()
+        self.sharesdropped += 1
+    if dropped: dropped.job.nonce_handled_callback(dropped.nonce, dropped.noncediff, "share queue overflow")
+    engine.call(self._send_shares)
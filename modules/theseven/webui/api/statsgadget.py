@@ -34,6 +34,9 @@ def getworkerstats(core, webui, httprequest, path, request, privileges):
     "starttime": core.stats.starttime,
     "ghashes": ghashes,
     "avgmhps": 1000. * ghashes / (now - core.stats.starttime),
+    "midstate_backend": core.stats.midstate_backend,
+    "workqueue": core.workqueue.get_lock_statistics(),
+    "fetcher": core.fetcher.get_statistics(),
     "workers": core.get_worker_statistics(),
   }
 
@@ -63,6 +66,9 @@ def getallstats(core, webui, httprequest, path, request, privileges):
     "starttime": core.stats.starttime,
     "ghashes": ghashes,
     "avgmhps": 1000. * ghashes / (now - core.stats.starttime),
+    "midstate_backend": core.stats.midstate_backend,
+    "workqueue": core.workqueue.get_lock_statistics(),
+    "fetcher": core.fetcher.get_statistics(),
     "workers": core.get_worker_statistics(),
     "worksources": core.get_work_source_statistics(),
     "blockchains": core.get_blockchain_statistics(),
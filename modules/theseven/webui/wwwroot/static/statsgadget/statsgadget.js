@@ -166,6 +166,9 @@ mod.statsgadget = {
                     "sharesinvalid": {430: invalidSharesDefinition, 440: makePerHourDefinition("Invalids per hour", 2)},
                     "starttime": {1000: uptimeDefinition},
                     "parallel_jobs": {1100: {"title": "Jobs processed in parallel", "renderer": intRenderer}},
+                    "kernel": {1200: {"title": "Hashing kernel"}},
+                    "python_mhps": {1210: {"title": "Python kernel MH/s", "renderer": floatRenderer, "rendererconfig": {"precision": 2}}},
+                    "numpy_mhps": {1220: {"title": "NumPy kernel MH/s", "renderer": floatRenderer, "rendererconfig": {"precision": 2}}},
                     "current_job": {},
                     "current_work_source": {},
                     "current_work_source_id": {},
@@ -183,6 +186,7 @@ mod.statsgadget = {
                     "supports_rollntime": {120: {"title": "Supports X-Roll-NTime", "renderer": booleanRenderer}},
                     "jobs_per_request": {130: {"title": "Jobs per request", "renderer": intRenderer}},
                     "job_expiry": {140: {"title": "Job validity timeframe", "renderer": timespanRenderer}},
+                    "fetch_latency": {160: {"title": "Fetch latency (s)", "renderer": floatRenderer, "rendererconfig": {"precision": 3}}},
                     "difficulty": {150: {"title": "Difficulty", "renderer": floatRenderer, "rendererconfig": {"precision": 2}}},
                     "avgmhps": {200: averageMHpsDefinition},
                     "ghashes": {230: gHashesTotalDefinition},
@@ -192,6 +196,9 @@ mod.statsgadget = {
                     "jobsreceived": {400: receivedJobsDefinition, 410: makePerHourDefinition("Received per hour", 2)},
                     "jobsaccepted": {420: acceptedJobsPercentageDefinition, 430: makePerHourDefinition("Accepted per hour", 2)},
                     "jobscanceled": {440: canceledJobsDefinition, 450: makePerHourDefinition("Canceled per hour", 2)},
+                    "jobsexpired": {460: {"title": "Expired unused", "renderer": intRenderer}},
+                    "jobsstale": {470: {"title": "Stale unused", "renderer": intRenderer}},
+                    "cancelsavoided": {480: {"title": "Cancels avoided", "renderer": intRenderer}},
                     "sharesaccepted": {210: effectiveMHpsDefinition, 220: utilityDefinition, 500: acceptedSharesDefinition},
                     "sharesrejected": {510: rejectedSharesDefinition, 520: makePerHourDefinition("Rejects per hour", 2)},
                     "starttime": {1000: uptimeDefinition},
@@ -205,6 +212,9 @@ mod.statsgadget = {
                     "name": {100: {"title": "Blockchain name"}},
                     "blocks": {200: {"title": "Blocks seen", "renderer": intRenderer}, 210: makePerHourDefinition("Blocks per hour", 2)},
                     "lastblock": {220: {"title": "Last block", "renderer": timestampRenderer}, 230: timeAgoDefinition},
+                    "switchtime": {240: {"title": "Last block switch (s)", "renderer": floatRenderer, "rendererconfig": {"precision": 3}}},
+                    "avgswitchtime": {250: {"title": "Average block switch (s)", "renderer": floatRenderer, "rendererconfig": {"precision": 3}}},
+                    "maxswitchtime": {260: {"title": "Slowest block switch (s)", "renderer": floatRenderer, "rendererconfig": {"precision": 3}}},
                     "avgmhps": {300: averageMHpsDefinition},
                     "ghashes": {330: gHashesTotalDefinition},
                     "jobsreceived": {400: receivedJobsDefinition, 410: makePerHourDefinition("Received per hour", 2)},
@@ -158,11 +158,13 @@ class ZtexBoardProxy(Process):
             self.lastnonce = nonces[0][1]
             exhausted = True
         if exhausted: self.send("keyspace_exhausted")
+        found = []
         for nonce in nonces:
           if nonce[0] != -self.device.nonce_offset and not nonce[0] in lastshares:
-            if self.job: self.send("nonce_found", time.time(), struct.pack("<I", nonce[0]))
+            if self.job: found.append(struct.pack("<I", nonce[0]))
             lastshares.append(nonce[0])
             while len(lastshares) > len(nonces): lastshares.pop(0)
+        if found: self.send("nonces_found", time.time(), found)
         
         # Verify proper operation and adjust clocking if neccessary
         if now > self.checklockout and self.job:
@@ -170,7 +170,7 @@ class ZtexWorker(BaseWorker):
           elif data[0] == "dying": raise Exception("Proxy died!")
           elif data[0] == "response": self.response_queue.put(data[1:])
           elif data[0] == "started_up": self._notify_proxy_started_up(*data[1:])
-          elif data[0] == "nonce_found": self._notify_nonce_found(*data[1:])
+          elif data[0] == "nonces_found": self._notify_nonces_found(*data[1:])
           elif data[0] == "speed_changed": self._notify_speed_changed(*data[1:])
           elif data[0] == "error_rate": self._notify_error_rate(*data[1:])
           elif data[0] == "keyspace_exhausted": self._notify_keyspace_exhausted(*data[1:])
@@ -232,21 +232,21 @@ class ZtexWorker(BaseWorker):
     self.workloopthread.start()
 
     
-  def _notify_nonce_found(self, now, nonce):
+  def _notify_nonces_found(self, now, nonces):
     # Snapshot the current jobs to avoid race conditions
     oldjob = self.oldjob
     newjob = self.job
     # If there is no job, this must be a leftover from somewhere, e.g. previous invocation
     # or reiterating the keyspace because we couldn't provide new work fast enough.
-    # In both cases we can't make any use of that nonce, so just discard it.
+    # In both cases we can't make any use of these nonces, so just discard them.
     if not oldjob and not newjob: return
-    # Pass the nonce that we found to the work source, if there is one.
-    # Do this before calculating the hash rate as it is latency critical.
-    job = None
+    # Pass the nonces that we found to the work source, if there is one.
+    # All nonces of one poll are verified as a batch. Those that don't
+    # belong to the current job are retried against the previous one.
     if newjob:
-      if newjob.nonce_found(nonce, oldjob): job = newjob
-    if not job and oldjob:
-      if oldjob.nonce_found(nonce): job = oldjob
+      results = newjob.nonces_found(nonces, oldjob)
+      nonces = [nonce for nonce, result in zip(nonces, results) if not result]
+    if nonces and oldjob: oldjob.nonces_found(nonces)
 
 
   def _notify_speed_changed(self, speed):
@@ -34,6 +34,7 @@ import time
 import signal
 from optparse import OptionParser
 from core.core import Core
+from benchmarks import suites as benchmark_suites
 
 
 if __name__ == "__main__":
@@ -48,15 +49,32 @@ if __name__ == "__main__":
                     help = "Autodetect available workers and add them to the instance")
   parser.add_option("--add-example-work-sources", action = "store_true", default = False,
                     help = "Add the example work sources to the instance")
+  parser.add_option("--starvation-probability", action = "store", type = "float", default = 0.001, metavar = "P",
+                    help = "Size the work buffer so that it runs dry with at most this probability (default: 0.001)")
+  parser.add_option("--benchmark", action = "store", type = "string", default = None, metavar = "SUITE",
+                    help = "Run a benchmark suite (%s) instead of mining, and compare it against the saved baseline" % ", ".join(benchmark_suites))
+  parser.add_option("--benchmark-threshold", action = "store", type = "float", default = 10, metavar = "PERCENT",
+                    help = "Report benchmarks that got slower than this as regressions (default: 10%)")
+  parser.add_option("--benchmark-save", action = "store_true", default = False,
+                    help = "Save the benchmark results as the new baseline")
   (options, args) = parser.parse_args()
 
+  # Run the requested benchmark suite, exits with status 1 if there were regressions
+  if options.benchmark:
+    from benchmarks.benchmark import run_suite
+    if not options.benchmark in benchmark_suites: parser.error("Unknown benchmark suite: %s" % options.benchmark)
+    sys.exit(1 if run_suite(options.benchmark, options.benchmark_threshold, options.benchmark_save) else 0)
+
   # Figure out instance name
   if len(args) == 0: instancename = "default"
   elif len(args) == 1: instancename = args[0]
   else: parser.error("Incorrect number of arguments")
 
+  if not 0 < options.starvation_probability < 0.5: parser.error("Starvation probability must be between 0 and 0.5")
+
   # Create core instance, will load saved instance state if present
   core = Core(instance = instancename, default_loglevel = options.default_loglevel)
+  core.fetcher.settings.starvation_probability = options.starvation_probability
 
   # Autodetect appropriate frontends if requested or if a new instance is being set up
   if options.detect_frontends or core.is_new_instance: